@@ -0,0 +1,342 @@
+##    Copyright 2017 MICtools Developers <davide.albanese@gmail.com>
+
+##    This file is part of MICtools.
+##
+##    MICtools is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    MICtools is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Throughput benchmarks of the MICtools pipeline stages (null, pval,
+strength and multiple testing correction) on synthetic data.
+
+The synthetic variables are resampled from the variables of
+examples/datasaurus.txt, so that the value distributions (and ties) are
+realistic, and half of them are noisy functions of another variable.
+
+Usage:
+
+    python benchmarks/bench.py run results.json
+    python benchmarks/bench.py run results.json -m 50,200 -n 142,1000 -b 9
+    python benchmarks/bench.py run results.json --stages pval -j 4
+    python benchmarks/bench.py compare old.json new.json
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import platform
+import tempfile
+import itertools
+
+import click
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import minepy
+import mictools
+import mictools.null
+import mictools.pval
+import mictools.strength
+import mictools.mtest
+
+
+BENCH_FORMAT = "mictools-bench"
+BENCH_VERSION = 1
+DATASAURUS_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "examples", "datasaurus.txt")
+
+FUNCTIONS = [lambda x: x, np.sin, np.square, np.abs, np.cos]
+
+
+def read_base(base_fn=DATASAURUS_FN):
+    """Read the base dataset (variables x samples) used by synthetic_data().
+    """
+
+    return pd.read_csv(base_fn, sep='\t', index_col=0).values
+
+
+def _scaled(x):
+    return (x - x.mean()) / (x.std() + 1e-12)
+
+
+def synthetic_data(base, m, n, seed=0, prefix="V"):
+    """Return a synthetic dataset (m variables x n samples). Each variable is
+    resampled (with replacement) from a random variable of base. The odd
+    variables are a noisy function of the previous one.
+    """
+
+    rs = np.random.RandomState(seed)
+    data = np.empty((m, n), dtype=np.float64)
+    for i in range(m):
+        if (i % 2) and (rs.rand() < 0.5):
+            f = FUNCTIONS[rs.randint(len(FUNCTIONS))]
+            x = _scaled(data[i-1])
+            data[i] = f(2 * x) + rs.normal(scale=rs.uniform(0.1, 1.0),
+                                           size=n)
+        else:
+            data[i] = rs.choice(base[rs.randint(base.shape[0])], size=n)
+
+    return pd.DataFrame(data, index=["{}{:d}".format(prefix, i)
+                                     for i in range(m)],
+                        columns=["S{:d}".format(j) for j in range(n)])
+
+
+def synthetic_labels(columns, nclasses, seed=0):
+    """Assign the samples to nclasses classes of (almost) equal size.
+    """
+
+    rs = np.random.RandomState(seed)
+    labels = np.arange(len(columns)) % nclasses
+    rs.shuffle(labels)
+
+    return pd.Series(["C{:d}".format(l) for l in labels], index=columns)
+
+
+def timeit(func, repeat=1):
+    """Return the best wall time of repeat calls of func.
+    """
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def _record(stage, params, seconds, count, unit):
+    return {"stage": stage, "params": params, "seconds": seconds,
+            "count": count, "rate": count / seconds if seconds > 0 else None,
+            "unit": unit}
+
+
+def bench_null(base, m, n, B, nclasses, nperm, seed=0, repeat=1):
+    X = synthetic_data(base, m, n, seed=seed)
+    labels = None if nclasses == 1 else \
+        synthetic_labels(X.columns, nclasses, seed=seed)
+    seconds = timeit(lambda: mictools.null.compute_null(
+        X, labels=labels, B=B, nperm=nperm, seed=seed), repeat=repeat)
+
+    params = {"M": m, "n": n, "B": B, "classes": nclasses, "nperm": nperm}
+
+    return _record("null", params, seconds, nperm * nclasses, "perm/s")
+
+
+def bench_pval(base, mode, m, k, n, B, nclasses, jobs=1, seed=0, repeat=1):
+    X = synthetic_data(base, m, n, seed=seed, prefix="X")
+    Y = None if mode == "all" else \
+        synthetic_data(base, k, n, seed=seed+1, prefix="Y")
+    labels = None if nclasses == 1 else \
+        synthetic_labels(X.columns, nclasses, seed=seed)
+    single = (mode == "rowwise")
+
+    # the null distribution is not timed. jobs is passed only if > 1, so
+    # that the benchmark also runs on the versions without it
+    null_dist = mictools.null.compute_null(X, labels=labels, Y=Y,
+                                           rowwise=single, B=B, nperm=1000,
+                                           seed=seed)
+    kwargs = {} if jobs == 1 else {"jobs": jobs}
+    seconds = timeit(lambda: mictools.pval.compute_pval(
+        X, null_dist, labels=labels, Y=Y, single=single, B=B, **kwargs),
+                     repeat=repeat)
+
+    if Y is None:
+        npairs = m * (m - 1) // 2
+    elif single:
+        npairs = min(m, k)
+    else:
+        npairs = m * k
+    params = {"mode": mode, "M": m, "K": None if Y is None else k, "n": n,
+              "B": B, "classes": nclasses, "jobs": jobs}
+
+    return _record("pval", params, seconds, npairs * nclasses, "pair/s")
+
+
+def bench_strength(base, m, n, nclasses, seed=0, repeat=1):
+    X = synthetic_data(base, m, n, seed=seed)
+    labels = None if nclasses == 1 else \
+        synthetic_labels(X.columns, nclasses, seed=seed)
+    clss = ['None'] if labels is None else sorted(labels.unique())
+
+    # all the pairs are below the threshold
+    i, j = np.triu_indices(m, k=1)
+    index = pd.MultiIndex.from_arrays([X.index[i], X.index[j]],
+                                      names=['Var1', 'Var2'])
+    rs = np.random.RandomState(seed)
+    pval = pd.DataFrame(rs.uniform(0, 0.5, size=(i.shape[0], len(clss))),
+                        index=index, columns=clss)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_fn = os.path.join(tmp_dir, "strength.txt")
+        seconds = timeit(lambda: mictools.strength.compute_strength(
+            X, pval, output_fn, labels=labels, t=1.0), repeat=repeat)
+
+    return _record("strength", {"M": m, "n": n, "classes": nclasses},
+                   seconds, i.shape[0] * len(clss), "pair/s")
+
+
+def bench_mtest(npvals, method, seed=0, repeat=1):
+    rs = np.random.RandomState(seed)
+
+    # p-values of an empirical null (ties), with 10% of signals
+    nperm = 200000
+    pvals = (rs.randint(0, nperm, size=npvals) + 1) / (nperm + 1)
+    nsig = npvals // 10
+    pvals[:nsig] = (rs.randint(0, 10, size=nsig) + 1) / (nperm + 1)
+
+    if method == "qvalue":
+        func = lambda: mictools.mtest.qvalue(pvals)
+    else:
+        func = lambda: mictools.mtest.multipletests(pvals, method=method)
+    seconds = timeit(func, repeat=repeat)
+
+    return _record("mtest", {"method": method, "npvals": npvals}, seconds,
+                   npvals, "pval/s")
+
+
+def _int_list(ctx, param, value):
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise click.BadParameter("must be a comma-separated list of integers")
+
+
+def _environment():
+    minepy_version = getattr(minepy, "__version__", None)
+    if isinstance(minepy_version, bytes):
+        minepy_version = minepy_version.decode()
+
+    return {"mictools": mictools.__version__, "minepy": minepy_version,
+            "numpy": np.__version__, "pandas": pd.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+@click.group()
+def cli():
+    """MICtools benchmarks.
+    """
+
+
+@cli.command()
+@click.argument('output', type=click.Path(writable=True))
+@click.option('-m', '--m', 'ms', default="50,200", callback=_int_list,
+              show_default=True, help='numbers of X variables.')
+@click.option('-k', '--k', 'ks', default="50", callback=_int_list,
+              show_default=True, help='numbers of Y variables (cross mode).')
+@click.option('-n', '--n', 'ns', default="142,500", callback=_int_list,
+              show_default=True, help='numbers of samples.')
+@click.option('-b', '--grid', 'grids', default="9", callback=_int_list,
+              show_default=True, help='TICe grid sizes (B).')
+@click.option('-l', '--classes', 'nclasses', default="1,2",
+              callback=_int_list, show_default=True, help='numbers of '
+              'sample classes.')
+@click.option('-p', '--nperm', type=click.INT, default=20000,
+              show_default=True, help='permutations of the null benchmark.')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True, help='pval worker processes (see mictools '
+              'pval -j/--jobs).')
+@click.option('--npvals', default="100000,1000000", callback=_int_list,
+              show_default=True, help='numbers of p-values of the multiple '
+              'testing benchmark.')
+@click.option('--methods', default="qvalue,fdr_bh,holm", show_default=True,
+              help='multiple testing methods, comma-separated.')
+@click.option('--stages', default="null,pval,strength,mtest",
+              show_default=True, help='stages to run, comma-separated.')
+@click.option('-r', '--repeat', type=click.INT, default=1, show_default=True,
+              help='repetitions of each benchmark (the best time is '
+              'reported).')
+@click.option('-s', '--seed', type=click.INT, default=0, show_default=True,
+              help='seed of the synthetic data.')
+def run(output, ms, ks, ns, grids, nclasses, nperm, jobs, npvals, methods,
+        stages, repeat, seed):
+    """Run the benchmarks over the grid of parameters and write the results
+    to OUTPUT (JSON).
+    """
+
+    base = read_base()
+    stages = stages.split(',')
+    benchmarks = []
+    if "null" in stages:
+        benchmarks += [(bench_null, (base, m, n, B, ncl, nperm))
+                       for m, n, B, ncl in itertools.product(
+                           ms, ns, grids, nclasses)]
+    if "pval" in stages:
+        benchmarks += [(bench_pval, (base, "all", m, None, n, B, ncl, jobs))
+                       for m, n, B, ncl in itertools.product(
+                           ms, ns, grids, nclasses)]
+        benchmarks += [(bench_pval, (base, "cross", m, k, n, B, ncl, jobs))
+                       for m, k, n, B, ncl in itertools.product(
+                           ms, ks, ns, grids, nclasses)]
+        # rowwise pairs X_i, Y_i (K = M)
+        benchmarks += [(bench_pval, (base, "rowwise", m, m, n, B, ncl, jobs))
+                       for m, n, B, ncl in itertools.product(
+                           ms, ns, grids, nclasses)]
+    if "strength" in stages:
+        benchmarks += [(bench_strength, (base, m, n, ncl))
+                       for m, n, ncl in itertools.product(ms, ns, nclasses)]
+    if "mtest" in stages:
+        benchmarks += [(bench_mtest, (npv, method))
+                       for npv in npvals for method in methods.split(',')]
+
+    results = []
+    for func, args in benchmarks:
+        record = func(*args, seed=seed, repeat=repeat)
+        sys.stdout.write("{:<9} {:<72} {:>10.3f} s {:>14.1f} {}\n".format(
+            record["stage"], json.dumps(record["params"]),
+            record["seconds"], record["rate"], record["unit"]))
+        results.append(record)
+
+    report = {"format": BENCH_FORMAT, "version": BENCH_VERSION,
+              "environment": _environment(), "repeat": repeat, "seed": seed,
+              "results": results}
+    with open(output, 'w') as output_handle:
+        json.dump(report, output_handle, indent=1)
+
+
+@cli.command()
+@click.argument('old', type=click.Path(exists=True))
+@click.argument('new', type=click.Path(exists=True))
+def compare(old, new):
+    """Compare two benchmark results (e.g. of two versions). The speedup is
+    the ratio of the NEW and OLD rates.
+    """
+
+    reports = []
+    for fn in [old, new]:
+        with open(fn) as handle:
+            reports.append(json.load(handle))
+
+    key = lambda record: (record["stage"],
+                          json.dumps(record["params"], sort_keys=True))
+    rates_old = {key(record): record["rate"]
+                 for record in reports[0]["results"]}
+    for record in reports[1]["results"]:
+        rate_old = rates_old.get(key(record))
+        if rate_old is None:
+            continue
+        sys.stdout.write("{:<9} {:<72} {:>8.2f}x\n".format(
+            record["stage"], json.dumps(record["params"]),
+            record["rate"] / rate_old))
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,3 +1,4 @@
 __version__ = "1.1.4"
 
-NULL_HIST_RES = 10000
\ No newline at end of file
+NULL_HIST_RES = 10000
+NULL_FINE_RES = 1000000
\ No newline at end of file
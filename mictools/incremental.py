@@ -0,0 +1,229 @@
+##    Copyright 2017 MICtools Developers <davide.albanese@gmail.com>
+
+##    This file is part of MICtools.
+##
+##    MICtools is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    MICtools is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Incremental update of the pval results when variables are added.
+
+The variables of a pval run are stored with their content hashes (see
+mictools.pval.write_variables()). Given the updated data, only the pairs
+involving a new (or changed) variable are computed, and the pairs of the
+previous run are copied from its obs.txt and pval.txt files.
+"""
+
+import os
+import os.path
+import sys
+
+import numpy as np
+import pandas as pd
+
+import mictools.utils
+import mictools.pval
+import mictools.metrics
+from mictools import NULL_HIST_RES
+
+
+META_NAMES = {"B": "TICe grid size (B)", "c": "TICe c parameter",
+              "mode": "pairing mode", "samples": "sample set or labeling",
+              "null": "null distribution", "tail": "GPD tail"}
+
+
+def compare_variables(A, variables, name):
+    """Compare the variables of A (the set name, X or Y) with the previous
+    variables table (see mictools.pval.read_variables()) by name and
+    content hash. Return the boolean masks of the added and of the changed
+    variables and the number of variables removed.
+    """
+
+    names = A.index.astype(str)
+    if not names.is_unique:
+        raise ValueError("the {} variable names must be unique".format(name))
+
+    previous = variables[variables["Set"] == name]
+    previous = pd.Series(previous["Hash"].values, index=previous["Var"])
+    hashes = np.array(mictools.utils.row_sha1(A.values), dtype=object)
+    hashes_prev = previous.reindex(names).values
+    added = pd.isnull(hashes_prev)
+    changed = ~added & (hashes_prev != hashes)
+    nremoved = int((~previous.index.isin(names)).sum())
+
+    return added, changed, nremoved
+
+
+def check_previous(previous_dir, meta):
+    """Check that the results in previous_dir can be updated with the
+    parameters meta (see mictools.pval.run_meta()). Return the variables
+    table of the previous run.
+    """
+
+    try:
+        variables, meta_prev = mictools.pval.read_variables(
+            os.path.join(previous_dir, mictools.pval.VARIABLES_FN))
+    except IOError:
+        raise ValueError("{} not found in {} (the results must be computed "
+                         "by pval in the tsv format)".format(
+                             mictools.pval.VARIABLES_FN, previous_dir))
+
+    for key in sorted(meta):
+        if meta_prev.get(key) != meta[key]:
+            raise ValueError("the {} differs from the one of the previous "
+                             "run in {}".format(META_NAMES.get(key, key),
+                                                previous_dir))
+
+    for fn in ["obs.txt", "pval.txt", "obs_dist.txt"]:
+        if not os.path.isfile(os.path.join(previous_dir, fn)):
+            raise ValueError("{} not found in {}".format(fn, previous_dir))
+
+    if os.path.isfile(os.path.join(previous_dir, "pval_dist.txt")):
+        raise ValueError("the sparse results in {} (see pval --max-pval, "
+                         "--min-tic and --top-k) cannot be updated".format(
+                             previous_dir))
+
+    return variables
+
+
+def _iter_previous(previous_dir, chunk_size=1000000):
+    """Iterate over the obs.txt and pval.txt files of the previous run in
+    chunks of chunk_size pairs. Yield the (Var1, Var2) index and the TICe
+    values and p-values (pairs x classes).
+    """
+
+    readers = [pd.read_csv(os.path.join(previous_dir, fn), sep='\t',
+                           index_col=[0, 1], dtype={"Var1": str, "Var2": str},
+                           keep_default_na=False, na_values=[],
+                           chunksize=chunk_size)
+               for fn in ["obs.txt", "pval.txt"]]
+    while True:
+        with mictools.metrics.io("read", previous_dir):
+            obs, pval = next(readers[0], None), next(readers[1], None)
+        if obs is None:
+            break
+        yield obs.index, obs.values.astype(np.float64), \
+            pval.values.astype(np.float64)
+
+
+def update_pval(X, null_dist, previous_dir, output_dir, labels=None, Y=None,
+                B=9, c=5, tail=None, tile_size=1000000, jobs=1, meta=None):
+    """Update the pval results of a previous run (previous_dir) with the
+    variables added to X (or Y) and write them to output_dir (which can be
+    previous_dir). The variables are matched by name and content hash:
+    the pairs involving a new or changed variable are computed, the pairs
+    of the variables removed or changed are dropped and the others are
+    copied. The observed distribution is updated accordingly. The pairs of
+    the previous run are written first.
+    """
+
+    variables = check_previous(previous_dir, meta)
+
+    clss = ['None'] if labels is None else sorted(labels.unique())
+    sets = [("X", X)] if Y is None else [("X", X), ("Y", Y)]
+    new, nadded, nchanged, nremoved = [], 0, 0, 0
+    for name, A in sets:
+        added, changed, nremoved_A = compare_variables(A, variables, name)
+        new.append(added | changed)
+        nadded += int(added.sum())
+        nchanged += int(changed.sum())
+        nremoved += nremoved_A
+    new_x, new_y = new[0], (None if Y is None else new[1])
+    Z, new_z = sets[-1][1], new[-1]
+
+    # the variables of the previous run still valid
+    kept_x = X.index[~new_x].astype(str).values
+    kept_z = Z.index[~new_z].astype(str).values
+
+    nupdate = int(mictools.pval.update_npairs(new_x, new_y).sum())
+    ntot = mictools.pval.npairs(X.shape[0], None if Y is None else Y.shape[0])
+    sys.stdout.write("{:d} added, {:d} changed and {:d} removed variables: "
+                     "{:d} of {:d} pairs to compute\n".format(
+                         nadded, nchanged, nremoved, nupdate, ntot))
+
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    pval_bins = np.linspace(0, 1, mictools.pval.PVAL_PLOT_BINS+1)
+    observed_hist = np.zeros((len(clss), NULL_HIST_RES), dtype=np.int64)
+    removed_hist = np.zeros((len(clss), NULL_HIST_RES), dtype=np.int64)
+    pval_hist = np.zeros((len(clss), mictools.pval.PVAL_PLOT_BINS),
+                         dtype=np.int64)
+
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        if not os.path.isdir(output_dir):
+            raise ValueError("directory {} cannot be created".format(
+                output_dir))
+
+    # the output files replace the previous ones only when complete
+    output_fns = [os.path.join(output_dir, fn) for fn in
+                  ["obs.txt", "pval.txt", "obs_dist.txt",
+                   mictools.pval.VARIABLES_FN]]
+    obs_handle = open(output_fns[0] + ".tmp", 'w')
+    pval_handle = open(output_fns[1] + ".tmp", 'w')
+
+    def write_pairs(index, obs, pval, header):
+        with mictools.metrics.io("write", output_dir):
+            pd.DataFrame(obs, index=index, columns=clss).to_csv(
+                obs_handle, sep='\t', float_format='%.6f', header=header)
+            pd.DataFrame(pval, index=index, columns=clss).to_csv(
+                pval_handle, sep='\t', float_format='%e', header=header)
+
+    # pairs of the previous run
+    header = True
+    for index, obs, pval in _iter_previous(previous_dir):
+        keep = np.isin(index.get_level_values(0), kept_x) & \
+            np.isin(index.get_level_values(1), kept_z)
+        for l in range(len(clss)):
+            removed_hist[l] += np.histogram(obs[~keep, l], bins)[0]
+            pval_hist[l] += np.histogram(pval[keep, l], pval_bins)[0]
+        write_pairs(index[keep], obs[keep], pval[keep], header)
+        header = False
+
+    # pairs involving a new variable
+    groups = {}
+    for i, j, obs, pval in mictools.pval.iter_pval_update(
+            X=X, null_dist=null_dist, new_x=new_x, new_y=new_y,
+            labels=labels, Y=Y, B=B, c=c, tail=tail, tile_size=tile_size,
+            jobs=jobs, groups=groups):
+        for l in range(len(clss)):
+            observed_hist[l] += np.histogram(obs[:, l], bins)[0]
+            pval_hist[l] += np.histogram(pval[:, l], pval_bins)[0]
+        index = pd.MultiIndex.from_arrays([X.index.values[i],
+                                           Z.index.values[j]],
+                                          names=['Var1', 'Var2'])
+        write_pairs(index, obs, pval, header)
+        header = False
+    mictools.pval.write_groups(groups, Y is not None)
+
+    obs_handle.close()
+    pval_handle.close()
+
+    obs_dist_prev = pd.read_csv(os.path.join(previous_dir, "obs_dist.txt"),
+                                sep='\t', index_col=[0, 1, 2],
+                                keep_default_na=False, dtype={"Class": str})
+    for l, cl in enumerate(clss):
+        observed_hist[l] += obs_dist_prev.loc[cl]["ObsCount"].values - \
+            removed_hist[l]
+    obs_dist = pd.concat([mictools.pval._obs_dist_df(h)
+                          for h in observed_hist], axis=0, keys=clss,
+                         names=["Class"])
+
+    with mictools.metrics.io("write", output_dir):
+        obs_dist.to_csv(output_fns[2] + ".tmp", sep='\t', float_format="%.6f")
+        mictools.pval.write_variables(output_fns[3] + ".tmp", X, Y, meta)
+        for fn in output_fns:
+            os.replace(fn + ".tmp", fn)
+
+    for l, cl in enumerate(clss):
+        mictools.pval.plot_pval_hist(pval_hist[l], cl, output_dir)
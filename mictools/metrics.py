@@ -0,0 +1,234 @@
+##    Copyright 2017 MICtools Developers <davide.albanese@gmail.com>
+
+##    This file is part of MICtools.
+##
+##    MICtools is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    MICtools is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run metrics and progress reporting.
+
+The computations report their work with tick() (e.g. permutations or pairs,
+optionally per class) and the reads/writes are timed with io(). The data
+are collected per stage (see stage()) when the metrics are enabled (see
+enable()), otherwise the hooks do nothing. Only the process which enabled
+the metrics records them: the work done in the worker processes is
+reported by the main process when the results are collected.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+METRICS_FORMAT = "mictools-metrics"
+METRICS_VERSION = 3
+PROGRESS_INTERVAL = 1.0
+
+_state = {"enabled": False, "progress": False, "pid": None, "stages": [],
+          "stack": [], "profiler": None}
+
+
+def enable(progress=False, profile=False):
+    """Start recording the metrics. If progress is True, the progress of
+    the current stage (with throughput and ETA) is written to stderr. If
+    profile is True, the main process is profiled with cProfile (see
+    write_profile()).
+    """
+
+    _state.update(enabled=True, progress=progress, pid=os.getpid(),
+                  stages=[], stack=[])
+    if profile:
+        _state["profiler"] = cProfile.Profile()
+        _state["profiler"].enable()
+
+
+def _active():
+    return _state["enabled"] and (_state["pid"] == os.getpid())
+
+
+def _peak_rss():
+    """Return the peak resident set size (bytes) of the process and the
+    largest peak RSS among its terminated (and waited for) children. The
+    latter is not the sum over the children: n workers using x bytes each
+    give x, not n*x.
+    """
+
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Record the wall and CPU times, the work done and the I/O time of a
+    stage. Nested stages are named parent.name. The peak RSS of the
+    process and the largest one of its children (see _peak_rss()) are taken
+    at the end of the stage, i.e. over the stage and everything run before
+    it.
+    """
+
+    if not _active():
+        yield
+        return
+
+    if _state["stack"]:
+        name = "{}.{}".format(_state["stack"][-1]["name"], name)
+    times = os.times()
+    start = time.perf_counter()
+    current = {"name": name, "counters": {}, "totals": {},
+               "io": {}, "start": start,
+               "cpu_start": (times.user + times.system,
+                             times.children_user + times.children_system),
+               "last_progress": start, "last_counter": None}
+    _state["stack"].append(current)
+    try:
+        yield
+    finally:
+        _state["stack"].pop()
+        _state["stages"].append(_stage_report(current))
+        counter = current["last_counter"]
+        if _state["progress"] and (counter is not None):
+            _write_progress(current, counter,
+                            sum(current["counters"][counter].values()),
+                            time.perf_counter())
+            sys.stderr.write("\n")
+
+
+def _stage_report(current):
+    wall = time.perf_counter() - current["start"]
+    times = os.times()
+    peak_rss, max_child_peak_rss = _peak_rss()
+
+    counters = {}
+    for counter, counts in current["counters"].items():
+        total = sum(counts.values())
+        counters[counter] = {"total": total,
+                             "rate": total / wall if wall > 0 else None,
+                             "classes": {str(cl): n for cl, n in
+                                         counts.items() if cl is not None}}
+
+    return {"name": current["name"], "wall_time": wall,
+            "cpu_time": times.user + times.system - current["cpu_start"][0],
+            "cpu_time_children": times.children_user + \
+                times.children_system - current["cpu_start"][1],
+            "process_peak_rss": peak_rss,
+            "max_child_peak_rss": max_child_peak_rss,
+            "counters": counters, "io": current["io"]}
+
+
+def set_total(counter, total):
+    """Set the expected total of a counter of the current stage, used to
+    report the progress.
+    """
+
+    if _active() and _state["stack"]:
+        _state["stack"][-1]["totals"][counter] = total
+
+
+def tick(counter, n=1, cls=None):
+    """Add n units of work (e.g. permutations or pairs) of the class cls to
+    the counter of the current stage.
+    """
+
+    if not (_active() and _state["stack"]):
+        return
+
+    current = _state["stack"][-1]
+    counts = current["counters"].setdefault(counter, {})
+    counts[cls] = counts.get(cls, 0) + n
+    current["last_counter"] = counter
+
+    if _state["progress"]:
+        now = time.perf_counter()
+        if now - current["last_progress"] >= PROGRESS_INTERVAL:
+            current["last_progress"] = now
+            _write_progress(current, counter, sum(counts.values()), now)
+
+
+def _write_progress(current, counter, done, now):
+    elapsed = now - current["start"]
+    rate = done / elapsed if elapsed > 0 else 0.0
+    total = current["totals"].get(counter)
+    line = "[{}] {:d} {}".format(current["name"], done, counter)
+    if total:
+        line += " of {:d} ({:.1f}%)".format(total, 100 * done / total)
+    line += ", {:.1f}/s".format(rate)
+    if total and rate > 0:
+        line += ", ETA {:.0f}s".format(max(total - done, 0) / rate)
+    sys.stderr.write("\r" + line.ljust(79))
+    sys.stderr.flush()
+
+
+@contextlib.contextmanager
+def io(kind, fn=None):
+    """Time a read or write (kind) and add it to the current stage.
+    """
+
+    if not (_active() and _state["stack"]):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        io_kind = _state["stack"][-1]["io"].setdefault(
+            kind, {"time": 0.0, "calls": 0, "files": []})
+        io_kind["time"] += time.perf_counter() - start
+        io_kind["calls"] += 1
+        if (fn is not None) and (fn not in io_kind["files"]):
+            io_kind["files"].append(fn)
+
+
+def report():
+    """Return the metrics recorded so far.
+    """
+
+    peak_rss, max_child_peak_rss = _peak_rss()
+
+    return {"format": METRICS_FORMAT, "version": METRICS_VERSION,
+            "argv": sys.argv, "process_peak_rss": peak_rss,
+            "max_child_peak_rss": max_child_peak_rss,
+            "stages": list(_state["stages"])}
+
+
+def write_metrics(output_fn):
+    """Write the metrics report (JSON).
+    """
+
+    with open(output_fn, 'w') as output_handle:
+        json.dump(report(), output_handle, indent=1)
+
+
+def write_profile(output_fn):
+    """Stop the profiler and write the statistics (see the pstats module).
+    """
+
+    profiler = _state["profiler"]
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(output_fn)
+        _state["profiler"] = None
@@ -26,22 +26,186 @@ import scipy.stats
 import statsmodels.stats.multitest
 
 
-def pi0est(pvals, lmb=np.arange(0.05, 1, 0.05), method="smoother"):
-    pvals_arr = np.asarray(pvals, dtype=np.float)
-    lmb_arr = np.atleast_1d(lmb)
+# The adjustments are computed on the sorted unique p-values and their
+# counts (see pval_counts()), so the cost depends on the number of distinct
+# p-values only. Tied p-values always receive the same adjusted value.
+# When there are too many distinct p-values, they can be binned on the
+# fixed grid PVAL_GRID instead (see pval_hist() and PValCounts): the cost
+# is then O(bins), and the adjusted values are conservative but no longer
+# exact. Each p-value is rounded up by at most 0.23%, and the adjustments
+# based on it (e.g. bonferroni, holm, fdr_bh) by the same amount. The
+# q-values can differ more, about 1% in practice, because the binning also
+# moves the pi0 estimate.
 
-    if pvals_arr.ndim != 1:
-        raise ValueError("p must be an 1d array_like object")
+# p-value bin edges: 0 and PVAL_GRID_DECADE geometric steps per decade in
+# [10^-PVAL_GRID_DECADES, 1], i.e. a relative resolution of about 0.23%
+PVAL_GRID_DECADES = 300
+PVAL_GRID_DECADE = 1000
+PVAL_GRID = np.concatenate([[0.], np.logspace(
+    -PVAL_GRID_DECADES, 0, PVAL_GRID_DECADES*PVAL_GRID_DECADE+1)])
+
+# number of distinct p-values above which PValCounts bins the p-values
+MAX_UNIQUE_PVALS = 10000000
+
+STEPDOWN_METHODS = {
+    "bonferroni": ["b", "bonf", "bonferroni"],
+    "sidak": ["s", "sidak"],
+    "holm-sidak": ["hs", "holm-sidak"],
+    "holm": ["h", "holm"],
+    "simes-hochberg": ["sh", "simes-hochberg"],
+    "fdr_bh": ["fdr_bh", "fdr_i", "fdr_p", "fdri", "fdrp"],
+    "fdr_by": ["fdr_by", "fdr_n", "fdr_c", "fdrn", "fdrcorr"],
+    "fdr_tsbky": ["fdr_tsbky", "fdr_2sbky", "fdr_twostage"],
+    "fdr_tsbh": ["fdr_tsbh", "fdr_2sbh"]
+    }
+
+
+def pval_counts(pvals, counts=None):
+    """Return the sorted unique p-values and the number of occurrences of
+    each one. If counts is provided, pvals[i] occurs counts[i] times.
+    """
+
+    pvals_arr = np.asarray(pvals, dtype=np.float64).ravel()
+
+    if counts is None:
+        return np.unique(pvals_arr, return_counts=True)
+
+    values, inverse = np.unique(pvals_arr, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts,
+                         minlength=values.shape[0]).astype(np.int64)
+    nonzero = counts > 0
+
+    return values[nonzero], counts[nonzero]
+
+
+def pval_hist(pvals, counts=None):
+    """Return the histogram of the p-values on the fixed grid PVAL_GRID,
+    where each bin stands for its upper edge. If counts is provided,
+    pvals[i] occurs counts[i] times. The size of the histogram does not
+    depend on the number of p-values, so the histograms of chunks of
+    p-values can be summed.
+    """
+
+    pvals_arr = np.asarray(pvals, dtype=np.float64).ravel()
+    bins = np.minimum(np.searchsorted(PVAL_GRID, pvals_arr, side='left'),
+                      PVAL_GRID.shape[0]-1)
+
+    return np.bincount(bins, weights=counts,
+                       minlength=PVAL_GRID.shape[0]).astype(np.int64)
+
+
+def hist_counts(hist):
+    """Return the p-values (upper bin edges) and the counts of the non-empty
+    bins of a histogram (see pval_hist()). Since every p-value is replaced
+    by the upper edge of its bin, the adjustments are conservative.
+    """
+
+    nonzero = hist > 0
+
+    return PVAL_GRID[nonzero], hist[nonzero]
+
+
+class PValCounts(object):
+    """Accumulate p-values (e.g. chunk by chunk) as their sorted unique
+    values and counts (see pval_counts()). The chunks are merged when
+    their total size exceeds the number of unique values merged so far, so
+    the cost is not quadratic in the number of chunks.
+
+    If binned is True, or as soon as there are more than max_unique
+    distinct p-values, the p-values are binned on the fixed grid PVAL_GRID
+    instead (see pval_hist()): the memory is bounded, but the adjusted
+    values are conservative approximations.
+    """
+
+    def __init__(self, binned=False, max_unique=MAX_UNIQUE_PVALS):
+        self.binned = binned
+        self.max_unique = max_unique
+        self._hist = pval_hist([]) if binned else None
+        self._values = np.empty(0, dtype=np.float64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._npending = 0
+
+    def add(self, pvals, counts=None):
+        """Add the p-values pvals (pvals[i] occurs counts[i] times, if
+        counts is provided).
+        """
+
+        if self.binned:
+            self._hist += pval_hist(pvals, counts)
+            return
+
+        values, counts = pval_counts(pvals, counts)
+        self._pending.append((values, counts))
+        self._npending += values.shape[0]
+        if self._npending > self._values.shape[0]:
+            self._merge()
+
+    def _merge(self):
+        values = [self._values] + [v for v, _ in self._pending]
+        counts = [self._counts] + [n for _, n in self._pending]
+        self._values, self._counts = pval_counts(np.concatenate(values),
+                                                 np.concatenate(counts))
+        self._pending, self._npending = [], 0
+
+        if self._values.shape[0] > self.max_unique:
+            self.binned = True
+            self._hist = pval_hist(self._values, self._counts)
+            self._values = np.empty(0, dtype=np.float64)
+            self._counts = np.empty(0, dtype=np.int64)
+
+    def counts(self):
+        """Return the sorted unique p-values (the upper bin edges, if
+        binned) and their counts.
+        """
+
+        if self.binned:
+            return hist_counts(self._hist)
+
+        if self._pending:
+            self._merge()
+            if self.binned:
+                return hist_counts(self._hist)
+
+        return self._values, self._counts
+
+
+def map_counts(pvals, values, adjusted):
+    """Map the adjusted values of the unique p-values (see pval_counts()) or
+    of the bins (see hist_counts()) back to pvals.
+    """
+
+    index = np.searchsorted(values, pvals, side='left')
+
+    return adjusted[np.minimum(index, values.shape[0]-1)]
+
+
+def _count_above(values, counts, t, inclusive=False):
+    """Number of p-values > t (>= t if inclusive), for each t.
+    """
+
+    cum = np.concatenate([[0], np.cumsum(counts)])
+    side = 'left' if inclusive else 'right'
+
+    return cum[-1] - cum[np.searchsorted(values, t, side=side)]
+
+
+def pi0est_counts(values, counts, lmb=np.arange(0.05, 1, 0.05),
+                  method="smoother"):
+    """pi0est() on the unique p-values and their counts (see pval_counts()).
+    """
+
+    lmb_arr = np.atleast_1d(lmb)
 
     if lmb_arr.ndim > 1:
         raise ValueError("lmb must be an 1d array_like object or a single "
                          "value")
 
-    m = pvals_arr.shape[0]
+    m = counts.sum()
     n = lmb_arr.shape[0]
     lmb_arr = np.sort(lmb_arr)
 
-    if (pvals_arr.min() < 0) or (pvals_arr.max() > 1):
+    if (values[0] < 0) or (values[-1] > 1):
         raise ValueError("p-values ('pvals') are not in valid range [0, 1]")
     
     if (n > 1) and (n <4):
@@ -52,23 +216,26 @@ def pi0est(pvals, lmb=np.arange(0.05, 1, 0.05), method="smoother"):
         raise ValueError("lambdas ('lmb') are not in valid range [0, 1)")
 
     if n == 1:
-        pi0 = np.mean(pvals_arr >= lmb[0]) / (1 - lmb[0])
+        pi0 = _count_above(values, counts, lmb_arr[0], inclusive=True) / m / \
+            (1 - lmb_arr[0])
         pi0_lambda = pi0
         pi0 = min(pi0, 1)
         pi0_smooth = None
     else:
-        pi0 = np.asarray([np.mean(pvals_arr > l) / (1 - l) for l in lmb])
+        w = _count_above(values, counts, lmb_arr)
+        pi0 = w / m / (1 - lmb_arr)
         pi0_lambda = pi0
 
         if method == "smoother":
-            spl = scipy.interpolate.LSQUnivariateSpline(lmb, pi0, t=[], k=2)
-            pi0_smooth = spl(lmb)
+            spl = scipy.interpolate.LSQUnivariateSpline(lmb_arr, pi0, t=[],
+                                                        k=2)
+            pi0_smooth = spl(lmb_arr)
             pi0 = min(pi0_smooth[-1], 1)
 
         elif method == "bootstrap":
             pi0_min = np.percentile(pi0, 10)
-            w = np.asarray([np.sum(pvals_arr > l) for l in lmb])
-            mse = (w / (m**2 * (1 - lmb)**2)) * (1 - w/m) + (pi0 - pi0_min)**2
+            mse = (w / (m**2 * (1 - lmb_arr)**2)) * (1 - w/m) + \
+                (pi0 - pi0_min)**2
             pi0 = min(pi0[np.where(mse == np.min(mse))[0][0]], 1)
             pi0_smooth = None
 
@@ -82,33 +249,120 @@ def pi0est(pvals, lmb=np.arange(0.05, 1, 0.05), method="smoother"):
     return pi0, pi0_lambda, lmb_arr, pi0_smooth
 
 
-def qvalue(pvals, pfdr=False, **kwargs):
-    pvals_arr = np.asarray(pvals, dtype=np.float)
+def pi0est(pvals, lmb=np.arange(0.05, 1, 0.05), method="smoother"):
+    pvals_arr = np.asarray(pvals, dtype=np.float64)
 
     if pvals_arr.ndim != 1:
         raise ValueError("p must be an 1d array_like object")
 
-    pi0, pi0_lmb, lmb, pi0_smooth = pi0est(pvals_arr, **kwargs)
+    values, counts = pval_counts(pvals_arr)
+
+    return pi0est_counts(values, counts, lmb=lmb, method=method)
+
+
+def qvalue_counts(values, counts, pfdr=False, **kwargs):
+    """qvalue() on the unique p-values and their counts (see pval_counts()).
+    Return the q-values of the unique p-values.
+    """
 
-    m = pvals_arr.shape[0]
-    u = np.argsort(pvals_arr)
-    v = scipy.stats.rankdata(pvals_arr, method='max')
+    pi0, pi0_lmb, lmb, pi0_smooth = pi0est_counts(values, counts, **kwargs)
+
+    m = counts.sum()
+    v = np.cumsum(counts) # rank of the last occurrence of each value
 
     if pfdr:
         with np.errstate(invalid='ignore', divide='ignore'):
-            qvals = (pi0 * m * pvals_arr) / (v * (1 - (1 - pvals_arr)**m))
+            qvals = (pi0 * m * values) / (v * (1 - (1 - values)**m))
     else:
-        qvals = (pi0 * m * pvals_arr) / v
-    
-    qvals[u[m-1]] = min(qvals[u[m-1]], 1)
-    for i in range(m-2, -1, -1):
-        qvals[u[i]] = min(qvals[u[i]], qvals[u[i+1]])
+        qvals = (pi0 * m * values) / v
+
+    qvals[-1] = min(qvals[-1], 1)
+    qvals = np.minimum.accumulate(qvals[::-1])[::-1]
 
     return qvals, pi0, pi0_lmb, lmb, pi0_smooth
 
 
+def qvalue(pvals, pfdr=False, **kwargs):
+    pvals_arr = np.asarray(pvals, dtype=np.float64)
+
+    if pvals_arr.ndim != 1:
+        raise ValueError("p must be an 1d array_like object")
+
+    values, inverse, counts = np.unique(pvals_arr, return_inverse=True,
+                                        return_counts=True)
+    qvals, pi0, pi0_lmb, lmb, pi0_smooth = qvalue_counts(
+        values, counts, pfdr=pfdr, **kwargs)
+
+    return qvals[inverse.ravel()], pi0, pi0_lmb, lmb, pi0_smooth
+
+
+def _fdr_bh_counts(values, counts):
+    m = counts.sum()
+    last = np.cumsum(counts)
+
+    return np.minimum.accumulate((values / (last / m))[::-1])[::-1]
+
+
+def multipletests_counts(values, counts, method='hs', alpha=0.05):
+    """Same as multipletests(), on the unique p-values and their counts (see
+    pval_counts()). Return the adjusted values of the unique p-values. The
+    methods without a closed form on counts (e.g. hommel) are delegated to
+    statsmodels on the expanded p-values, so their memory usage is
+    proportional to the number of p-values (counts.sum()).
+    """
+
+    m = counts.sum()
+    last = np.cumsum(counts) # rank of the last occurrence of each value
+    first = last - counts + 1 # rank of the first occurrence
+    method_name = [name for name, aliases in STEPDOWN_METHODS.items()
+                   if method.lower() in aliases]
+    method_name = method_name[0] if method_name else None
+
+    if method_name == "bonferroni":
+        pvals_adj = values * m
+    elif method_name == "sidak":
+        pvals_adj = -np.expm1(m * np.log1p(-values))
+    elif method_name == "holm-sidak":
+        pvals_adj = np.maximum.accumulate(
+            -np.expm1((m - first + 1) * np.log1p(-values)))
+    elif method_name == "holm":
+        pvals_adj = np.maximum.accumulate(values * (m - first + 1))
+    elif method_name == "simes-hochberg":
+        pvals_adj = np.minimum.accumulate(
+            ((m - last + 1) * values)[::-1])[::-1]
+    elif method_name == "fdr_bh":
+        pvals_adj = _fdr_bh_counts(values, counts)
+    elif method_name == "fdr_by":
+        cm = np.sum(1. / np.arange(1, m+1))
+        pvals_adj = np.minimum.accumulate(
+            (values / (last / m / cm))[::-1])[::-1]
+    elif method_name in ["fdr_tsbky", "fdr_tsbh"]:
+        # two-stage procedure with a single iteration, see
+        # statsmodels.stats.multitest.fdrcorrection_twostage()
+        fact = (1. + alpha) if method_name == "fdr_tsbky" else 1.
+        alpha_prime = alpha / fact
+        pvals_adj = _fdr_bh_counts(values, counts)
+        rejected = last[values <= last * alpha_prime / m]
+        r1 = rejected.max() if rejected.shape[0] else 0
+        if r1 in (0, m):
+            pvals_adj = pvals_adj * fact
+        else:
+            pvals_adj = pvals_adj * (m - r1) / m * fact
+    else:
+        pvals_exp = np.repeat(values, counts)
+        _, pvals_adj_exp, _, _ = statsmodels.stats.multitest.multipletests(
+            pvals_exp, alpha=alpha, method=method, is_sorted=True)
+        # the most conservative value within each group of ties
+        pvals_adj = np.maximum.reduceat(pvals_adj_exp, first - 1) \
+            if m > 0 else pvals_adj_exp
+
+    return np.minimum(pvals_adj, 1)
+
+
 def multipletests(pvals, method='hs'):
-    _, pvals_adj, _, _ = statsmodels.stats.multitest.multipletests(
-        pvals, method=method)
+    pvals_arr = np.asarray(pvals, dtype=np.float64)
+    values, inverse, counts = np.unique(pvals_arr, return_inverse=True,
+                                        return_counts=True)
+    pvals_adj = multipletests_counts(values, counts, method=method)
 
-    return pvals_adj
\ No newline at end of file
+    return pvals_adj[inverse.ravel()]
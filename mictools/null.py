@@ -17,50 +17,223 @@
 
 
 import sys
+import os
+import os.path
+import glob
+import json
+import pickle
+import hashlib
+import multiprocessing
 
 import numpy as np
 import pandas as pd
+import scipy.stats
 
 import minepy
 import mictools.utils
-from mictools import NULL_HIST_RES
+import mictools.metrics
+from mictools import NULL_HIST_RES, NULL_FINE_RES
 
 
-def compute_null_oneclass(X, Y=None, rowwise=False, B=9, c=5, nperm=250000, seed=0):
+NULL_BINARY_FORMAT = "mictools-null"
+NULL_BINARY_VERSION = 1
+NULL_BINARY_EXT = ".npz"
 
-    mictools.utils.check_data(X, Y=Y)
 
-    bins = np.linspace(0, 1, NULL_HIST_RES+1)
-    hist = np.zeros(NULL_HIST_RES, dtype=np.int64)
-    rs = np.random.RandomState(seed)
-    mine = minepy.MINE(alpha=B, c=c, est="mic_e")
+def _null_tic(Xa, Ya=None, rowwise=False, B=9, c=5, nperm=250000, rs=None,
+              batch=1, cls=None):
+    """Sample nperm TICe values under the null hypothesis. With batch > 1,
+    each permuted variable is scored against a block of (at most) batch
+    variables in a single minepy.cstats() call. The permutations are
+    reported to mictools.metrics as permutations of the class cls.
+    """
 
-    Xa = X.values
-    if Y is None:
+    if (Ya is None) and (Xa.shape[0] < 2):
+        raise ValueError("at least 2 variables are required to compute the "
+                         "null distribution of all the pairs")
+
+    tic = np.empty(nperm, dtype=np.float64)
+
+    if Ya is None:
         idx = np.arange(Xa.shape[0])
-        Ya, max_idx_rowwise = None, None
+        max_idx_rowwise = None
     else:
-        Ya = Y.values
         if rowwise:
             max_idx_rowwise = min(Xa.shape[0], Ya.shape[0])
             idx = None
 
-    for n in range(nperm):
-        if Y is None:
-            i, j = rs.choice(idx, size=2, replace=False)
-            x, y = Xa[i], rs.permutation(Xa[j])     
+    if batch == 1:
+        mine = minepy.MINE(alpha=B, c=c, est="mic_e")
+        for n in range(nperm):
+            if Ya is None:
+                i, j = rs.choice(idx, size=2, replace=False)
+                x, y = Xa[i], rs.permutation(Xa[j])     
+            else:
+                if rowwise:
+                    i = j = rs.randint(max_idx_rowwise)
+                else:
+                    i, j = rs.randint(Xa.shape[0]), rs.randint(Ya.shape[0])
+
+                x, y = Xa[i], rs.permutation(Ya[j])
+
+            mine.compute_score(x, y)
+            tic[n] = mine.tic(norm=True)
+            mictools.metrics.tick("permutations", 1, cls)
+
+        return tic
+
+    n = 0
+    while n < nperm:
+        if Ya is None:
+            # the permuted variable j is paired with distinct i != j
+            size = min(batch, nperm-n, Xa.shape[0]-1)
+            j = rs.randint(Xa.shape[0])
+            i = rs.choice(Xa.shape[0]-1, size=size, replace=False)
+            i[i >= j] += 1
+            y = rs.permutation(Xa[j])
+            _, tic_b = minepy.cstats(Xa[i], y[np.newaxis], alpha=B, c=c,
+                                     est="mic_e")
         else:
+            size = min(batch, nperm-n)
             if rowwise:
-                i = j = rs.randint(max_idx_rowwise)
+                # pairs (i, i) only, each Y_i is permuted independently
+                i = rs.randint(max_idx_rowwise, size=size)
+                y = np.asarray([rs.permutation(Ya[k]) for k in i])
+                _, tic_b = mictools.utils.sstats(Xa[i], y, alpha=B, c=c,
+                                                 est="mic_e")
             else:
-                i, j = rs.randint(Xa.shape[0]), rs.randint(Ya.shape[0])
+                j = rs.randint(Ya.shape[0])
+                i = rs.randint(Xa.shape[0], size=size)
+                y = rs.permutation(Ya[j])
+                _, tic_b = minepy.cstats(Xa[i], y[np.newaxis], alpha=B, c=c,
+                                         est="mic_e")
+
+        tic[n:n+size] = np.ravel(tic_b)
+        n += size
+        mictools.metrics.tick("permutations", size, cls)
+
+    return tic
+
+
+def _null_bincount(tic):
+    """Bin the TICe values into the NULL_HIST_RES bins of [0, 1].
+    """
+
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    hist_idx = np.minimum(np.searchsorted(bins, tic, side='right') - 1,
+                          NULL_HIST_RES-1)
+
+    return np.bincount(hist_idx, minlength=NULL_HIST_RES).astype(np.int64)
+
+
+def _null_fine_bincount(tic):
+    """Bin the TICe values into the NULL_FINE_RES bins of [0, 1]. Return the
+    indices of the non-zero bins (sorted) and their counts.
+    """
+
+    idx = np.clip((np.asarray(tic) * NULL_FINE_RES).astype(np.int64), 0,
+                  NULL_FINE_RES-1)
+    idx, counts = np.unique(idx, return_counts=True)
+
+    return idx, counts.astype(np.int64)
+
+
+def _null_fine_add(fine_hists):
+    """Sum sparse histograms (bin indices, counts).
+    """
+
+    idx = np.concatenate([fine_hist[0] for fine_hist in fine_hists])
+    counts = np.concatenate([fine_hist[1] for fine_hist in fine_hists])
+    idx, inverse = np.unique(idx, return_inverse=True)
+    counts_sum = np.zeros(idx.shape[0], dtype=np.int64)
+    np.add.at(counts_sum, inverse, counts)
+
+    return idx, counts_sum
+
+
+def _null_fine_empty():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+def _null_hist(Xa, Ya=None, rowwise=False, B=9, c=5, nperm=250000, rs=None,
+               batch=1, fine=False, cls=None):
+    tic = _null_tic(Xa, Ya, rowwise=rowwise, B=B, c=c, nperm=nperm, rs=rs,
+                    batch=batch, cls=cls)
+
+    return _null_fine_bincount(tic) if fine else _null_bincount(tic)
 
-            x, y = Xa[i], rs.permutation(Ya[j])
 
-        mine.compute_score(x, y)
-        tic = mine.tic(norm=True)
-        hist_idx = min(np.digitize([tic], bins)[0]-1, NULL_HIST_RES-1)
-        hist[hist_idx] += 1
+_worker_data = {}
+
+
+def _null_worker_init(Xa_cls, Ya_cls, names=None):
+    _worker_data["Xa_cls"], _worker_data["Ya_cls"] = Xa_cls, Ya_cls
+    _worker_data["names"] = [None] * len(Xa_cls) if names is None else names
+
+
+def _null_hist_worker(args):
+    l, rowwise, B, c, nperm, batch, fine, rs_state = args
+    rs = np.random.RandomState()
+    rs.set_state(rs_state)
+    hist = _null_hist(_worker_data["Xa_cls"][l], _worker_data["Ya_cls"][l],
+                      rowwise=rowwise, B=B, c=c, nperm=nperm, rs=rs,
+                      batch=batch, fine=fine, cls=_worker_data["names"][l])
+
+    return hist, rs.get_state()
+
+
+def _null_class_worker(task):
+    l, w, args = task
+    hist, _ = _null_hist_worker(args)
+
+    return l, w, hist
+
+
+def _split_nperm(nperm, jobs):
+    """Split nperm permutations into jobs (almost) equal parts.
+    """
+
+    return [nperm // jobs + (1 if i < nperm % jobs else 0)
+            for i in range(jobs)]
+
+
+def _shard_nperm(nperm, shard=None):
+    """Return the number of permutations of the shard k/N (shard=(k, N)),
+    nperm if shard is None.
+    """
+
+    if shard is None:
+        return nperm
+
+    k, nshards = shard
+    if not (1 <= k <= nshards):
+        raise ValueError("shard must be k/N with 1 <= k <= N")
+
+    return _split_nperm(nperm, nshards)[k-1]
+
+
+def _null_random_states(seed, jobs=1, shard=None):
+    """Return the initial random states, one per worker. Each shard k/N
+    and each worker get an independent stream spawned from seed. The
+    legacy RandomState(seed) stream is used with a single job and no
+    shards.
+    """
+
+    if (jobs == 1) and (shard is None):
+        return [np.random.RandomState(seed).get_state()]
+
+    seed_seq = np.random.SeedSequence(seed)
+    if shard is not None:
+        k, nshards = shard
+        seed_seq = seed_seq.spawn(nshards)[k-1]
+    seed_seqs = [seed_seq] if jobs == 1 else seed_seq.spawn(jobs)
+
+    return [np.random.RandomState(np.random.MT19937(s)).get_state()
+            for s in seed_seqs]
+
+
+def _null_hist_df(hist):
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
 
     # right-tailed area
     hist_cum = np.cumsum(hist[::-1])[::-1]
@@ -75,8 +248,401 @@ def compute_null_oneclass(X, Y=None, rowwise=False, B=9, c=5, nperm=250000, seed
     return hist_df
 
 
+def _null_bins_df(lo, hi, count):
+    """Build a null distribution with the (sparse, variable) bins
+    [lo, hi) / NULL_FINE_RES.
+    """
+
+    count = np.asarray(count, dtype=np.int64)
+
+    # right-tailed area
+    count_cum = np.cumsum(count[::-1])[::-1]
+
+    index = pd.MultiIndex.from_arrays([np.asarray(lo) / NULL_FINE_RES,
+                                       np.asarray(hi) / NULL_FINE_RES],
+                                      names=('BinStart', 'BinEnd'))
+
+    return pd.DataFrame({"NullCount": count, "NullCountCum": count_cum},
+                        index=index, columns=["NullCount", "NullCountCum"])
+
+
+def _null_fine_df(idx, counts, q=0.99):
+    """Build an adaptive resolution null distribution from a sparse
+    NULL_FINE_RES histogram. The fine bins are kept above the NULL_HIST_RES
+    bin where the right-tailed area falls below 1-q, and are summed into the
+    NULL_HIST_RES bins elsewhere. Only the non-zero bins are returned.
+    """
+
+    ratio = NULL_FINE_RES // NULL_HIST_RES
+    coarse = np.zeros(NULL_HIST_RES, dtype=np.int64)
+    np.add.at(coarse, idx // ratio, counts)
+    coarse_cum = np.cumsum(coarse[::-1])[::-1]
+    k = np.argmax(coarse_cum <= (1 - q) * coarse_cum[0])
+
+    body = np.flatnonzero(coarse[:k])
+    in_tail = idx >= k * ratio
+    lo = np.concatenate((body * ratio, idx[in_tail]))
+    hi = np.concatenate(((body + 1) * ratio, idx[in_tail] + 1))
+    count = np.concatenate((coarse[body], counts[in_tail]))
+
+    return _null_bins_df(lo, hi, count)
+
+
+def compute_null_oneclass(X, Y=None, rowwise=False, B=9, c=5, nperm=250000,
+                          seed=0, jobs=1, batch=1, shard=None, state=None,
+                          save_state=None, checkpoint_every=None, fine=False,
+                          cls=None):
+    """Compute the TICe null distribution of a single class.
+
+    If fine is True, the null distribution has adaptive resolution (see
+    _null_fine_df()): sparse NULL_HIST_RES bins, and NULL_FINE_RES bins in
+    the upper tail. cls is the class name, used to report the progress
+    (see mictools.metrics).
+
+    With shard=(k, N), only the k-th of N independent portions of the nperm
+    permutations is computed. The permutations are run in rounds of
+    checkpoint_every permutations; after each round save_state (if
+    provided) is called with the current state (per-worker histograms,
+    permutations done and random states), which can be passed back as
+    state to resume the computation.
+    """
+
+    mictools.utils.check_data(X, Y=Y)
+
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
+
+    if batch < 1:
+        raise ValueError("the batch size must be >=1")
+
+    nperm = _shard_nperm(nperm, shard)
+
+    Xa = np.ascontiguousarray(X.values, dtype=np.float64)
+    Ya = None if Y is None else \
+        np.ascontiguousarray(Y.values, dtype=np.float64)
+
+    if state is None:
+        hist = [_null_fine_empty() for _ in range(jobs)] if fine else \
+            np.zeros((jobs, NULL_HIST_RES), dtype=np.int64)
+        state = {"hist": hist,
+                 "done": np.zeros(jobs, dtype=np.int64),
+                 "rs_state": _null_random_states(seed, jobs, shard)}
+    nperm_w = np.asarray(_split_nperm(nperm, jobs), dtype=np.int64)
+
+    # rounds are multiples of the (effective) batch size, so that the random
+    # streams do not depend on checkpoint_every
+    if checkpoint_every is None:
+        nperm_round = nperm_w.max()
+    else:
+        eff_batch = batch if Ya is not None else \
+            max(min(batch, Xa.shape[0]-1), 1)
+        nperm_round = -(-checkpoint_every // jobs)
+        nperm_round = -(-nperm_round // eff_batch) * eff_batch
+
+    pool = None if jobs == 1 else \
+        multiprocessing.Pool(jobs, _null_worker_init, ([Xa], [Ya], [cls]))
+    try:
+        while (state["done"] < nperm_w).any():
+            args = [(0, rowwise, B, c, min(nperm_round, n - d), batch, fine,
+                     rs)
+                    for n, d, rs in zip(nperm_w, state["done"],
+                                        state["rs_state"])]
+            if pool is None:
+                _null_worker_init([Xa], [Ya], [cls])
+                res = [_null_hist_worker(args[0])]
+            else:
+                res = pool.map(_null_hist_worker, args)
+
+            for w, (hist_w, rs_state_w) in enumerate(res):
+                if fine:
+                    state["hist"][w] = _null_fine_add([state["hist"][w],
+                                                       hist_w])
+                else:
+                    state["hist"][w] += hist_w
+                state["done"][w] += args[w][4]
+                state["rs_state"][w] = rs_state_w
+                if pool is not None:
+                    mictools.metrics.tick("permutations", args[w][4], cls)
+
+            if save_state is not None:
+                save_state(state)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _worker_data.clear()
+
+    if fine:
+        return _null_fine_df(*_null_fine_add(state["hist"]))
+
+    # the histograms are summed in worker order, so the result depends on
+    # (seed, jobs, shard) only
+    hist = state["hist"].sum(axis=0)
+
+    return _null_hist_df(hist)
+
+
+def _null_hist_classes(Xa_cls, Ya_cls, todo, rowwise=False, B=9, c=5,
+                       nperm=250000, seed=0, jobs=1, batch=1, shard=None,
+                       fine=False, names=None, streams=None):
+    """Compute the null histograms of the classes todo (positions into
+    Xa_cls/Ya_cls). The (class, stream) tasks of all the classes share a
+    single process pool and the classes with more samples are submitted
+    first. The permutations of each class are split into streams random
+    streams (by default one per job, as in compute_null_oneclass()), so
+    the results do not depend on the scheduling. Return a dictionary
+    class position -> histogram (sparse histogram if fine is True, see
+    _null_fine_bincount()). names are the class names, used to report the
+    progress (see mictools.metrics).
+    """
+
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
+
+    if batch < 1:
+        raise ValueError("the batch size must be >=1")
+
+    nperm = _shard_nperm(nperm, shard)
+
+    if streams is None:
+        streams = jobs
+    nperm_w = _split_nperm(nperm, streams)
+    rs_states = _null_random_states(seed, streams, shard)
+    sizes = {l: Xa_cls[l].shape[1] for l in todo}
+    order = sorted(todo, key=lambda l: -sizes[l])
+    tasks = [(l, w, (l, rowwise, B, c, nperm_w[w], batch, fine,
+                     rs_states[w])) for l in order for w in range(streams)]
+
+    hist = {l: [None] * streams for l in todo}
+    if jobs == 1:
+        pool = None
+        _null_worker_init(Xa_cls, Ya_cls, names)
+        results = map(_null_class_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, _null_worker_init,
+                                    (Xa_cls, Ya_cls, names))
+        results = pool.imap_unordered(_null_class_worker, tasks)
+
+    try:
+        for l, w, hist_w in results:
+            hist[l][w] = hist_w
+            if pool is not None:
+                mictools.metrics.tick("permutations", nperm_w[w],
+                                      None if names is None else names[l])
+    finally:
+        if pool is None:
+            _worker_data.clear()
+        else:
+            pool.terminate()
+
+    if fine:
+        return {l: _null_fine_add(hist[l]) for l in todo}
+
+    # the histograms are summed in worker order, as in
+    # compute_null_oneclass()
+    return {l: np.sum(hist[l], axis=0) for l in todo}
+
+
 def compute_null(X, labels=None, Y=None, rowwise=False, B=9, c=5, nperm=250000,
-                 seed=0):
+                 seed=0, jobs=1, batch=1, shard=None, checkpoint_fn=None,
+                 checkpoint_every=10000, cache_dir=None, fine=False,
+                 streams=None, class_data=None):
+    """Compute the TICe null distribution for each class. If fine is True,
+    the null distributions have adaptive resolution (see
+    compute_null_oneclass()). If checkpoint_fn
+    is provided, the partial state is periodically flushed to that file and
+    a computation interrupted is resumed from it. If cache_dir is provided,
+    the null distributions are looked up in (and added to) the null cache
+    (see null_cache_key()), so that classes with the same key share a single
+    computation. If streams is provided, the permutations of each class are
+    split into streams random streams regardless of jobs, so that the
+    result does not depend on the number of jobs (without checkpoints
+    only). class_data can be precomputed with mictools.utils.class_data().
+    """
+
+    mictools.utils.check_data(X, labels=labels, Y=Y)
+
+    if (cache_dir is not None) and (shard is not None):
+        raise ValueError("the null cache cannot be used with shards")
+
+    if (checkpoint_fn is not None) and (streams is not None):
+        raise ValueError("the number of random streams cannot be set with "
+                         "checkpoints")
+
+    if labels is None:
+        labels = pd.Series('None', index=X.columns)
+
+    # class columns and per-class (zero-copy) data, computed once
+    if class_data is None:
+        class_data = mictools.utils.class_data(X, labels=labels, Y=Y)
+    clss, columns, Xa_cls, Ya_cls = class_data
+
+    if checkpoint_fn is None:
+        checkpoint, checkpoint_every = None, None
+    else:
+        params = {"B": B, "c": c, "nperm": nperm, "seed": seed, "jobs": jobs,
+                  "batch": batch, "shard": shard, "rowwise": rowwise,
+                  "classes": clss, "shape": (X.shape, None if Y is None \
+                                             else Y.shape)}
+        if fine:
+            params["fine"] = True
+        checkpoint = read_checkpoint(checkpoint_fn, params)
+
+    # classes with the same cache key share a single computation
+    keys = [None] * len(clss)
+    null_dist_cls = [None] * len(clss)
+    if cache_dir is not None:
+        null_dist_cache = {}
+        for l in range(len(clss)):
+            keys[l] = null_cache_key(Xa_cls[l], Ya_cls[l], rowwise=rowwise,
+                                     B=B, c=c) + ("_fine" if fine else "")
+            if keys[l] not in null_dist_cache:
+                null_dist_cache[keys[l]] = read_cached_null(cache_dir,
+                                                            keys[l], nperm)
+            null_dist_cls[l] = null_dist_cache[keys[l]]
+
+    todo, todo_keys = [], set()
+    for l in range(len(clss)):
+        if (null_dist_cls[l] is None) and \
+           ((keys[l] is None) or (keys[l] not in todo_keys)):
+            todo.append(l)
+            todo_keys.add(keys[l])
+
+    nperm_cl = _shard_nperm(nperm, shard)
+    mictools.metrics.set_total("permutations", nperm_cl * len(todo))
+
+    if checkpoint is None:
+        # all the classes are computed concurrently
+        hist_cls = _null_hist_classes(Xa_cls, Ya_cls, todo, rowwise=rowwise,
+                                      B=B, c=c, nperm=nperm, seed=seed,
+                                      jobs=jobs, batch=batch, shard=shard,
+                                      fine=fine, names=clss, streams=streams)
+        computed = {l: _null_fine_df(*hist_cls[l]) if fine else \
+                    _null_hist_df(hist_cls[l]) for l in todo}
+    else:
+        computed = {}
+        for l in todo:
+            cl = clss[l]
+            X_cl = pd.DataFrame(Xa_cls[l], index=X.index,
+                                columns=X.columns[columns[l]], copy=False)
+            Y_cl = None if Y is None else \
+                pd.DataFrame(Ya_cls[l], index=Y.index,
+                             columns=Y.columns[columns[l]], copy=False)
+            state = checkpoint["states"].get(cl)
+
+            def save_state(state_cl, cl=cl):
+                checkpoint["states"][cl] = state_cl
+                write_checkpoint(checkpoint, checkpoint_fn)
+
+            computed[l] = compute_null_oneclass(
+                X_cl, Y_cl, rowwise=rowwise, B=B, c=c, nperm=nperm, seed=seed,
+                jobs=jobs, batch=batch, shard=shard, state=state,
+                save_state=save_state, checkpoint_every=checkpoint_every,
+                fine=fine, cls=cl)
+
+    if cache_dir is not None:
+        for l in todo:
+            write_cached_null(computed[l], cache_dir, keys[l], nperm,
+                              meta={"B": B, "c": c, "seed": seed})
+
+    for m in range(len(clss)):
+        if null_dist_cls[m] is None:
+            # computed, or sharing the cache key of a computed class
+            l = m if m in computed else \
+                [l for l in todo if keys[l] == keys[m]][0]
+            null_dist_cls[m] = computed[l]
+
+    null_dist = pd.concat(null_dist_cls, axis=0, keys=clss, names=["Class"])
+
+    return null_dist
+
+
+def tie_profile(x):
+    """Return the tie profile of a variable, i.e. the number of zeros and
+    the sorted sizes of the other groups of tied values.
+    """
+
+    x = np.asarray(x)
+    _, counts = np.unique(x[x != 0], return_counts=True)
+
+    return "{:d}:{}".format(np.sum(x == 0),
+                            ",".join(str(n) for n in sorted(counts[counts>1])))
+
+
+def null_cache_key(X, Y=None, rowwise=False, B=9, c=5):
+    """Return the null cache key of a (single class) dataset. Under
+    permutation the TICe null depends on the number of samples, the TICe
+    parameters, the pairing mode and the tie/zero profiles of the variables,
+    summarized by a fingerprint.
+    """
+
+    Xa = np.asarray(X)
+    if Y is None:
+        mode, profiles = "pairs", sorted(tie_profile(x) for x in Xa)
+    else:
+        Ya = np.asarray(Y)
+        if rowwise:
+            mode = "rowwise"
+            profiles = sorted("{}|{}".format(tie_profile(x), tie_profile(y))
+                              for x, y in zip(Xa, Ya))
+        else:
+            mode = "cross"
+            profiles = sorted(tie_profile(x) for x in Xa) + ["|"] + \
+                sorted(tie_profile(y) for y in Ya)
+
+    fingerprint = hashlib.sha1(";".join(profiles).encode()).hexdigest()
+
+    return "n{:d}_B{}_c{}_{}_{}".format(Xa.shape[1], B, c, mode,
+                                        fingerprint[:16])
+
+
+def _cached_null_fns(cache_dir, key):
+    fns = glob.glob(os.path.join(cache_dir, key + "_p*.txt"))
+    nperms = [os.path.basename(fn)[len(key)+2:-4] for fn in fns]
+
+    # skip the parameters files (see meta_filename())
+    return {int(nperm): fn for nperm, fn in zip(nperms, fns)
+            if nperm.isdigit()}
+
+
+def read_cached_null(cache_dir, key, nperm=None):
+    """Read a (single class) null distribution from the null cache. If nperm
+    is None, the entry with the largest number of permutations is returned.
+    Return None if no entry is found.
+    """
+
+    fns = _cached_null_fns(cache_dir, key)
+
+    if nperm is None:
+        if not fns:
+            return None
+        nperm = max(fns)
+    elif nperm not in fns:
+        return None
+
+    null_dist, _ = read_null(fns[nperm])
+
+    return null_dist.loc[key]
+
+
+def write_cached_null(null_dist, cache_dir, key, nperm, meta=None):
+    """Add a (single class) null distribution to the null cache.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    null_fn = os.path.join(cache_dir, "{}_p{:d}.txt".format(key, nperm))
+    tmp_fn = null_fn + ".tmp{:d}".format(os.getpid())
+    write_null(pd.concat([null_dist], keys=[key], names=["Class"]), tmp_fn,
+               meta)
+    if meta is not None:
+        os.replace(meta_filename(tmp_fn), meta_filename(null_fn))
+    os.replace(tmp_fn, null_fn)
+
+
+def cached_null(cache_dir, X, labels=None, Y=None, rowwise=False, B=9, c=5):
+    """Build the null distribution of each class from the null cache, using
+    the entries with the largest number of permutations.
+    """
 
     mictools.utils.check_data(X, labels=labels, Y=Y)
 
@@ -87,16 +653,12 @@ def compute_null(X, labels=None, Y=None, rowwise=False, B=9, c=5, nperm=250000,
     null_dist_list = []
     for cl in clss:
         keep = (cl == labels)
-        X_cl = X.loc[:, keep]
-        
-        if Y is None:
-            Y_cl = None
-        else:
-            Y_cl = Y.loc[:, keep]
-            
-        null_dist_cl = compute_null_oneclass(
-            X_cl, Y_cl, rowwise=rowwise, B=B, c=c, nperm=nperm, seed=seed)
-
+        Y_cl = None if Y is None else Y.loc[:, keep]
+        key = null_cache_key(X.loc[:, keep], Y_cl, rowwise=rowwise, B=B, c=c)
+        null_dist_cl = read_cached_null(cache_dir, key)
+        if null_dist_cl is None:
+            raise ValueError("no null distribution for class {} ({}) in the "
+                             "cache {}".format(cl, key, cache_dir))
         null_dist_list.append(null_dist_cl)
 
     null_dist = pd.concat(null_dist_list, axis=0, keys=clss, names=["Class"])
@@ -104,8 +666,246 @@ def compute_null(X, labels=None, Y=None, rowwise=False, B=9, c=5, nperm=250000,
     return null_dist
 
 
+def read_checkpoint(checkpoint_fn, params):
+    """Read a null checkpoint file. Return a new (empty) checkpoint if the
+    file does not exist.
+    """
+
+    if not os.path.isfile(checkpoint_fn):
+        return {"params": params, "states": {}}
+
+    with open(checkpoint_fn, 'rb') as checkpoint_handle:
+        checkpoint = pickle.load(checkpoint_handle)
+
+    if checkpoint["params"] != params:
+        raise ValueError("checkpoint {} was created with different "
+                         "parameters".format(checkpoint_fn))
+
+    return checkpoint
+
+
+def write_checkpoint(checkpoint, checkpoint_fn):
+    """Write a null checkpoint file atomically.
+    """
+
+    tmp_fn = checkpoint_fn + ".tmp"
+    with open(tmp_fn, 'wb') as checkpoint_handle:
+        pickle.dump(checkpoint, checkpoint_handle)
+    os.replace(tmp_fn, checkpoint_fn)
+
+
+def null_int_bins(null_dist):
+    """Return the bins of a (single class) null distribution as integer
+    ranges [lo, hi) of NULL_FINE_RES bins, and their counts.
+    """
+
+    lo = np.rint(null_dist.index.get_level_values("BinStart").values * \
+                 NULL_FINE_RES).astype(np.int64)
+    hi = np.rint(null_dist.index.get_level_values("BinEnd").values * \
+                 NULL_FINE_RES).astype(np.int64)
+
+    return lo, hi, null_dist["NullCount"].values.astype(np.int64)
+
+
+def _write_null_binary(null_dist, output_fn, meta=None):
+    clss = list(null_dist.index.get_level_values("Class").unique())
+    lo, hi, count, ptr = [], [], [], [0]
+    for cl in clss:
+        lo_cl, hi_cl, count_cl = null_int_bins(null_dist.loc[cl])
+        nonzero = count_cl > 0
+        lo.append(lo_cl[nonzero])
+        hi.append(hi_cl[nonzero])
+        count.append(count_cl[nonzero])
+        ptr.append(ptr[-1] + np.sum(nonzero))
+
+    meta = {} if meta is None else {key: str(meta[key]) for key in meta}
+    with open(output_fn, 'wb') as output_handle:
+        np.savez_compressed(output_handle,
+                            format=np.array(NULL_BINARY_FORMAT),
+                            version=np.array(NULL_BINARY_VERSION),
+                            meta=np.array(json.dumps(meta, sort_keys=True)),
+                            classes=np.array(clss, dtype=str),
+                            fine_res=np.array(NULL_FINE_RES),
+                            ptr=np.array(ptr, dtype=np.int64),
+                            lo=np.concatenate(lo).astype(np.int32),
+                            hi=np.concatenate(hi).astype(np.int32),
+                            count=np.concatenate(count))
+
+
+def _read_null_binary(null_fn):
+    with np.load(null_fn, allow_pickle=False) as data:
+        if str(data["format"]) != NULL_BINARY_FORMAT:
+            raise ValueError("{} is not a binary null distribution".\
+                             format(null_fn))
+        if int(data["version"]) > NULL_BINARY_VERSION:
+            raise ValueError("unsupported binary null distribution version "
+                             "{}".format(int(data["version"])))
+        if int(data["fine_res"]) != NULL_FINE_RES:
+            raise ValueError("unsupported binary null distribution "
+                             "resolution {}".format(int(data["fine_res"])))
+
+        meta = json.loads(str(data["meta"]))
+        clss = [str(cl) for cl in data["classes"]]
+        ptr, lo, hi, count = data["ptr"], data["lo"], data["hi"], \
+            data["count"]
+
+    null_dist = pd.concat([_null_bins_df(lo[a:b], hi[a:b], count[a:b])
+                           for a, b in zip(ptr[:-1], ptr[1:])],
+                          axis=0, keys=clss, names=["Class"])
+
+    return null_dist, meta
+
+
+def write_null(null_dist, output_fn, meta=None):
+    """Write a null distribution. The parameters in meta are stored as
+    key=value lines in a separate file (see meta_filename()), so that the
+    null distribution file keeps its plain tab-delimited format. If
+    output_fn ends with NULL_BINARY_EXT, the null distribution is written
+    in the binary format instead: a compressed .npz file containing only
+    the non-zero bins of each class, as integer ranges of NULL_FINE_RES
+    bins (see null_int_bins()).
+    """
+
+    with mictools.metrics.io("write", output_fn):
+        if output_fn.endswith(NULL_BINARY_EXT):
+            _write_null_binary(null_dist, output_fn, meta)
+            return
+
+        null_dist.to_csv(output_fn, sep='\t', float_format="%.6f")
+        if meta is not None:
+            with open(meta_filename(output_fn), 'w') as meta_handle:
+                for key in sorted(meta):
+                    meta_handle.write("{}={}\n".format(key, meta[key]))
+
+
+def read_null(null_fn):
+    """Read a null distribution (text or binary, see write_null()). Return
+    the null distribution and the parameters stored in the header.
+    """
+
+    with mictools.metrics.io("read", null_fn):
+        if null_fn.endswith(NULL_BINARY_EXT):
+            return _read_null_binary(null_fn)
+
+        return _read_null_text(null_fn)
+
+
+def meta_filename(null_fn):
+    """Return the name of the parameters file associated to a (text) null
+    distribution file.
+    """
+
+    return os.path.splitext(null_fn)[0] + "_meta.txt"
+
+
+def _read_null_text(null_fn):
+    meta = {}
+    meta_fn = meta_filename(null_fn)
+    if os.path.isfile(meta_fn):
+        with open(meta_fn) as meta_handle:
+            for line in meta_handle:
+                if line.strip():
+                    key, value = line.rstrip('\n').split('=', 1)
+                    meta[key] = value
+
+    # '#key=value' header lines, written by previous versions
+    with open(null_fn) as null_handle:
+        for line in null_handle:
+            if not line.startswith('#'):
+                break
+            key, value = line[1:].rstrip('\n').split('=', 1)
+            meta.setdefault(key, value)
+
+    null_dist = pd.read_csv(null_fn, sep='\t', comment='#', dtype={'Class': str},
+                            keep_default_na=False)
+    null_dist.set_index(['Class', 'BinStart', 'BinEnd'], inplace=True)
+
+    return null_dist, meta
+
+
+def fit_tail(null_dist, q=0.99, min_tail=50):
+    """Fit a generalized Pareto distribution (GPD) to the exceedances over
+    the q-quantile of a (single class) null distribution. The exceedances
+    are taken at the bin centers.
+    """
+
+    if not (0 < q < 1):
+        raise ValueError("the tail quantile must be in (0, 1)")
+
+    bin_start = null_dist.index.get_level_values("BinStart").values
+    bin_end = null_dist.index.get_level_values("BinEnd").values
+    count = null_dist["NullCount"].values
+    count_cum = null_dist["NullCountCum"].values
+    ntot = count_cum[0]
+
+    # first bin whose right-tailed area is below 1-q
+    k = np.argmax(count_cum <= (1 - q) * ntot)
+    threshold, ntail = bin_start[k], count_cum[k]
+
+    if ntail < min_tail:
+        raise ValueError("too few null values ({:d}) above the {} quantile, "
+                         "increase the number of permutations".\
+                         format(ntail, q))
+
+    exceed = np.repeat((bin_start[k:] + bin_end[k:]) / 2 - threshold,
+                       count[k:])
+    shape, _, scale = scipy.stats.genpareto.fit(exceed, floc=0)
+
+    return pd.Series([threshold, shape, scale, ntail, ntot],
+                     index=["Threshold", "Shape", "Scale", "NTail", "NTot"])
+
+
+def compute_tail(null_dist, q=0.99):
+    """Fit the GPD tail (see fit_tail()) of each class.
+    """
+
+    clss = null_dist.index.get_level_values("Class").unique()
+    tail = pd.DataFrame([fit_tail(null_dist.loc[cl], q=q) for cl in clss],
+                        index=pd.Index(clss, name="Class"))
+    tail[["NTail", "NTot"]] = tail[["NTail", "NTot"]].astype(np.int64)
+
+    return tail
+
+
+def tail_pval(tic, tail):
+    """Right-tailed p-values of the TICe values above the tail threshold,
+    extrapolated using the GPD fit (see fit_tail()). With a negative shape
+    the GPD has a finite endpoint, so the p-values are floored at the
+    resolution of the permutation test times the exceedance fraction, i.e.
+    tail_prob / (NTot + 1), and are never 0.
+    """
+
+    tail_prob = (tail["NTail"] + 1) / (tail["NTot"] + 1)
+    sf = scipy.stats.genpareto.sf(np.asarray(tic) - tail["Threshold"],
+                                  tail["Shape"], loc=0, scale=tail["Scale"])
+
+    return np.maximum(tail_prob * sf, tail_prob / (tail["NTot"] + 1))
+
+
+def tail_filename(null_fn):
+    """Return the name of the GPD tail file associated to a null
+    distribution file.
+    """
+
+    return os.path.splitext(null_fn)[0] + "_tail.txt"
+
+
+def write_tail(tail, tail_fn):
+    tail.to_csv(tail_fn, sep='\t', float_format="%.6e")
+
+
+def read_tail(tail_fn):
+    tail = pd.read_csv(tail_fn, sep='\t', dtype={'Class': str},
+                       keep_default_na=False)
+    tail.set_index('Class', inplace=True)
+
+    return tail
+
+
 def null_cmd(xvars_fn, output_fn, labels_fn=None, target=None, yvars_fn=None,
-             rowwise=False, nperm=250000, seed=0, grid=9, clumps=5):
+             rowwise=False, nperm=250000, seed=0, grid=9, clumps=5, jobs=1,
+             batch=1, tail=False, tail_quantile=0.99, shard=None,
+             checkpoint_fn=None, checkpoint_every=10000, cache_dir=None):
 
     X, labels, Y = mictools.utils.read_data(xvars_fn, labels_fn, target,
                                             yvars_fn)    
@@ -122,23 +922,145 @@ def null_cmd(xvars_fn, output_fn, labels_fn=None, target=None, yvars_fn=None,
     else:
         sys.stdout.write("* None: {:d}\n".format(X.shape[1]))
 
-    null_dist = compute_null(X=X,
-                             labels=labels, 
-                             Y=Y, 
-                             rowwise=rowwise,
-                             B=grid, 
-                             c=clumps,
-                             nperm=nperm,
-                             seed=seed)
-    
-    null_dist.to_csv(output_fn, sep='\t', float_format="%.6f")
+    if shard is not None:
+        k, nshards = shard
+        sys.stdout.write("Shard {:d}/{:d}: {:d} permutations\n".format(
+            k, nshards, _shard_nperm(nperm, shard)))
+
+    if (checkpoint_fn is not None) and os.path.isfile(checkpoint_fn):
+        sys.stdout.write("Resuming from checkpoint {}\n".format(checkpoint_fn))
+
+    try:
+        null_dist = compute_null(X=X,
+                                 labels=labels, 
+                                 Y=Y, 
+                                 rowwise=rowwise,
+                                 B=grid, 
+                                 c=clumps,
+                                 nperm=nperm,
+                                 seed=seed,
+                                 jobs=jobs,
+                                 batch=batch,
+                                 shard=shard,
+                                 checkpoint_fn=checkpoint_fn,
+                                 checkpoint_every=checkpoint_every,
+                                 cache_dir=cache_dir,
+                                 fine=output_fn.endswith(NULL_BINARY_EXT))
+        tail_df = compute_tail(null_dist, q=tail_quantile) if tail else None
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        exit(1)
+
+    meta = {"B": grid, "c": clumps, "seed": seed, "jobs": jobs,
+            "batch": batch, "rowwise": rowwise}
+    if shard is not None:
+        meta["shard"] = "{:d}/{:d}".format(*shard)
+    write_null(null_dist, output_fn, meta)
+
+    if tail:
+        tail_fn = tail_filename(output_fn)
+        write_tail(tail_df, tail_fn)
+        sys.stdout.write("GPD tail parameters written to {}\n".\
+                         format(tail_fn))
+
+
+def _merge_null_bins(null_dists):
+    """Sum (single class) null distributions with sparse or adaptive bins.
+    The non-zero fine bins falling into a NULL_HIST_RES bin that is non-zero
+    in any of the null distributions are summed into it.
+    """
+
+    ratio = NULL_FINE_RES // NULL_HIST_RES
+    lo, hi, count = [np.concatenate(a) for a in
+                     zip(*[null_int_bins(null_dist)
+                           for null_dist in null_dists])]
+    nonzero = count > 0
+    lo, hi, count = lo[nonzero], hi[nonzero], count[nonzero]
+
+    width = hi - lo
+    is_coarse = (width == ratio) & (lo % ratio == 0)
+    if not np.all(is_coarse | (width == 1)):
+        raise ValueError("null distributions with incompatible bins cannot "
+                         "be merged")
+
+    to_coarse = (width == 1) & np.isin(lo // ratio, lo[is_coarse] // ratio)
+    lo[to_coarse] = lo[to_coarse] // ratio * ratio
+    hi[to_coarse] = lo[to_coarse] + ratio
 
+    lo_merged, first, inverse = np.unique(lo, return_index=True,
+                                          return_inverse=True)
+    count_merged = np.zeros(lo_merged.shape[0], dtype=np.int64)
+    np.add.at(count_merged, inverse, count)
 
-def mergenull_cmd(null_fns, output_fn):
-    null_dist = pd.read_csv(null_fns[0], sep='\t', index_col=[0, 1, 2])
+    return _null_bins_df(lo_merged, hi[first], count_merged)
+
+
+def merge_null(null_dists, metas):
+    """Sum independent null distributions. The null distributions must be
+    compatible, i.e. have the same TICe parameters (B, c) and classes.
+    Null distributions with the same bins are summed bin by bin, the others
+    (sparse or adaptive bins, see write_null()) by _merge_null_bins().
+    Return the merged null distribution and its parameters.
+    """
+
+    for key in ["B", "c", "rowwise"]:
+        values = set(meta[key] for meta in metas if key in meta)
+        if len(values) > 1:
+            raise ValueError("null distributions with different {} ({}) "
+                             "cannot be merged".format(
+                                 key, ", ".join(sorted(values))))
+
+    # shards with the same seed, shard, jobs and batch share the random stream
+    streams = [tuple(meta.get(key) for key in ["seed", "shard", "jobs", 
+                                                 "batch"])
+               for meta in metas if "seed" in meta]
+    if len(set(streams)) < len(streams):
+        raise ValueError("null distributions computed with the same random "
+                         "stream (seed, shard, jobs and batch) cannot be "
+                         "merged")
+
+    clss = [list(null_dist.index.get_level_values("Class").unique())
+            for null_dist in null_dists]
+    if any(clss_tmp != clss[0] for clss_tmp in clss[1:]):
+        raise ValueError("null distributions with different classes cannot "
+                         "be merged")
+
+    if all(null_dists[0].index.equals(null_dist_tmp.index)
+           for null_dist_tmp in null_dists[1:]):
+        null_dist = null_dists[0]
+        for null_dist_tmp in null_dists[1:]:
+            null_dist = null_dist + null_dist_tmp
+    else:
+        null_dist = pd.concat(
+            [_merge_null_bins([null_dist_tmp.loc[cl]
+                               for null_dist_tmp in null_dists])
+             for cl in clss[0]], axis=0, keys=clss[0], names=["Class"])
+
+    meta = {key: metas[0][key] for key in ["B", "c", "rowwise"]
+            if key in metas[0]}
     
-    for null_fn in null_fns[1:]:
-        null_dist_tmp = pd.read_csv(null_fn, sep='\t', index_col=[0, 1, 2])
-        null_dist += null_dist_tmp
+    return null_dist, meta
+
+
+def mergenull_cmd(null_fns, output_fn, tail=False, tail_quantile=0.99):
+
+    null_dists, metas = zip(*[read_null(null_fn) for null_fn in null_fns])
+
+    try:
+        null_dist, meta = merge_null(null_dists, metas)
+        tail_df = compute_tail(null_dist, q=tail_quantile) if tail else None
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        exit(1)
+
+    write_null(null_dist, output_fn, meta)
+
+    ntotperm = null_dist["NullCountCum"].groupby(level="Class").max()
+    for cl, n in ntotperm.items():
+        sys.stdout.write("* {}: {:d} permutations\n".format(cl, n))
 
-    null_dist.to_csv(output_fn, sep='\t')
+    if tail:
+        tail_fn = tail_filename(output_fn)
+        write_tail(tail_df, tail_fn)
+        sys.stdout.write("GPD tail parameters written to {}\n".\
+                         format(tail_fn))
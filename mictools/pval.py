@@ -19,8 +19,10 @@
 import os
 import os.path
 import sys
-import itertools
+import hashlib
+import multiprocessing
 
+import click
 import numpy as np
 import pandas as pd
 import matplotlib
@@ -29,11 +31,22 @@ import matplotlib.pyplot as plt
 
 import minepy
 import mictools.utils
+import mictools.null
 import mictools.mtest
+import mictools.results
+import mictools.metrics
+import mictools.incremental
 from mictools import NULL_HIST_RES
 
 
-def compute_pval_oneclass(X, null_dist, Y=None, single=False, B=9, c=5):
+PVAL_PLOT_BINS = 50
+VARIABLES_FN = "variables.txt"
+# random streams of the screening null distribution, independent of the
+# number of jobs (see iter_pval_screen())
+SCREEN_NULL_STREAMS = 16
+
+def compute_pval_oneclass(X, null_dist, Y=None, single=False, B=9, c=5,
+                          tail=None, jobs=1):
 
     mictools.utils.check_data(X, Y=Y)
 
@@ -42,35 +55,112 @@ def compute_pval_oneclass(X, null_dist, Y=None, single=False, B=9, c=5):
     # observed values/distribution
     names=['Var1', 'Var2']
     Xa = X.values
+    Ya = None if Y is None else Y.values
+    k = None if Y is None else Y.shape[0]
+    groups = mictools.utils.pair_groups(Xa, Ya)
+    tic = None
+    if groups is not None:
+        # rank-equivalent and constant variables are scored once
+        i, j = tile_pairs(X.shape[0], k, 0, X.shape[0], single=single)
+        tic = unique_pair_tic(Xa, Ya, i, j, groups, B=B, c=c)
+
     if Y is None:
-        _, tic = minepy.pstats(Xa, alpha=B, c=c, est="mic_e")
-        index = pd.MultiIndex.from_tuples(
-            list(itertools.combinations(X.index, 2)), names=names)
+        if tic is None:
+            _, tic = minepy.pstats(Xa, alpha=B, c=c, est="mic_e")
+        i, j = mictools.utils.condensed_pairs(np.arange(tic.shape[0]),
+                                              X.shape[0])
+        index = pair_index(X.index, X.index, i, j)
     else:
-        Ya = Y.values
         if single:
-            _, tic = mictools.utils.sstats(Xa, Ya, alpha=B, c=c, est="mic_e")
+            if tic is None:
+                _, tic = mictools.utils.sstats(Xa, Ya, alpha=B, c=c,
+                                               est="mic_e", jobs=jobs)
             index = pd.MultiIndex.from_arrays([X.index, Y.index], names=names)
         else:
-            _, tic = minepy.cstats(Xa, Ya, alpha=B, c=c, est="mic_e")
+            if tic is None:
+                _, tic = minepy.cstats(Xa, Ya, alpha=B, c=c, est="mic_e")
+                tic = tic.flatten()
             index = pd.MultiIndex.from_product([X.index, Y.index], names=names)
-            tic = tic.flatten()
 
     observed_hist = np.histogram(tic, bins)[0].astype(np.int64)
 
-    # right-tailed area
-    observed_hist_cum = np.cumsum(observed_hist[::-1])[::-1]
-
     # p-values
-    null_hist_cum = null_dist["NullCountCum"].values
-    pval = (np.interp(tic, bins[:-1], null_hist_cum) + 1) / \
-        (null_hist_cum[0] + 1)
+    null_bins, null_hist_cum = null_knots(null_dist)
+    pval = tic_pval(tic, null_hist_cum, tail=tail, bins=null_bins)
     pval = pd.Series(pval, index=index)
     
     # observed
     obs = pd.Series(tic, index=index)
     
     # distribution
+    obs_dist = _obs_dist_df(observed_hist)
+
+    return obs_dist, obs, pval
+
+
+def pair_index(names1, names2, i, j):
+    """Return the (Var1, Var2) MultiIndex of the pairs (i, j). The names are
+    stored once (as levels) and the pairs as integer codes.
+    """
+
+    names = ['Var1', 'Var2']
+    if names1.is_unique and names2.is_unique:
+        return pd.MultiIndex(levels=[names1, names2], codes=[i, j],
+                             names=names, verify_integrity=False)
+    else:
+        return pd.MultiIndex.from_arrays([names1[i], names2[j]], names=names)
+
+
+def null_knots(null_dist):
+    """Return the knots (bins, null_hist_cum) of the right-tailed cumulative
+    null distribution of a single class, to be passed to tic_pval(). For the
+    regular NULL_HIST_RES bins these are the bin starts and NullCountCum.
+    For sparse or variable bins (see mictools.null.write_null()), the count
+    decreases linearly within each bin and is constant between the bins.
+    """
+
+    bin_start = null_dist.index.get_level_values("BinStart").values
+    bin_end = null_dist.index.get_level_values("BinEnd").values
+    count = null_dist["NullCount"].values
+    count_cum = null_dist["NullCountCum"].values
+
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)[:-1]
+    if (bin_start.shape[0] == NULL_HIST_RES) and \
+       np.allclose(bin_start, bins, rtol=0, atol=1e-9):
+        return bins, count_cum
+
+    bins = np.column_stack((bin_start, bin_end)).ravel()
+    null_hist_cum = np.column_stack((count_cum, count_cum - count)).ravel()
+
+    return bins, null_hist_cum
+
+
+def tic_pval(tic, null_hist_cum, tail=None, bins=None):
+    """Compute the p-values of the TICe values given the right-tailed
+    cumulative null distribution (NullCountCum) at the bins, by default the
+    starts of the regular NULL_HIST_RES bins (see null_knots()).
+    """
+
+    if bins is None:
+        bins = np.linspace(0, 1, NULL_HIST_RES+1)[:-1]
+
+    pval = (np.interp(tic, bins, null_hist_cum) + 1) / \
+        (null_hist_cum[0] + 1)
+
+    # extrapolate the p-values above the threshold using the GPD tail
+    if tail is not None:
+        in_tail = tic > tail["Threshold"]
+        pval[in_tail] = mictools.null.tail_pval(tic[in_tail], tail)
+
+    return pval
+
+
+def _obs_dist_df(observed_hist):
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+
+    # right-tailed area
+    observed_hist_cum = np.cumsum(observed_hist[::-1])[::-1]
+
     index = pd.MultiIndex.from_arrays([bins[:-1], bins[1:]],
                                       names=('BinStart', 'BinEnd'))
     obs_dist = pd.DataFrame({"ObsCount": observed_hist,
@@ -78,30 +168,65 @@ def compute_pval_oneclass(X, null_dist, Y=None, single=False, B=9, c=5):
                             index=index,
                             columns=["ObsCount", "ObsCountCum"])
 
-    return obs_dist, obs, pval
+    return obs_dist
 
 
-def compute_pval(X, null_dist, labels=None, Y=None, single=False, B=9, c=5):
+def _pval_dist_df(pval_hist):
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    index = pd.MultiIndex.from_arrays([bins[:-1], bins[1:]],
+                                      names=('BinStart', 'BinEnd'))
+
+    return pd.DataFrame({"PValCount": pval_hist}, index=index)
+
+
+def read_pval_dist(fn):
+    """Read the p-value distribution of the pairs not written in the sparse
+    mode (see pval_cmd()).
+    """
+
+    return pd.read_csv(fn, sep='\t', index_col=[0, 1, 2],
+                       keep_default_na=False, dtype={"Class": str})
+
+
+def dropped_pval(pval_dist, cl):
+    """Return the p-values of the pairs not written for the class cl and
+    their counts. Each p-value is replaced by the upper edge of its bin, so
+    that the multiple testing correction of the written pairs is
+    conservative.
+    """
+
+    pval_dist_cl = pval_dist.loc[cl]
+    counts = pval_dist_cl["PValCount"].values
+    nonzero = counts > 0
+
+    return pval_dist_cl.index.get_level_values("BinEnd").values[nonzero], \
+        counts[nonzero]
+
+
+def compute_pval(X, null_dist, labels=None, Y=None, single=False, B=9, c=5,
+                 tail=None, jobs=1):
 
     mictools.utils.check_data(X, labels=labels, Y=Y)
 
     if labels is None:
         labels = pd.Series('None', index=X.columns)
 
-    clss = sorted(labels.unique())
+    clss, columns = mictools.utils.class_columns(labels)
     obs_dist_list, obs_list, pval_list = [], [], []
-    for cl in clss:
-        keep = (cl == labels)
-        X_cl = X.loc[:, keep]
+    for cl, cols in zip(clss, columns):
+        X_cl = X.iloc[:, cols]
         null_dist_cl = null_dist.loc[cl]
+        tail_cl = None if tail is None else tail.loc[cl]
 
         if Y is None:
             Y_cl = None
         else:
-            Y_cl = Y.loc[:, keep]
+            Y_cl = Y.iloc[:, cols]
             
         obs_dist_cl, obs_cl, pval_cl = compute_pval_oneclass(
-            X_cl, null_dist_cl, Y_cl, single=single, B=B, c=c)
+            X_cl, null_dist_cl, Y_cl, single=single, B=B, c=c, tail=tail_cl,
+            jobs=jobs)
+        mictools.metrics.tick("pairs", pval_cl.shape[0], cl)
 
         obs_cl.name = cl
         pval_cl.name = cl
@@ -116,44 +241,823 @@ def compute_pval(X, null_dist, labels=None, Y=None, single=False, B=9, c=5):
     return obs_dist, obs, pval
 
 
-def plot_pval(pval, output_dir):
+def pval_tiles(m, k=None, single=False, tile_size=1000000):
+    """Split the variable pairs into tiles of consecutive X rows [a, b)
+    containing about tile_size pairs each. Pairs are (i, j) with i < j < m
+    (all pairs), (i, j) with j < k (X/Y) or (i, i) (rowwise).
+    """
+
+    if k is None:
+        npairs = np.arange(m-1, -1, -1)
+    elif single:
+        npairs = np.ones(min(m, k), dtype=np.int64)
+    else:
+        npairs = np.full(m, k, dtype=np.int64)
+
+    return split_rows(npairs, tile_size=tile_size)
+
+
+def split_rows(npairs, tile_size=1000000):
+    """Split the rows, with npairs[i] pairs in the row i, into tiles of
+    consecutive rows [a, b) containing about tile_size pairs each.
+    """
+
+    if tile_size < 1:
+        raise ValueError("the tile size must be >=1")
+
+    tiles = []
+    a, size = 0, 0
+    for i, n in enumerate(npairs):
+        size += n
+        if size >= tile_size:
+            tiles.append((a, i+1))
+            a, size = i+1, 0
+    if size > 0:
+        tiles.append((a, len(npairs)))
+
+    return tiles
+
+
+def tile_pairs(m, k, a, b, single=False):
+    """Return the pair indices i, j of the tile [a, b) (see pval_tiles()),
+    in the same order of tile_tic().
+    """
+
+    if k is None:
+        r, s = np.triu_indices(b-a, 0, m-a-1)
+        return r + a, s + a + 1
+    elif single:
+        i = np.arange(a, min(b, m, k))
+        return i, i
+    else:
+        return np.repeat(np.arange(a, b), k), np.tile(np.arange(k), b-a)
+
+
+def unique_pair_tic(Xa, Ya, i, j, groups, B=9, c=5, min_saving=0.05):
+    """Compute the TICe values of the pairs (i, j) scoring each pair of
+    representative variables once (see mictools.utils.pair_groups()). The
+    pairs with a constant variable get TICe 0. TICe is not symmetric, so
+    the pairs keep their X/Y orientation. Return None if less than a
+    min_saving fraction of the pairs would be saved.
+    """
+
+    rep_x, constant_x, rep_y, constant_y = groups
+    Ya = Xa if Ya is None else Ya
+    ri, rj = rep_x[i], rep_y[j]
+    scored = ~(constant_x[ri] | constant_y[rj])
+    keys = ri[scored].astype(np.int64) * Ya.shape[0] + rj[scored]
+    keys_unique, inverse = np.unique(keys, return_inverse=True)
+    if keys_unique.shape[0] > (1 - min_saving) * i.shape[0]:
+        return None
+
+    tic_unique = np.empty(keys_unique.shape[0], dtype=np.float64)
+    mine = minepy.MINE(alpha=B, c=c, est="mic_e")
+    for u, key in enumerate(keys_unique):
+        mine.compute_score(Xa[key // Ya.shape[0]], Ya[key % Ya.shape[0]])
+        tic_unique[u] = mine.tic(norm=True)
+
+    tic = np.zeros(i.shape[0], dtype=np.float64)
+    tic[scored] = tic_unique[inverse.reshape(-1)]
+
+    return tic
+
 
-    BINS = 50
+def pair_tic(Xa, Ya, i, j, B=9, c=5, groups=None):
+    """Compute the TICe values of the pairs (Xa[i], Ya[j]) (Xa[j] if Ya is
+    None), one pair at a time. If the row groups are provided (see
+    mictools.utils.pair_groups()), the rank-equivalent and constant
+    variables are scored once (see unique_pair_tic()).
+    """
 
+    if groups is not None:
+        return unique_pair_tic(Xa, Ya, i, j, groups, B=B, c=c, min_saving=0)
+
+    Ya = Xa if Ya is None else Ya
+    tic = np.empty(i.shape[0], dtype=np.float64)
+    mine = minepy.MINE(alpha=B, c=c, est="mic_e")
+    for p in range(i.shape[0]):
+        mine.compute_score(Xa[i[p]], Ya[j[p]])
+        tic[p] = mine.tic(norm=True)
+
+    return tic
+
+
+def tile_tic(Xa, Ya, a, b, single=False, B=9, c=5, groups=None):
+    """Compute the TICe values of the pairs in the tile [a, b) (see
+    pval_tiles()). Return the pair indices i, j and the TICe values, in the
+    same order of compute_pval_oneclass(). If the row groups are provided
+    (see mictools.utils.pair_groups()), the rank-equivalent and constant
+    variables are scored once (see unique_pair_tic()).
+    """
+
+    if groups is not None:
+        k = None if Ya is None else Ya.shape[0]
+        i, j = tile_pairs(Xa.shape[0], k, a, b, single=single)
+        tic = unique_pair_tic(Xa, Ya, i, j, groups, B=B, c=c)
+        if tic is not None:
+            return i, j, tic
+
+    if Ya is None:
+        # row r of the tile (i = a+r) is paired with j = a+1+s, s >= r
+        m = Xa.shape[0]
+        tic_tile = np.empty((b-a, m-a-1), dtype=np.float64)
+        _, tic_tile[:, b-a-1:] = minepy.cstats(Xa[a:b], Xa[b:], alpha=B, c=c,
+                                               est="mic_e")
+        if b-a > 1:
+            r, s = np.triu_indices(b-a, 1)
+            _, tic_tile[r, s-1] = minepy.pstats(Xa[a:b], alpha=B, c=c,
+                                                est="mic_e")
+        r, s = np.triu_indices(b-a, 0, m-a-1)
+        i, j, tic = r + a, s + a + 1, tic_tile[r, s]
+    elif single:
+        _, tic = mictools.utils.sstats(Xa[a:b], Ya[a:b], alpha=B, c=c,
+                                       est="mic_e")
+        i = j = np.arange(a, b)
+    else:
+        _, tic = minepy.cstats(Xa[a:b], Ya, alpha=B, c=c, est="mic_e")
+        i = np.repeat(np.arange(a, b), Ya.shape[0])
+        j = np.tile(np.arange(Ya.shape[0]), b-a)
+        tic = tic.flatten()
+
+    return i, j, tic
+
+
+_tile_data = {}
+
+
+def _pval_tile_init(Xa_cls, Ya_cls, null_cls, tail_cls, groups_cls, single,
+                    B, c, new_x=None, new_y=None, screen=None):
+    _tile_data.update(Xa_cls=Xa_cls, Ya_cls=Ya_cls, null_cls=null_cls,
+                      tail_cls=tail_cls, groups_cls=groups_cls,
+                      single=single, B=B, c=c, new_x=new_x, new_y=new_y,
+                      screen=screen)
+
+
+def _pval_tile(tile):
+    a, b = tile
+    d = _tile_data
+    ncls = len(d["Xa_cls"])
+
+    obs, pval = None, None
+    for l in range(ncls):
+        i, j, tic = tile_tic(d["Xa_cls"][l], d["Ya_cls"][l], a, b,
+                             single=d["single"], B=d["B"], c=d["c"],
+                             groups=d["groups_cls"][l])
+        if obs is None:
+            obs = np.empty((tic.shape[0], ncls), dtype=np.float64)
+            pval = np.empty_like(obs)
+        obs[:, l] = tic
+        pval[:, l] = _tile_class_pval(l, tic)
+
+    return i, j, obs, pval
+
+
+def _pval_update_tile(tile):
+    a, b = tile
+    d = _tile_data
+    i, j = update_pairs(d["new_x"], d["new_y"], a, b)
+    ncls = len(d["Xa_cls"])
+
+    obs = np.empty((i.shape[0], ncls), dtype=np.float64)
+    pval = np.empty_like(obs)
+    for l in range(ncls):
+        obs[:, l] = pair_tic(d["Xa_cls"][l], d["Ya_cls"][l], i, j, B=d["B"],
+                             c=d["c"], groups=d["groups_cls"][l])
+        pval[:, l] = _tile_class_pval(l, obs[:, l])
+
+    return i, j, obs, pval
+
+
+def _pval_screen_tile(tile):
+    a, b = tile
+    d, s = _tile_data, _tile_data["screen"]
+    ncls = len(d["Xa_cls"])
+
+    # first tier: TICe on the sample subsets, with the subsampled nulls
+    obs_sub, pval_sub = None, None
+    for l in range(ncls):
+        i, j, tic = tile_tic(s["Xa_cls"][l], s["Ya_cls"][l], a, b,
+                             single=d["single"], B=d["B"], c=d["c"],
+                             groups=s["groups_cls"][l])
+        if pval_sub is None:
+            obs_sub = np.empty((tic.shape[0], ncls), dtype=np.float64)
+            pval_sub = np.empty_like(obs_sub)
+        null_bins, null_hist_cum = s["null_cls"][l]
+        obs_sub[:, l] = tic
+        pval_sub[:, l] = tic_pval(tic, null_hist_cum, bins=null_bins)
+
+    # the survivors and a random fraction of the discarded pairs (audit) are
+    # rescored on all the samples
+    survive = (pval_sub <= s["pval"]).any(axis=1)
+    audit = ~survive & (pair_uniform(i, j, s["seed"]) < s["audit"])
+    rescore = survive | audit
+    obs = np.empty((rescore.sum(), ncls), dtype=np.float64)
+    pval = np.empty_like(obs)
+    for l in range(ncls):
+        obs[:, l] = pair_tic(d["Xa_cls"][l], d["Ya_cls"][l], i[rescore],
+                             j[rescore], B=d["B"], c=d["c"],
+                             groups=d["groups_cls"][l])
+        pval[:, l] = _tile_class_pval(l, obs[:, l])
+
+    # p-values of the discarded pairs (on all the samples, if audited),
+    # first tier TICe values and pairs with p-value <= the target on all
+    # the samples
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    dropped = ~survive[rescore]
+    dropped_hist = np.empty((ncls, NULL_HIST_RES), dtype=np.int64)
+    screen_obs_hist = np.empty((ncls, NULL_HIST_RES), dtype=np.int64)
+    counts = np.empty((ncls, 2), dtype=np.int64)
+    for l in range(ncls):
+        dropped_hist[l] = np.histogram(pval_sub[~rescore, l], bins)[0] + \
+            np.histogram(pval[dropped, l], bins)[0]
+        screen_obs_hist[l] = np.histogram(obs_sub[:, l], bins)[0]
+        passed = pval[:, l] <= s["target"]
+        counts[l] = (passed & ~dropped).sum(), (passed & dropped).sum()
+
+    stats = {"npairs": survive.shape[0], "ndropped": int((~survive).sum()),
+             "naudit": int(audit.sum()), "dropped_hist": dropped_hist,
+             "screen_obs_hist": screen_obs_hist, "counts": counts}
+
+    return i[survive], j[survive], obs[~dropped], pval[~dropped], stats
+
+
+def pair_uniform(i, j, seed=0):
+    """Return pseudo-random numbers in [0, 1) which depend only on the
+    pairs (i, j) and on the seed (SplitMix64 hash).
+    """
+
+    with np.errstate(over='ignore'):
+        z = (np.asarray(i, dtype=np.uint64) << np.uint64(32)) ^ \
+            np.asarray(j, dtype=np.uint64)
+        z = z + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+
+    return (z >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+
+def _tile_class_pval(l, tic):
+    null_bins, null_hist_cum = _tile_data["null_cls"][l]
+
+    return tic_pval(tic, null_hist_cum, tail=_tile_data["tail_cls"][l],
+                    bins=null_bins)
+
+
+def iter_pval(X, null_dist, labels=None, Y=None, single=False, B=9, c=5,
+              tail=None, tile_size=1000000, jobs=1, class_data=None,
+              groups=None):
+    """Compute the TICe values and the p-values tile by tile (see
+    pval_tiles()). For each tile, yield the pair indices i (X rows) and j (X
+    or Y rows) and the TICe values and p-values (npairs x nclasses arrays,
+    classes sorted). Memory usage depends on the tile size only.
+
+    With jobs > 1, the tiles are computed in a process pool and yielded in
+    the same order as the serial computation. The tile size is reduced, if
+    needed, to obtain at least 4 tiles per job. class_data can be
+    precomputed with mictools.utils.class_data(). If groups is a dict, it
+    is updated with the rank-equivalent and constant variables of each
+    class (class -> mictools.utils.pair_groups(), see write_groups()).
+    """
+
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
+
+    clss, initargs = _tile_initargs(X, null_dist, labels=labels, Y=Y,
+                                    single=single, B=B, c=c, tail=tail,
+                                    class_data=class_data)
+    if groups is not None:
+        groups.update(zip(clss, initargs[4]))
+
+    k = None if Y is None else Y.shape[0]
+    tile_size = mictools.utils.balanced_chunk_size(
+        npairs(X.shape[0], k, single=single), tile_size, jobs)
+    tiles = pval_tiles(X.shape[0], k, single=single, tile_size=tile_size)
+    mictools.metrics.set_total("pairs", npairs(X.shape[0], k, single=single) \
+                               * len(clss))
+
+    for res in _iter_tiles(_pval_tile, tiles, initargs, clss, jobs):
+        yield res
+
+
+def update_npairs(new_x, new_y=None):
+    """Return the number of pairs of each X row involving at least one new
+    variable (see update_pairs()).
+    """
+
+    if new_y is None:
+        m = new_x.shape[0]
+        new_after = new_x.sum() - np.cumsum(new_x)
+        return np.where(new_x, np.arange(m-1, -1, -1), new_after)
+    else:
+        return np.where(new_x, new_y.shape[0], new_y.sum())
+
+
+def update_pairs(new_x, new_y, a, b):
+    """Return the pair indices i, j of the X rows [a, b) involving at least
+    one new variable, in the order of the full computation. new_x (and
+    new_y) are the boolean masks of the new X (and Y) variables. If new_y is
+    None, the pairs are (i, j) with i < j (all pairs), otherwise all the
+    pairs between X and Y.
+    """
+
+    if new_y is None:
+        m = new_x.shape[0]
+        new_idx = np.flatnonzero(new_x)
+        j = [np.arange(r+1, m) if new_x[r] else new_idx[new_idx > r]
+             for r in range(a, b)]
+    else:
+        all_idx, new_idx = np.arange(new_y.shape[0]), np.flatnonzero(new_y)
+        j = [all_idx if new_x[r] else new_idx for r in range(a, b)]
+
+    npairs_rows = [j_r.shape[0] for j_r in j]
+    i = np.repeat(np.arange(a, b), npairs_rows)
+    j = np.concatenate(j) if j else np.empty(0, dtype=np.int64)
+
+    return i, j.astype(np.int64)
+
+
+def iter_pval_update(X, null_dist, new_x, new_y=None, labels=None, Y=None,
+                     B=9, c=5, tail=None, tile_size=1000000, jobs=1,
+                     groups=None):
+    """Compute the TICe values and the p-values of the pairs involving at
+    least one new variable (see update_pairs()) tile by tile, as
+    iter_pval().
+    """
+
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
+
+    clss, initargs = _tile_initargs(X, null_dist, labels=labels, Y=Y, B=B,
+                                    c=c, tail=tail)
+    if groups is not None:
+        groups.update(zip(clss, initargs[4]))
+    initargs += (new_x, new_y)
+
+    npairs_rows = update_npairs(new_x, new_y)
+    tile_size = mictools.utils.balanced_chunk_size(npairs_rows.sum(),
+                                                   tile_size, jobs)
+    tiles = split_rows(npairs_rows, tile_size=tile_size)
+    mictools.metrics.set_total("pairs", npairs_rows.sum() * len(clss))
+
+    for res in _iter_tiles(_pval_update_tile, tiles, initargs, clss, jobs):
+        yield res
+
+
+def iter_pval_screen(X, null_dist, labels=None, Y=None, single=False, B=9,
+                     c=5, tail=None, tile_size=1000000, jobs=1, fraction=0.1,
+                     screen_pval=0.1, screen_nperm=10000, audit=0.01,
+                     target_pval=0.01, seed=0, stats=None, groups=None):
+    """Compute the TICe values and the p-values tile by tile in two tiers,
+    yielding only the pairs which pass the first tier (see iter_pval()). In
+    the first tier, TICe is computed on a random fraction of the samples of
+    each class and the p-values are computed with a null distribution of
+    screen_nperm permutations of the same subsets. The pairs with p-value
+    <= screen_pval in at least one class are rescored on all the samples
+    with null_dist. A random audit fraction of the discarded pairs (see
+    pair_uniform()) is rescored too, to estimate the false negative rate of
+    the first tier at the p-value target_pval (see screen_fnr()). The
+    results do not depend on jobs: the screening null distribution is
+    computed with SCREEN_NULL_STREAMS random streams.
+
+    If stats is a dict, it is updated with the number of samples of the
+    subsets ("nsamples"), the number of pairs ("npairs"), discarded
+    ("ndropped") and audited ("naudit"), the histogram of the p-values of
+    the discarded pairs (NULL_HIST_RES bins, classes x bins, of the first
+    tier unless audited, "dropped_hist"), the histogram of the first tier
+    TICe values of all the pairs ("screen_obs_hist") and, for each class,
+    the number of survivors and of
+    audited pairs with p-value <= target_pval on all the samples
+    ("counts", classes x 2). groups is updated as in iter_pval().
+    """
+
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
+
+    if not (0 < fraction < 1):
+        raise ValueError("the screening fraction must be in (0, 1)")
+
+    if not (0 <= audit <= 1):
+        raise ValueError("the audit fraction must be in [0, 1]")
+
+    mictools.utils.check_data(X, labels=labels, Y=Y)
+    if labels is None:
+        labels = pd.Series('None', index=X.columns)
+
+    # random subset of the samples of each class
+    clss, columns = mictools.utils.class_columns(labels)
+    cols_sub = screen_subset(clss, columns, fraction, seed=seed)
+    X_sub = X.iloc[:, cols_sub]
+    Y_sub = None if Y is None else Y.iloc[:, cols_sub]
+    labels_sub = labels.iloc[cols_sub]
+
+    sys.stdout.write("Computing the screening null distribution on {:d} of "
+                     "{:d} samples...\n".format(cols_sub.shape[0],
+                                                X.shape[1]))
+    null_sub = mictools.null.compute_null(X_sub, labels=labels_sub, Y=Y_sub,
+                                          rowwise=single, B=B, c=c,
+                                          nperm=screen_nperm, seed=seed,
+                                          jobs=jobs,
+                                          streams=SCREEN_NULL_STREAMS)
+
+    _, initargs_sub = _tile_initargs(X_sub, null_sub, labels=labels_sub,
+                                     Y=Y_sub, single=single, B=B, c=c)
+    screen = {"Xa_cls": initargs_sub[0], "Ya_cls": initargs_sub[1],
+              "null_cls": initargs_sub[2], "groups_cls": initargs_sub[4],
+              "pval": screen_pval, "audit": audit, "target": target_pval,
+              "seed": seed}
+    clss, initargs = _tile_initargs(X, null_dist, labels=labels, Y=Y,
+                                    single=single, B=B, c=c, tail=tail)
+    if groups is not None:
+        groups.update(zip(clss, initargs[4]))
+    initargs += (None, None, screen)
+
+    k = None if Y is None else Y.shape[0]
+    npairs_tot = npairs(X.shape[0], k, single=single)
+    tile_size = mictools.utils.balanced_chunk_size(npairs_tot, tile_size,
+                                                   jobs)
+    tiles = pval_tiles(X.shape[0], k, single=single, tile_size=tile_size)
+    mictools.metrics.set_total("pairs", npairs_tot * len(clss))
+
+    if stats is None:
+        stats = {}
+    stats.update(nsamples=cols_sub.shape[0], npairs=0, ndropped=0, naudit=0,
+                 dropped_hist=np.zeros((len(clss), NULL_HIST_RES),
+                                       dtype=np.int64),
+                 screen_obs_hist=np.zeros((len(clss), NULL_HIST_RES),
+                                          dtype=np.int64),
+                 counts=np.zeros((len(clss), 2), dtype=np.int64))
+    for i, j, obs, pval, stats_tile in _iter_tiles(
+            _pval_screen_tile, tiles, initargs, clss, jobs, tick=False):
+        _tick_pairs(stats_tile["npairs"], clss)
+        for key in ["npairs", "ndropped", "naudit", "dropped_hist",
+                    "screen_obs_hist", "counts"]:
+            stats[key] += stats_tile[key]
+        yield i, j, obs, pval
+
+
+def screen_subset(clss, columns, fraction, seed=0):
+    """Return the (sorted) positions of the samples used in the first tier
+    of the screening: a random fraction of the samples of each class
+    (columns, see mictools.utils.class_columns()), at least 2. Raise
+    ValueError if a class has less than 2 samples.
+    """
+
+    for cl, cols in zip(clss, columns):
+        if cols.shape[0] < 2:
+            raise ValueError("the class {} has less than 2 samples and "
+                             "cannot be screened".format(cl))
+
+    rs = np.random.RandomState(seed)
+
+    return np.sort(np.concatenate(
+        [rs.choice(cols, max(2, int(round(fraction * cols.shape[0]))),
+                   replace=False) for cols in columns]))
+
+
+def screen_fnr(stats):
+    """Estimate the false negative rate of the first tier of each class
+    (see iter_pval_screen()): the fraction of the pairs with p-value <=
+    target_pval on all the samples which were discarded. Return None for
+    the classes without estimate.
+    """
+
+    fnr = []
+    for passed, missed in stats["counts"]:
+        if stats["naudit"] == 0:
+            fnr.append(None)
+            continue
+        missed_est = missed * stats["ndropped"] / stats["naudit"]
+        fnr.append(missed_est / (passed + missed_est) \
+                   if passed + missed_est > 0 else 0.0)
+
+    return fnr
+
+
+def _tile_initargs(X, null_dist, labels=None, Y=None, single=False, B=9, c=5,
+                   tail=None, class_data=None):
+    mictools.utils.check_data(X, labels=labels, Y=Y)
+
+    # per-class views of a single class-sorted buffer
+    if class_data is None:
+        class_data = mictools.utils.class_data(X, labels=labels, Y=Y)
+    clss, _, Xa_cls, Ya_cls = class_data
+    null_cls = [null_knots(null_dist.loc[cl]) for cl in clss]
+    tail_cls = [None if tail is None else tail.loc[cl] for cl in clss]
+
+    # rank-equivalent and constant variables, per class
+    groups_cls = [mictools.utils.pair_groups(Xa_cls[l], Ya_cls[l])
+                  for l in range(len(clss))]
+
+    return clss, (Xa_cls, Ya_cls, null_cls, tail_cls, groups_cls, single, B,
+                  c)
+
+
+def _iter_tiles(func, tiles, initargs, clss, jobs=1, tick=True):
+    if jobs == 1:
+        _pval_tile_init(*initargs)
+        try:
+            for tile in tiles:
+                res = func(tile)
+                if tick:
+                    _tick_pairs(res[0].shape[0], clss)
+                yield res
+        finally:
+            _tile_data.clear()
+    else:
+        with multiprocessing.Pool(jobs, _pval_tile_init, initargs) as pool:
+            for res in pool.imap(func, tiles):
+                if tick:
+                    _tick_pairs(res[0].shape[0], clss)
+                yield res
+
+
+class TopPartners(object):
+    """Keep, for each class, the k pairs with the highest TICe of each
+    variable (X variables first, then Y variables with an offset of m),
+    with their TICe values and p-values. Ties are broken by the order in
+    which the pairs are added. The memory usage is O(nvars*k) per class.
+    """
+
+    def __init__(self, nvars, k, nclasses, offset=0):
+        if k < 1:
+            raise ValueError("the number of partners must be >=1")
+
+        self.k = k
+        self.offset = offset
+        self.n = 0
+        self.score = np.full((nclasses, nvars, k), -np.inf, dtype=np.float64)
+        self.seq = np.full((nclasses, nvars, k), -1, dtype=np.int64)
+
+        # the pairs kept in at least one class, in the order of add()
+        self.pairs_seq = np.empty(0, dtype=np.int64)
+        self.pairs_i = np.empty(0, dtype=np.int64)
+        self.pairs_j = np.empty(0, dtype=np.int64)
+        self.obs = np.empty((0, nclasses), dtype=np.float64)
+        self.pval = np.empty((0, nclasses), dtype=np.float64)
+
+    def add(self, i, j, obs, pval):
+        """Add the pairs (i, j) and their TICe values and p-values (npairs x
+        nclasses).
+        """
+
+        seq = self.n + np.arange(i.shape[0], dtype=np.int64)
+        self.n += i.shape[0]
+        nvars, k = self.score.shape[1], self.k
+
+        # each pair is a candidate partner of both its variables
+        var_new = np.concatenate([i, j + self.offset])
+        seq_new = np.concatenate([seq, seq])
+        var_old = np.repeat(np.arange(nvars), k)
+        for l in range(self.score.shape[0]):
+            valid = self.seq[l].ravel() >= 0
+            var = np.concatenate([var_old[valid], var_new])
+            seq_l = np.concatenate([self.seq[l].ravel()[valid], seq_new])
+            score = np.concatenate([self.score[l].ravel()[valid],
+                                    obs[:, l], obs[:, l]])
+
+            # sort by variable, decreasing TICe and order
+            order = np.lexsort((seq_l, -score, var))
+            var, seq_l, score = var[order], seq_l[order], score[order]
+            start = np.searchsorted(var, var)
+            rank = np.arange(var.shape[0]) - start
+            top = rank < k
+
+            self.score[l].fill(-np.inf)
+            self.seq[l].fill(-1)
+            self.score[l, var[top], rank[top]] = score[top]
+            self.seq[l, var[top], rank[top]] = seq_l[top]
+
+        # drop the pairs no longer kept in any class
+        keep = np.isin(np.concatenate([self.pairs_seq, seq]),
+                       self.seq[self.seq >= 0])
+        self.pairs_seq = np.concatenate([self.pairs_seq, seq])[keep]
+        self.pairs_i = np.concatenate([self.pairs_i, i])[keep]
+        self.pairs_j = np.concatenate([self.pairs_j, j])[keep]
+        self.obs = np.concatenate([self.obs, obs])[keep]
+        self.pval = np.concatenate([self.pval, pval])[keep]
+
+    def pairs(self):
+        """Return the pair indices i, j, the TICe values and the p-values of
+        the pairs kept, in the order of add().
+        """
+
+        return self.pairs_i, self.pairs_j, self.obs, self.pval
+
+
+def write_groups(groups, cross=False):
+    """Report the rank-equivalent and constant variables of each class
+    (groups, see iter_pval()). cross is True in the XVARS x YVARS modes.
+    """
+
+    lines = []
+    for cl, groups_cl in groups.items():
+        if groups_cl is None:
+            continue
+        rep_x, constant_x, rep_y, constant_y = groups_cl
+        for name, rep, constant in [("X", rep_x, constant_x),
+                                    ("Y", rep_y, constant_y)][:1+cross]:
+            duplicate = (rep != np.arange(rep.shape[0])) & ~constant
+            if duplicate.any() or constant.any():
+                lines.append("* {} ({}): {:d} rank-equivalent, {:d} "
+                             "constant\n".format(cl, name, duplicate.sum(),
+                                                 constant.sum()))
+
+    if lines:
+        sys.stdout.write("Variables scored once (rank-equivalent to a "
+                         "previous variable) and constant variables (TICe "
+                         "0):\n")
+        for line in lines:
+            sys.stdout.write(line)
+
+
+def _write_screen(stats, clss, screen_pval, target_pval):
+    sys.stdout.write("Screening on {:d} samples: {:d} of {:d} pairs "
+                     "discarded (p-value > {:g} in all the classes), {:d} of "
+                     "them rescored on all the samples\n".format(
+                         stats["nsamples"], stats["ndropped"],
+                         stats["npairs"], screen_pval, stats["naudit"]))
+    sys.stdout.write("Estimated false negative rate of the screening (pairs "
+                     "with p-value <= {:g} on all the samples which were "
+                     "discarded):\n".format(target_pval))
+    for cl, fnr, (_, missed) in zip(clss, screen_fnr(stats),
+                                    stats["counts"]):
+        if fnr is None:
+            sys.stdout.write("* {}: NA (no discarded pair rescored)\n".\
+                             format(cl))
+        else:
+            sys.stdout.write("* {}: {:f} ({:d} of {:d} rescored discarded "
+                             "pairs)\n".format(cl, fnr, missed,
+                                               stats["naudit"]))
+
+
+def _tick_pairs(n, clss):
+    for cl in clss:
+        mictools.metrics.tick("pairs", n, cl)
+
+
+def npairs(m, k=None, single=False):
+    """Return the number of variable pairs tested.
+    """
+
+    if k is None:
+        return m * (m - 1) // 2
+    elif single:
+        return min(m, k)
+    else:
+        return m * k
+
+
+def run_meta(X, null_dist, labels=None, Y=None, single=False, B=9, c=5,
+             tail=None):
+    """Return the parameters of a pval run, stored with the variables (see
+    write_variables()). The samples, the labels and the null distribution
+    are summarized by SHA-1 digests.
+    """
+
+    samples = list(X.columns) if labels is None else \
+        ["{}\t{}".format(s, l) for s, l in labels.items()]
+    mode = "pairs" if Y is None else ("rowwise" if single else "cross")
+    sha1 = lambda text: hashlib.sha1(text.encode()).hexdigest()
+
+    return {"B": str(B), "c": str(c), "mode": mode,
+            "samples": sha1("\n".join(samples)),
+            "null": sha1(null_dist.to_csv(sep='\t', float_format="%.6f")),
+            "tail": "None" if tail is None else \
+                sha1(tail.to_csv(sep='\t'))}
+
+
+def write_variables(output_fn, X, Y=None, meta=None):
+    """Write the names and the content hashes (see mictools.utils.row_sha1())
+    of the X and Y variables (VARIABLES_FN in the pval output directory).
+    The parameters in meta are stored as '#key=value' header lines.
+    """
+
+    sets = [("X", X)] if Y is None else [("X", X), ("Y", Y)]
+    with open(output_fn, 'w') as output_handle:
+        if meta is not None:
+            for key in sorted(meta):
+                output_handle.write("#{}={}\n".format(key, meta[key]))
+        output_handle.write("Set\tVar\tHash\n")
+        for name, A in sets:
+            for var, h in zip(A.index, mictools.utils.row_sha1(A.values)):
+                output_handle.write("{}\t{}\t{}\n".format(name, var, h))
+
+
+def read_variables(fn):
+    """Read the variables of a pval run (see write_variables()). Return the
+    variables table and the parameters stored in the header.
+    """
+
+    meta = {}
+    with open(fn) as handle:
+        for line in handle:
+            if not line.startswith('#'):
+                break
+            key, value = line[1:].rstrip('\n').split('=', 1)
+            meta[key] = value
+
+    variables = pd.read_csv(fn, sep='\t', skiprows=len(meta), dtype=str,
+                            keep_default_na=False)
+
+    return variables, meta
+
+
+def plot_pval(pval, output_dir):
+
+    bins = np.linspace(0, 1, PVAL_PLOT_BINS+1)
     for cl in pval.columns:
-        fig = plt.figure(figsize=(10, 4))
-        ax1 = plt.subplot(111)
-        bins = np.linspace(0, 1, BINS+1)
-        hist, bin_edges = np.histogram(pval[cl], bins=bins, density=True)
-        plt.bar(bin_edges[:-1], hist, width=1/BINS, log=False,
-                linewidth=1, color="white", edgecolor="black")
-        plt.xlabel("p-value")
-        plt.ylabel("Density")
+        hist, _ = np.histogram(pval[cl], bins=bins)
+        plot_pval_hist(hist, cl, output_dir)
+
 
-        output_fn = os.path.join(output_dir, "pval_{}.png".format(cl))
-        fig.savefig(output_fn, bbox_inches='tight', dpi=300, format='png')
+def plot_pval_hist(hist, cl, output_dir):
+    """Plot the p-value distribution of a class given its histogram (with
+    equally spaced bins in [0, 1]).
+    """
+
+    nbins = hist.shape[0]
+    bin_edges = np.linspace(0, 1, nbins+1)
+    density = hist / (hist.sum() / nbins)
+
+    fig = plt.figure(figsize=(10, 4))
+    ax1 = plt.subplot(111)
+    plt.bar(bin_edges[:-1], density, width=1/nbins, log=False,
+            linewidth=1, color="white", edgecolor="black")
+    plt.xlabel("p-value")
+    plt.ylabel("Density")
+
+    output_fn = os.path.join(output_dir, "pval_{}.png".format(cl))
+    fig.savefig(output_fn, bbox_inches='tight', dpi=300, format='png')
+    plt.close(fig)
 
 
 def pval_cmd(xvars_fn, null_fn, output_dir, labels_fn=None, target=None,
-             yvars_fn=None, single=False, grid=9, clumps=5):
+             yvars_fn=None, single=False, grid=9, clumps=5, tail=False,
+             tile_size=1000000, jobs=1, output_format='tsv', max_pval=None,
+             min_tic=None, top_k=None, previous_dir=None, screen=None,
+             screen_pval=0.1, screen_nperm=10000, screen_audit=0.01,
+             screen_target=0.01):
+
+    if (top_k is not None) and single:
+        sys.stderr.write("--top-k cannot be used in the rowwise mode\n")
+        exit(1)
+
+    if previous_dir is not None:
+        if single or (output_format != 'tsv') or (max_pval is not None) or \
+           (min_tic is not None) or (top_k is not None) or \
+           (screen is not None):
+            sys.stderr.write("--previous cannot be used in the rowwise mode, "
+                             "with the binary format or with --max-pval, "
+                             "--min-tic, --top-k and --screen\n")
+            exit(1)
 
     X, labels, Y = mictools.utils.read_data(xvars_fn, labels_fn, target,
                                             yvars_fn)    
-    null_dist = pd.read_csv(null_fn, sep='\t', dtype={'Class': str})
-    null_dist.set_index(['Class', 'BinStart', 'BinEnd'], inplace=True)
+    if os.path.isdir(null_fn):
+        # null cache (see mictools null --cache)
+        try:
+            null_dist = mictools.null.cached_null(null_fn, X, labels=labels,
+                                                  Y=Y, rowwise=single, B=grid,
+                                                  c=clumps)
+            tail_df = mictools.null.compute_tail(null_dist) if tail else None
+        except ValueError as e:
+            sys.stderr.write("{}\n".format(e))
+            exit(1)
+    else:
+        null_dist, null_meta = mictools.null.read_null(null_fn)
 
-    obs_dist, obs, pval = compute_pval(X=X,
-                                       null_dist=null_dist,
-                                       labels=labels, 
-                                       Y=Y, 
-                                       single=single,
-                                       B=grid, 
-                                       c=clumps)
+        for key, value in [("B", grid), ("c", clumps)]:
+            if (key in null_meta) and (null_meta[key] != str(value)):
+                sys.stderr.write("warning: the null distribution was computed "
+                                 "with {}={} (here {}={})\n".format(
+                                     key, null_meta[key], key, value))
+
+        if tail:
+            tail_fn = mictools.null.tail_filename(null_fn)
+            if not os.path.isfile(tail_fn):
+                sys.stderr.write("GPD tail file {} not found (see mictools "
+                                 "null --tail)\n".format(tail_fn))
+                exit(1)
+            tail_df = mictools.null.read_tail(tail_fn)
+        else:
+            tail_df = None
 
     ntotperm = null_dist["NullCountCum"].iloc[0]
     minpval = 1 / ntotperm
     sys.stdout.write("The minimum p-value with a total of {:d} permutations is "
                      "{:e}\n".format(ntotperm, minpval))
+    if tail:
+        sys.stdout.write("p-values above the tail thresholds are extrapolated "
+                         "using the GPD fit\n")
+
+    if screen is not None:
+        try:
+            screen_subset(*mictools.utils.class_columns(
+                pd.Series('None', index=X.columns) if labels is None \
+                else labels), screen)
+        except ValueError as e:
+            raise click.ClickException(str(e))
 
     try:
         os.makedirs(output_dir)
@@ -162,14 +1066,181 @@ def pval_cmd(xvars_fn, null_fn, output_dir, labels_fn=None, target=None,
             sys.stderr.write("directory {} cannot be created\n".\
                              format(output_dir))
             exit(1)
-    
-    obs_dist.to_csv(os.path.join(output_dir, "obs_dist.txt"), sep='\t',
-                    float_format="%.6f")
-    obs.to_csv(os.path.join(output_dir, "obs.txt"), sep='\t',
-               float_format='%.6f')
-    pval.to_csv(os.path.join(output_dir, "pval.txt"), sep='\t',
-                float_format='%e')
-    plot_pval(pval, output_dir)
+
+    meta = run_meta(X, null_dist, labels=labels, Y=Y, single=single, B=grid,
+                    c=clumps, tail=tail_df)
+    if previous_dir is not None:
+        try:
+            mictools.incremental.update_pval(
+                X, null_dist, previous_dir, output_dir, labels=labels, Y=Y,
+                B=grid, c=clumps, tail=tail_df, tile_size=tile_size,
+                jobs=jobs, meta=meta)
+        except ValueError as e:
+            sys.stderr.write("{}\n".format(e))
+            exit(1)
+        return
+
+    clss = ['None'] if labels is None else sorted(labels.unique())
+    names1 = X.index.values
+    names2 = X.index.values if Y is None else Y.index.values
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    pval_bins = np.linspace(0, 1, PVAL_PLOT_BINS+1)
+    observed_hist = np.zeros((len(clss), NULL_HIST_RES), dtype=np.int64)
+    pval_hist = np.zeros((len(clss), PVAL_PLOT_BINS), dtype=np.int64)
+
+    # sparse mode: only the pairs passing a threshold in at least one class
+    # (and/or the top-k partners of each variable) are written, the
+    # p-values of the others are kept as a histogram
+    thresholds = (max_pval is not None) or (min_tic is not None)
+    sparse = thresholds or (top_k is not None) or (screen is not None)
+    dropped_hist = np.zeros((len(clss), NULL_HIST_RES), dtype=np.int64)
+    nemitted, ntests = 0, 0
+    if top_k is not None:
+        nvars = X.shape[0] if Y is None else X.shape[0] + Y.shape[0]
+        top = TopPartners(nvars, top_k, len(clss),
+                          offset=0 if Y is None else X.shape[0])
+
+    if output_format == 'binary':
+        # pair indices refer to a single names dictionary (X then Y names)
+        names = names1 if Y is None else np.concatenate([names1, names2])
+        offset = 0 if Y is None else X.shape[0]
+        k = None if Y is None else Y.shape[0]
+        n = None if sparse else npairs(X.shape[0], k, single=single)
+        # all pairs are stored in the condensed order, without indices
+        condensed = X.shape[0] if (Y is None and not sparse) else None
+        obs_writer = mictools.results.ResultsWriter(
+            os.path.join(output_dir, "obs.bin"), names, clss, npairs=n,
+            float_format='%.6f', condensed=condensed)
+        pval_writer = mictools.results.ResultsWriter(
+            os.path.join(output_dir, "pval.bin"), names, clss, npairs=n,
+            float_format='%e', condensed=condensed)
+    else:
+        obs_handle = open(os.path.join(output_dir, "obs.txt"), 'w')
+        pval_handle = open(os.path.join(output_dir, "pval.txt"), 'w')
+
+    def write_pairs(i, j, obs, pval, header):
+        with mictools.metrics.io("write", output_dir):
+            if output_format == 'binary':
+                obs_writer.write(i, j + offset, obs)
+                pval_writer.write(i, j + offset, pval)
+            else:
+                index = pd.MultiIndex.from_arrays([names1[i], names2[j]],
+                                                  names=['Var1', 'Var2'])
+                pd.DataFrame(obs, index=index, columns=clss).to_csv(
+                    obs_handle, sep='\t', float_format='%.6f', header=header)
+                pd.DataFrame(pval, index=index, columns=clss).to_csv(
+                    pval_handle, sep='\t', float_format='%e', header=header)
+
+    groups = {}
+    if screen is None:
+        results = iter_pval(X=X,
+                            null_dist=null_dist,
+                            labels=labels, 
+                            Y=Y, 
+                            single=single,
+                            B=grid, 
+                            c=clumps,
+                            tail=tail_df,
+                            tile_size=tile_size,
+                            jobs=jobs,
+                            groups=groups)
+    else:
+        # two-tier screening: only the first tier survivors are written
+        screen_stats = {}
+        results = iter_pval_screen(X=X,
+                                   null_dist=null_dist,
+                                   labels=labels,
+                                   Y=Y,
+                                   single=single,
+                                   B=grid,
+                                   c=clumps,
+                                   tail=tail_df,
+                                   tile_size=tile_size,
+                                   jobs=jobs,
+                                   fraction=screen,
+                                   screen_pval=screen_pval,
+                                   screen_nperm=screen_nperm,
+                                   audit=screen_audit,
+                                   target_pval=screen_target,
+                                   stats=screen_stats,
+                                   groups=groups)
+
+    # the results are written tile by tile
+    header = True
+    for i, j, obs, pval in results:
+        for l in range(len(clss)):
+            observed_hist[l] += np.histogram(obs[:, l], bins)[0]
+            pval_hist[l] += np.histogram(pval[:, l], pval_bins)[0]
+        ntests += pval.shape[0]
+
+        if thresholds:
+            keep = np.zeros(pval.shape[0], dtype=bool)
+            if max_pval is not None:
+                keep |= (pval <= max_pval).any(axis=1)
+            if min_tic is not None:
+                keep |= (obs >= min_tic).any(axis=1)
+            for l in range(len(clss)):
+                dropped_hist[l] += np.histogram(pval[~keep, l], bins)[0]
+            i, j, obs, pval = i[keep], j[keep], obs[keep], pval[keep]
+
+        if top_k is None:
+            nemitted += pval.shape[0]
+            write_pairs(i, j, obs, pval, header)
+            header = False
+        else:
+            # the pairs not kept are counted when all the tiles are done
+            for l in range(len(clss)):
+                dropped_hist[l] += np.histogram(pval[:, l], bins)[0]
+            top.add(i, j, obs, pval)
+
+    if top_k is not None:
+        i, j, obs, pval = top.pairs()
+        for l in range(len(clss)):
+            dropped_hist[l] -= np.histogram(pval[:, l], bins)[0]
+        nemitted += pval.shape[0]
+        write_pairs(i, j, obs, pval, header)
+
+    write_groups(groups, Y is not None)
+
+    with mictools.metrics.io("write", output_dir):
+        if output_format == 'binary':
+            obs_writer.close()
+            pval_writer.close()
+        else:
+            obs_handle.close()
+            pval_handle.close()
+
+        obs_dist = pd.concat([_obs_dist_df(h) for h in observed_hist], axis=0,
+                             keys=clss, names=["Class"])
+        obs_dist.to_csv(os.path.join(output_dir, "obs_dist.txt"), sep='\t',
+                        float_format="%.6f")
+        write_variables(os.path.join(output_dir, VARIABLES_FN), X, Y, meta)
+
+    if screen is not None:
+        # first tier TICe values of all the pairs, on the sample subsets
+        obs_dist_screen = pd.concat(
+            [_obs_dist_df(h) for h in screen_stats["screen_obs_hist"]],
+            axis=0, keys=clss, names=["Class"])
+        with mictools.metrics.io("write", output_dir):
+            obs_dist_screen.to_csv(
+                os.path.join(output_dir, "obs_dist_screen.txt"), sep='\t',
+                float_format="%.6f")
+        dropped_hist += screen_stats["dropped_hist"]
+        ntests += screen_stats["ndropped"]
+        pval_hist += screen_stats["dropped_hist"].reshape(
+            len(clss), PVAL_PLOT_BINS, -1).sum(axis=2)
+        _write_screen(screen_stats, clss, screen_pval, screen_target)
+
+    if sparse:
+        sys.stdout.write("{:d} of {:d} pairs written\n".format(
+            nemitted, ntests))
+        pval_dist = pd.concat([_pval_dist_df(h) for h in dropped_hist],
+                              axis=0, keys=clss, names=["Class"])
+        pval_dist.to_csv(os.path.join(output_dir, "pval_dist.txt"),
+                         sep='\t', float_format="%.6f")
+
+    for l, cl in enumerate(clss):
+        plot_pval_hist(pval_hist[l], cl, output_dir)
 
 
 def plot_pi0(pi0, pi0_lmb, lmb, pi0_smooth, output_fn):
@@ -185,10 +1256,74 @@ def plot_pi0(pi0, pi0_lmb, lmb, pi0_smooth, output_fn):
     fig.savefig(output_fn, bbox_inches='tight', dpi=300, format='png')
 
 
-def adjust_cmd(pval_fn, output_dir, method='qvalue'):
+def adjust_counts(counts_cls, clss, method, output_dir):
+    """Adjust the unique p-values of each class given their counts (a list
+    of (values, counts), see mictools.mtest.PValCounts). Return the list
+    of the adjusted values. With method='qvalue', the pi0 plots are saved
+    in output_dir.
+    """
+
+    values_adj_cls = []
+    for (values, counts), cl in zip(counts_cls, clss):
+        if method == 'qvalue':
+            values_adj_cl, pi0, pi0_lmb, lmb, pi0_smooth = \
+                mictools.mtest.qvalue_counts(values, counts)
+            output_plot_fn = os.path.join(output_dir, "pi0_{}.png".format(cl))
+            plot_pi0(pi0, pi0_lmb, lmb, pi0_smooth, output_plot_fn)
+        else:
+            values_adj_cl = mictools.mtest.multipletests_counts(
+                values, counts, method=method)
+        values_adj_cls.append(values_adj_cl)
+
+    return values_adj_cls
+
+
+def _iter_pval_chunks(pval_fn, results=None, chunk_size=1000000):
+    """Iterate over the p-values file (or the binary results) in chunks of
+    chunk_size pairs. Yield (rows, pval), where rows is the (Var1, Var2)
+    index (text) or the slice of the rows (binary) and pval is a float64
+    array (pairs x classes).
+    """
+
+    if results is not None:
+        for start in range(0, results["npairs"], chunk_size):
+            rows = slice(start, start+chunk_size)
+            with mictools.metrics.io("read", pval_fn):
+                pval = results["values"][:, rows].T.astype(np.float64)
+            yield rows, pval
+    else:
+        reader = pd.read_csv(pval_fn, sep='\t', index_col=[0, 1],
+                             dtype={"Var1": str, "Var2": str},
+                             chunksize=chunk_size)
+        while True:
+            with mictools.metrics.io("read", pval_fn):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            yield chunk.index, chunk.values.astype(np.float64)
+
 
-    pval = pd.read_csv(pval_fn, sep='\t', index_col=[0, 1])
-    pval_adj = pd.DataFrame(index=pval.index, columns=pval.columns)
+def adjust_cmd(pval_fn, output_dir, method='qvalue', chunk_size=1000000,
+               binned=False):
+
+    binary = mictools.results.is_results(pval_fn)
+    if binary:
+        results = mictools.results.read_results(pval_fn)
+        clss = results["classes"]
+    else:
+        results = None
+        header = pd.read_csv(pval_fn, sep='\t', index_col=[0, 1], nrows=0)
+        clss = header.columns
+
+    # sparse pval output (see pval --max-pval/--min-tic)
+    pval_dist_fn = os.path.join(
+        os.path.dirname(os.path.normpath(pval_fn)), "pval_dist.txt")
+    if os.path.isfile(pval_dist_fn):
+        sys.stdout.write("The p-values of the pairs not written in {} are "
+                         "read from {}\n".format(pval_fn, pval_dist_fn))
+        pval_dist = read_pval_dist(pval_dist_fn)
+    else:
+        pval_dist = None
     
     try:
         os.makedirs(output_dir)
@@ -198,14 +1333,57 @@ def adjust_cmd(pval_fn, output_dir, method='qvalue'):
                              format(output_dir))
             exit(1)
 
-    for cl in pval.columns:
-        if method == 'qvalue':
-            pval_adj[cl], pi0, pi0_lmb, lmb, pi0_smooth = \
-                mictools.mtest.qvalue(pval[cl])
-            output_plot_fn = os.path.join(output_dir, "pi0_{}.png".format(cl))
-            plot_pi0(pi0, pi0_lmb, lmb, pi0_smooth, output_plot_fn)
+    # first pass: the unique p-values of each class and their counts (on
+    # a fixed grid if binned, see mictools.mtest.PValCounts)
+    pval_counts_cls = [mictools.mtest.PValCounts(binned=binned)
+                       for cl in clss]
+    if pval_dist is not None:
+        for l, cl in enumerate(clss):
+            pval_counts_cls[l].add(*dropped_pval(pval_dist, cl))
+
+    for _, pval in _iter_pval_chunks(pval_fn, results, chunk_size):
+        for l in range(len(clss)):
+            mictools.metrics.tick("pvalues", pval.shape[0], clss[l])
+            pval_counts_cls[l].add(pval[:, l])
+
+    counts_cls = [pval_counts.counts() for pval_counts in pval_counts_cls]
+    for cl, pval_counts in zip(clss, pval_counts_cls):
+        if pval_counts.binned and not binned:
+            sys.stderr.write("warning: more than {:d} distinct p-values in "
+                             "the class {}, binned on a fixed grid (the "
+                             "adjusted p-values are conservative)\n".format(
+                                 pval_counts.max_unique, cl))
+    values_adj_cls = adjust_counts(counts_cls, clss, method, output_dir)
+
+    # second pass: the adjusted p-values are written chunk by chunk
+    if binary:
+        output_fn = os.path.join(output_dir, "pval_adj.bin")
+        writer = mictools.results.ResultsWriter(
+            output_fn, results["names"], clss, npairs=results["npairs"],
+            float_format='%e', condensed=results["condensed"])
+    else:
+        output_fn = os.path.join(output_dir, "pval_adj.txt")
+        output_handle = open(output_fn, 'w')
+        header.to_csv(output_handle, sep='\t')
+
+    for rows, pval in _iter_pval_chunks(pval_fn, results, chunk_size):
+        pval_adj = np.empty_like(pval)
+        for l in range(len(clss)):
+            pval_adj[:, l] = mictools.mtest.map_counts(
+                pval[:, l], counts_cls[l][0], values_adj_cls[l])
+
+        with mictools.metrics.io("write", output_fn):
+            if binary:
+                var1, var2 = (None, None) if results["condensed"] else \
+                    (results["var1"][rows], results["var2"][rows])
+                writer.write(var1, var2, pval_adj)
+            else:
+                pd.DataFrame(pval_adj, index=rows, columns=clss).to_csv(
+                    output_handle, sep='\t', float_format='%e',
+                    header=False)
+
+    with mictools.metrics.io("write", output_fn):
+        if binary:
+            writer.close()
         else:
-            pval_adj[cl] = mictools.mtest.multipletests(pval[cl], method=method)
-    
-    output_fn = os.path.join(output_dir, "pval_adj.txt")
-    pval_adj.to_csv(output_fn, sep='\t', float_format='%e')
\ No newline at end of file
+            output_handle.close()
@@ -0,0 +1,263 @@
+##    Copyright 2017 MICtools Developers <davide.albanese@gmail.com>
+
+##    This file is part of MICtools.
+##
+##    MICtools is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    MICtools is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Binary results format.
+
+A results file (e.g. pval.bin) is a directory containing:
+
+* meta.json: format version, classes, number of pairs, float format used
+  when converting to TSV;
+* names.txt: the variable names, one per line (X variables followed by the
+  Y variables, if any);
+* var1.npy, var2.npy: the pair indices into names.txt. When all the pairs
+  of the X variables are stored in the condensed order (see
+  mictools.utils.condensed_index()), the indices are implicit and these
+  files are not written;
+* values.npy: float32 array (nclasses x npairs), one contiguous row per
+  class.
+
+The .npy files can be memory-mapped (see read_results()).
+"""
+
+import os
+import os.path
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import mictools.utils
+
+
+RESULTS_FORMAT = "mictools-results"
+RESULTS_VERSION = 1
+
+
+def is_results(path):
+    """Return True if path is a binary results directory.
+    """
+
+    meta_fn = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_fn):
+        return False
+
+    with open(meta_fn) as meta_handle:
+        return json.load(meta_handle).get("format") == RESULTS_FORMAT
+
+
+class ResultsWriter(object):
+    """Write a binary results directory incrementally. If npairs is known
+    in advance, the arrays are filled in place. Otherwise the data are
+    appended to temporary files and the .npy files are built by close().
+    If condensed is the number of X variables m, the m*(m-1)/2 pairs are
+    written in the condensed order and the pair indices are not stored.
+    """
+
+    def __init__(self, path, names, classes, npairs=None,
+                 float_format='%e', condensed=None):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+        self.path = path
+        self.classes = list(classes)
+        self.npairs = npairs
+        self.float_format = float_format
+        self.condensed = condensed
+        self.index_dtype = np.int32 if len(names) < 2**31 else np.int64
+        self.n = 0
+
+        with open(os.path.join(path, "names.txt"), 'w') as names_handle:
+            for name in names:
+                names_handle.write("{}\n".format(name))
+
+        self.var_keys = [] if condensed else ["var1", "var2"]
+
+        if condensed is not None:
+            npairs_cond = condensed * (condensed - 1) // 2
+            if npairs not in (None, npairs_cond):
+                raise ValueError("condensed results must contain all the "
+                                 "{:d} pairs".format(npairs_cond))
+            self.npairs = npairs = npairs_cond
+
+        if npairs is None:
+            self.handles = [open(self._fn(key) + ".tmp", 'wb')
+                            for key in self.var_keys]
+            self.handles += [open(self._fn("values") + ".{:d}.tmp".format(l),
+                                  'wb') for l in range(len(self.classes))]
+        else:
+            self.vars = [self._open_memmap(key, self.index_dtype, (npairs, ))
+                         for key in self.var_keys]
+            self.values = self._open_memmap(
+                "values", np.float32, (len(self.classes), npairs))
+
+    def _fn(self, key):
+        return os.path.join(self.path, key + ".npy")
+
+    def _open_memmap(self, key, dtype, shape):
+        return np.lib.format.open_memmap(self._fn(key), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def write(self, i, j, values):
+        """Append the pairs (i, j) and their values (npairs x nclasses). i
+        and j are ignored (and can be None) for condensed results.
+        """
+
+        values = np.asarray(values, dtype=np.float32)
+        n = values.shape[0]
+        pairs = [] if self.condensed else \
+            [np.asarray(i, dtype=self.index_dtype),
+             np.asarray(j, dtype=self.index_dtype)]
+
+        if self.npairs is None:
+            for handle, var in zip(self.handles, pairs):
+                handle.write(var.tobytes())
+            for l in range(len(self.classes)):
+                self.handles[len(pairs)+l].write(
+                    np.ascontiguousarray(values[:, l]).tobytes())
+        else:
+            for mm, var in zip(self.vars, pairs):
+                mm[self.n:self.n+n] = var
+            self.values[:, self.n:self.n+n] = values.T
+
+        self.n += n
+
+    def _build_npy(self, key, tmp_fns, dtype, shape):
+        with open(self._fn(key), 'wb') as npy_handle:
+            np.lib.format.write_array_header_1_0(
+                npy_handle, {'descr': np.lib.format.dtype_to_descr(
+                    np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+            for tmp_fn in tmp_fns:
+                with open(tmp_fn, 'rb') as tmp_handle:
+                    shutil.copyfileobj(tmp_handle, npy_handle)
+                os.remove(tmp_fn)
+
+    def close(self):
+        if self.npairs is None:
+            for handle in self.handles:
+                handle.close()
+            for key in self.var_keys:
+                self._build_npy(key, [self._fn(key) + ".tmp"],
+                                self.index_dtype, (self.n, ))
+            self._build_npy("values", [self._fn("values") + \
+                                       ".{:d}.tmp".format(l)
+                                       for l in range(len(self.classes))],
+                            np.float32, (len(self.classes), self.n))
+        else:
+            if self.n != self.npairs:
+                raise ValueError("{:d} pairs written, {:d} expected".\
+                                 format(self.n, self.npairs))
+            del self.vars, self.values
+
+        meta = {"format": RESULTS_FORMAT, "version": RESULTS_VERSION,
+                "classes": self.classes, "npairs": self.n,
+                "float_format": self.float_format,
+                "condensed": self.condensed}
+        with open(os.path.join(self.path, "meta.json"), 'w') as meta_handle:
+            json.dump(meta, meta_handle, indent=1)
+
+
+def read_results(path, mmap=True):
+    """Read a binary results directory. Return a dictionary with keys
+    'names', 'classes', 'npairs', 'condensed', 'var1' and 'var2' (if not
+    condensed, see results_pairs()), 'values' (nclasses x npairs) and
+    'float_format'. The arrays are memory-mapped if mmap is True.
+    """
+
+    with open(os.path.join(path, "meta.json")) as meta_handle:
+        meta = json.load(meta_handle)
+
+    if meta.get("format") != RESULTS_FORMAT:
+        raise ValueError("{} is not a binary results directory".format(path))
+
+    if meta["version"] > RESULTS_VERSION:
+        raise ValueError("unsupported binary results version {}".\
+                         format(meta["version"]))
+
+    with open(os.path.join(path, "names.txt")) as names_handle:
+        names = np.asarray([line.rstrip('\n') for line in names_handle],
+                           dtype=object)
+
+    mmap_mode = 'r' if mmap else None
+    results = {"names": names, "classes": meta["classes"],
+               "npairs": meta["npairs"], "float_format": meta["float_format"],
+               "condensed": meta.get("condensed")}
+    keys = ["values"] if results["condensed"] else ["var1", "var2", "values"]
+    for key in keys:
+        results[key] = np.load(os.path.join(path, key + ".npy"),
+                               mmap_mode=mmap_mode)
+
+    return results
+
+
+def results_to_frame(results, rows=slice(None)):
+    """Return the rows (a slice or an array of indices) of the results as a
+    DataFrame indexed by (Var1, Var2), with one column per class.
+    """
+
+    names = results["names"]
+    var1, var2 = results_pairs(results, rows)
+    index = pd.MultiIndex.from_arrays([names[var1], names[var2]],
+                                      names=['Var1', 'Var2'])
+
+    return pd.DataFrame(results["values"][:, rows].T, index=index,
+                        columns=results["classes"])
+
+
+def results_pairs(results, rows=slice(None)):
+    """Return the pair indices (var1, var2) of the rows (a slice or an array
+    of indices). For condensed results they are computed arithmetically.
+    """
+
+    if results["condensed"]:
+        k = np.arange(results["npairs"])[rows]
+        return mictools.utils.condensed_pairs(k, results["condensed"])
+    else:
+        return results["var1"][rows], results["var2"][rows]
+
+
+def results_below(results, t, chunk_size=1000000):
+    """Return the indices of the rows with at least one value < t.
+    """
+
+    npairs = results["npairs"]
+    rows = [start + np.flatnonzero(
+        (results["values"][:, start:start+chunk_size] < t).any(axis=0))
+            for start in range(0, npairs, chunk_size)]
+
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+
+def results_to_tsv(path, output_fn, chunk_size=1000000):
+    """Convert a binary results directory to a TSV file, in the same format
+    of the pval subcommand text outputs.
+    """
+
+    results = read_results(path)
+    npairs = results["npairs"]
+
+    with open(output_fn, 'w') as output_handle:
+        if npairs == 0:
+            results_to_frame(results).to_csv(output_handle, sep='\t')
+        for start in range(0, npairs, chunk_size):
+            frame = results_to_frame(results, slice(start, start+chunk_size))
+            frame.to_csv(output_handle, sep='\t', header=(start == 0),
+                         float_format=results["float_format"])
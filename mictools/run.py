@@ -0,0 +1,224 @@
+##    Copyright 2017 MICtools Developers <davide.albanese@gmail.com>
+
+##    This file is part of MICtools.
+##
+##    MICtools is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    MICtools is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""End-to-end pipeline (null, pval, adjust and strength) in a single
+process. The data are read once, the per-class data are shared by the
+stages and the intermediate results are kept in memory: of the pairs, only
+the indices and the (float32) p-values.
+"""
+
+import os
+import os.path
+import sys
+
+import numpy as np
+import pandas as pd
+
+from mictools import NULL_HIST_RES
+import mictools.utils
+import mictools.null
+import mictools.pval
+import mictools.mtest
+import mictools.strength
+import mictools.metrics
+
+
+def run_pval(X, null_dist, labels=None, Y=None, single=False, B=9, c=5,
+             tail=None, tile_size=1000000, jobs=1, class_data=None,
+             output_dir=None, groups=None):
+    """Compute the TICe values and the p-values of all the pairs, keeping
+    only what the next stages need. Return the pair indices i, j (into X
+    and Y, or X), the p-values as float32 (pairs x classes) and the
+    histogram of the TICe values of each class (classes x NULL_HIST_RES
+    bins). If output_dir is provided, the TICe values and the p-values are
+    also written to obs.txt and pval.txt, tile by tile. groups is updated
+    as in mictools.pval.iter_pval().
+    """
+
+    k = None if Y is None else Y.shape[0]
+    clss = ['None'] if labels is None else sorted(labels.unique())
+    n = mictools.pval.npairs(X.shape[0], k, single=single)
+    i_all = np.empty(n, dtype=np.int32)
+    j_all = np.empty(n, dtype=np.int32)
+    pval_all = np.empty((n, len(clss)), dtype=np.float32)
+    bins = np.linspace(0, 1, NULL_HIST_RES+1)
+    observed_hist = np.zeros((len(clss), NULL_HIST_RES), dtype=np.int64)
+
+    if output_dir is not None:
+        Z = X if Y is None else Y
+        obs_handle = open(os.path.join(output_dir, "obs.txt"), 'w')
+        pval_handle = open(os.path.join(output_dir, "pval.txt"), 'w')
+
+    start = 0
+    for i, j, obs, pval in mictools.pval.iter_pval(X=X,
+                                                   null_dist=null_dist,
+                                                   labels=labels,
+                                                   Y=Y,
+                                                   single=single,
+                                                   B=B,
+                                                   c=c,
+                                                   tail=tail,
+                                                   tile_size=tile_size,
+                                                   jobs=jobs,
+                                                   class_data=class_data,
+                                                   groups=groups):
+        stop = start + i.shape[0]
+        i_all[start:stop], j_all[start:stop] = i, j
+        pval_all[start:stop] = pval
+        for l in range(len(clss)):
+            observed_hist[l] += np.histogram(obs[:, l], bins)[0]
+        if output_dir is not None:
+            index = mictools.pval.pair_index(X.index, Z.index, i, j)
+            for values, handle, float_format in \
+                [(obs, obs_handle, '%.6f'), (pval, pval_handle, '%e')]:
+                pd.DataFrame(values, index=index, columns=clss).to_csv(
+                    handle, sep='\t', float_format=float_format,
+                    header=(start == 0))
+        start = stop
+
+    if output_dir is not None:
+        obs_handle.close()
+        pval_handle.close()
+
+    return i_all, j_all, pval_all, observed_hist
+
+
+def run_adjust(pval, clss, method='qvalue', output_dir='.'):
+    """Adjust the p-values (pairs x classes) of each class.
+    """
+
+    for cl in clss:
+        mictools.metrics.tick("pvalues", pval.shape[0], cl)
+    counts_cls = [mictools.mtest.pval_counts(pval[:, l])
+                  for l in range(len(clss))]
+    values_adj_cls = mictools.pval.adjust_counts(counts_cls, clss, method,
+                                                 output_dir)
+
+    pval_adj = np.empty_like(pval)
+    for l in range(len(clss)):
+        pval_adj[:, l] = mictools.mtest.map_counts(
+            pval[:, l], counts_cls[l][0], values_adj_cls[l])
+
+    return pval_adj
+
+
+def _write_pairs(values, index, clss, output_fn, float_format):
+    pd.DataFrame(values, index=index, columns=clss).to_csv(
+        output_fn, sep='\t', float_format=float_format)
+
+
+def run_cmd(xvars_fn, output_dir, labels_fn=None, target=None, yvars_fn=None,
+            rowwise=False, nperm=200000, seed=0, grid=9, clumps=5, jobs=1,
+            batch=1, tail=False, tail_quantile=0.99, cache_dir=None,
+            tile_size=1000000, method='qvalue', t=0.05, alpha=None,
+            intermediates=False):
+
+    X, labels, Y = mictools.utils.read_data(xvars_fn, labels_fn, target,
+                                            yvars_fn)
+
+    # classes and per-class data, shared by all the stages
+    try:
+        mictools.utils.check_data(X, labels=labels, Y=Y)
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        exit(1)
+    class_data = mictools.utils.class_data(X, labels=labels, Y=Y)
+    clss = class_data[0]
+
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        if not os.path.isdir(output_dir):
+            sys.stderr.write("directory {} cannot be created\n".\
+                             format(output_dir))
+            exit(1)
+
+    # null distribution
+    sys.stdout.write("Computing the null distribution...\n")
+    try:
+        with mictools.metrics.stage("null"):
+            null_dist = mictools.null.compute_null(X=X,
+                                                   labels=labels,
+                                                   Y=Y,
+                                                   rowwise=rowwise,
+                                                   B=grid,
+                                                   c=clumps,
+                                                   nperm=nperm,
+                                                   seed=seed,
+                                                   jobs=jobs,
+                                                   batch=batch,
+                                                   cache_dir=cache_dir,
+                                                   class_data=class_data)
+            tail_df = mictools.null.compute_tail(null_dist,
+                                                 q=tail_quantile) \
+                if tail else None
+    except ValueError as e:
+        sys.stderr.write("{}\n".format(e))
+        exit(1)
+
+    if intermediates:
+        null_fn = os.path.join(output_dir, "null_dist.txt")
+        meta = {"B": grid, "c": clumps, "seed": seed, "jobs": jobs,
+                "batch": batch, "rowwise": rowwise}
+        mictools.null.write_null(null_dist, null_fn, meta)
+        if tail:
+            mictools.null.write_tail(tail_df,
+                                     mictools.null.tail_filename(null_fn))
+
+    # p-values
+    sys.stdout.write("Computing the p-values...\n")
+    groups = {}
+    with mictools.metrics.stage("pval"):
+        i, j, pval, observed_hist = run_pval(
+            X=X, null_dist=null_dist, labels=labels, Y=Y, single=rowwise,
+            B=grid, c=clumps, tail=tail_df, tile_size=tile_size, jobs=jobs,
+            class_data=class_data,
+            output_dir=output_dir if intermediates else None, groups=groups)
+    mictools.pval.write_groups(groups, Y is not None)
+
+    # multiple testing correction
+    sys.stdout.write("Multiple testing correction ({})...\n".format(method))
+    with mictools.metrics.stage("adjust"):
+        pval_adj = run_adjust(pval, clss, method=method,
+                              output_dir=output_dir)
+
+    Z = X if Y is None else Y
+    if intermediates:
+        obs_dist = pd.concat(
+            [mictools.pval._obs_dist_df(h) for h in observed_hist], axis=0,
+            keys=clss, names=["Class"])
+        obs_dist.to_csv(os.path.join(output_dir, "obs_dist.txt"), sep='\t',
+                        float_format="%.6f")
+
+        index = mictools.pval.pair_index(X.index, Z.index, i, j)
+        _write_pairs(pval_adj, index, clss,
+                     os.path.join(output_dir, "pval_adj.txt"), '%e')
+        mictools.pval.plot_pval(pd.DataFrame(pval, columns=clss), output_dir)
+
+    # strength of the significant pairs only
+    sys.stdout.write("Computing the strength...\n")
+    sig = (pval_adj < t).any(axis=1)
+    pval_sig = pd.DataFrame(
+        pval_adj[sig], columns=clss,
+        index=mictools.pval.pair_index(X.index, Z.index, i[sig], j[sig]))
+    with mictools.metrics.stage("strength"):
+        mictools.strength.compute_strength(
+            X=X, pval=pval_sig,
+            output_fn=os.path.join(output_dir, "strength.txt"),
+            labels=labels, Y=Y, t=t, alpha=alpha, c=clumps, jobs=jobs,
+            ordered=True, class_data=class_data)
@@ -20,13 +20,17 @@ import sys
 import os
 import os.path
 import csv
+import multiprocessing
 
+import click
 import numpy as np
 import pandas as pd
 import scipy.stats
 
 import minepy
 import mictools.utils
+import mictools.results
+import mictools.metrics
 
 
 NPOINTS_BINS = [1,    25,   50,   250,   500, 1000, 2500, 5000, 10000, 40000]
@@ -40,8 +44,98 @@ def compute_alpha(npoints):
     return ALPHAS[np.digitize([npoints], NPOINTS_BINS)[0] - 1]
 
 
+def _unit_rows(A):
+    """Center the rows of A and scale them to unit norm, so that the Pearson
+    correlation between two rows is their dot product. Constant rows are
+    set to NaN.
+    """
+
+    A = A - A.mean(axis=1, keepdims=True)
+    norm = np.sqrt(np.einsum('ij,ij->i', A, A))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        A /= norm[:, np.newaxis]
+    A[norm == 0] = np.nan
+
+    return A
+
+
+def _correlation_rows(A):
+    """Return the unit rows (see _unit_rows()) of A and of its ranks, for the
+    Pearson and the Spearman correlation respectively.
+    """
+
+    A = np.asarray(A, dtype=np.float64)
+    ranks = np.apply_along_axis(scipy.stats.rankdata, 1, A) \
+        if A.shape[0] and A.shape[1] else A
+
+    return _unit_rows(A), _unit_rows(ranks)
+
+
+_strength_data = {}
+
+
+def _strength_init(data):
+    _strength_data.update(data)
+
+
+def _strength_chunk(chunk):
+    """Compute the output rows of the pairs [a, b) in the class l. If the
+    pair k has the same MIC_e of a previous pair first[k] (see
+    compute_strength()) not in the chunk, its MIC_e is left to None.
+    """
+
+    l, a, b = chunk
+    d = _strength_data
+    cl, X_cl, Z_cl, p_cl = d["clss"][l], d["X"][l], d["Z"][l], d["pval"][l]
+    var1_idx, var2_idx = d["var1_idx"][a:b], d["var2_idx"][a:b]
+    first, constant = d["first"][l], d["constant"][l]
+    mine = minepy.MINE(alpha=d["alpha"][l], c=d["c"], est="mic_e")
+
+    # Pearson and Spearman coefficients as batched dot products
+    R = np.einsum('ij,ij->i', d["Xp"][l][var1_idx], d["Zp"][l][var2_idx])
+    rho = np.einsum('ij,ij->i', d["Xs"][l][var1_idx], d["Zs"][l][var2_idx])
+    R, rho = np.clip(R, -1, 1), np.clip(rho, -1, 1)
+
+    rows = []
+    for k in range(a, b):
+        if first is None:
+            mine.compute_score(X_cl[var1_idx[k-a]], Z_cl[var2_idx[k-a]])
+            mic = "{:.6f}".format(mine.mic())
+        elif constant[k]:
+            mic = "{:.6f}".format(0.0)
+        elif first[k] < a:
+            mic = None
+        elif first[k] < k:
+            mic = rows[first[k]-a][-1]
+        else:
+            mine.compute_score(X_cl[var1_idx[k-a]], Z_cl[var2_idx[k-a]])
+            mic = "{:.6f}".format(mine.mic())
+
+        rows.append([cl,
+                     d["var1"][k],
+                     d["var2"][k],
+                     "{:e}".format(p_cl[k]),
+                     "{:.6f}".format(R[k-a]),
+                     "{:.6f}".format(rho[k-a]),
+                     mic])
+
+    return l, a, rows
+
+
 def compute_strength(X, pval, output_fn, labels=None, Y=None, t=0.05,
-                     alpha=None, c=5):
+                     alpha=None, c=5, jobs=1, ordered=False,
+                     chunk_size=1000, class_data=None):
+    """Compute MIC_e, Pearson and Spearman coefficients of the pairs with at
+    least one p-value < t, in each class. The (class, pairs) chunks are
+    processed by jobs worker processes and the rows are written as soon as
+    they are computed. With jobs > 1 the order of the rows is the one of
+    the serial computation only if ordered is True.
+
+    MIC_e is computed once for the pairs of rank-equivalent variables (see
+    mictools.utils.pair_groups()) and is 0 for the pairs with a constant
+    variable. class_data can be precomputed with
+    mictools.utils.class_data().
+    """
 
     mictools.utils.check_data(X, labels=labels, Y=Y)
 
@@ -49,11 +143,80 @@ def compute_strength(X, pval, output_fn, labels=None, Y=None, t=0.05,
         labels = pd.Series('None', index=X.columns)
 
     # compute MIC_e for pairs with at least one p-value < t
-    index = pval.index[(pval < t).sum(axis=1) > 0]
-  
+    keep_pairs = ((pval < t).sum(axis=1) > 0).values
+    index = pval.index[keep_pairs]
+    pval_values = pval.values[keep_pairs]
+
+    # resolve the pair names to row positions once
+    Z = X if Y is None else Y
+    var1_idx = X.index.get_indexer(index.get_level_values(0))
+    var2_idx = Z.index.get_indexer(index.get_level_values(1))
+    if (var1_idx < 0).any() or (var2_idx < 0).any():
+        raise ValueError("the p-values contain variables not in the input "
+                         "data")
+
     if alpha is None:
         sys.stdout.write("Automatically chosen alphas:\n")
 
+    # per-class views of a single class-sorted buffer
+    if class_data is None:
+        class_data = mictools.utils.class_data(X, labels=labels, Y=Y)
+    clss, columns, X_cls, Y_cls = class_data
+    Z_cls = X_cls if Y is None else Y_cls
+    data = {"clss": clss, "c": c, "var1_idx": var1_idx, "var2_idx": var2_idx,
+            "var1": index.get_level_values(0).values,
+            "var2": index.get_level_values(1).values,
+            "X": [], "Z": [], "pval": [], "alpha": [], "Xp": [], "Zp": [],
+            "Xs": [], "Zs": [], "first": [], "constant": []}
+    has_dep = []
+    for l, cl in enumerate(clss):
+        X_cl, Z_cl = X_cls[l], Z_cls[l]
+        data["X"].append(X_cl)
+        data["Z"].append(Z_cl)
+
+        # unit rows for the correlations, computed once per class
+        Xp_cl, Xs_cl = _correlation_rows(X_cl)
+        Zp_cl, Zs_cl = (Xp_cl, Xs_cl) if Y is None else \
+            _correlation_rows(Z_cl)
+        data["Xp"].append(Xp_cl)
+        data["Zp"].append(Zp_cl)
+        data["Xs"].append(Xs_cl)
+        data["Zs"].append(Zs_cl)
+        data["pval"].append(pval_values[:, pval.columns.get_loc(cl)])
+
+        # first pair with the same representative variables (same MIC_e)
+        groups = mictools.utils.pair_groups(X_cl, None if Y is None else Z_cl)
+        if groups is None:
+            first_cl, constant_cl, has_dep_cl = None, None, None
+        else:
+            rep1, rep2 = groups[0][var1_idx], groups[2][var2_idx]
+            constant_cl = groups[1][rep1] | groups[3][rep2]
+            _, first_unique, inverse = np.unique(
+                rep1.astype(np.int64) * Z_cl.shape[0] + rep2,
+                return_index=True, return_inverse=True)
+            first_cl = first_unique[inverse.reshape(-1)]
+            has_dep_cl = np.bincount(first_cl, minlength=first_cl.shape[0]) \
+                > 1
+        data["first"].append(first_cl)
+        data["constant"].append(constant_cl)
+        has_dep.append(has_dep_cl)
+
+        if alpha is None:
+            alpha_cl = compute_alpha(X_cl.shape[1])
+            sys.stdout.write("* {}: {:f}\n".format(cl, alpha_cl))
+        else:
+            alpha_cl = alpha
+        data["alpha"].append(alpha_cl)
+
+    npairs = index.shape[0]
+    chunk_size = mictools.utils.balanced_chunk_size(npairs*len(clss),
+                                                    chunk_size, jobs)
+    # without ordering, the classes with more samples are computed first
+    order = range(len(clss)) if (ordered or jobs == 1) else \
+        mictools.utils.class_order(columns)
+    chunks = [(l, a, min(a+chunk_size, npairs)) for l in order
+              for a in range(0, npairs, chunk_size)]
+
     strength_handle = open(output_fn, 'w')
     strength_writer = csv.writer(strength_handle, delimiter='\t',
                                  lineterminator='\n')
@@ -62,58 +225,77 @@ def compute_strength(X, pval, output_fn, labels=None, Y=None, t=0.05,
 
     strength_writer.writerow(header)
 
-    clss = sorted(labels.unique())
-    for cl in clss:
-        keep = (cl == labels)
-        X_cl = X.loc[:, keep]
+    serial = (jobs == 1) or (len(chunks) <= 1)
+    if serial:
+        _strength_init(data)
+        results = map(_strength_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(jobs, _strength_init, (data, ))
+        imap = pool.imap if ordered else pool.imap_unordered
+        results = imap(_strength_chunk, chunks)
 
-        if Y is not None:
-            Y_cl = Y.loc[:, keep]
-
-        if alpha is None:
-            alpha_cl = compute_alpha(X_cl.shape[1])
-            sys.stdout.write("* {}: {:f}\n".format(cl, alpha_cl))
+    mictools.metrics.set_total("pairs", npairs * len(clss))
+    # the counters are reported also when no pair is significant
+    for cl in clss:
+        mictools.metrics.tick("pairs", 0, cl)
+    # MIC_e of the pairs with dependent pairs in other chunks and the rows
+    # waiting for it (unordered chunks only)
+    mic_first, pending = {}, {}
+    try:
+        for l, a, rows in results:
+            mictools.metrics.tick("pairs", len(rows), clss[l])
+            first, resolved = data["first"][l], []
+            if first is not None:
+                for k, row in enumerate(rows, a):
+                    if row[-1] is None:
+                        row[-1] = mic_first.get((l, first[k]))
+                        if row[-1] is None:
+                            pending.setdefault((l, first[k]), []).append(row)
+                    elif has_dep[l][k]:
+                        mic_first[(l, k)] = row[-1]
+                        for row_p in pending.pop((l, k), []):
+                            row_p[-1] = row[-1]
+                            resolved.append(row_p)
+                rows = [row for row in rows if row[-1] is not None]
+            with mictools.metrics.io("write", output_fn):
+                strength_writer.writerows(rows + resolved)
+    finally:
+        if serial:
+            _strength_data.clear()
         else:
-            alpha_cl = alpha
-        
-        mine = minepy.MINE(alpha=alpha_cl, c=c, est="mic_e")
-
-        for var1, var2 in index:
-            x = X_cl.loc[var1]
-            y = X_cl.loc[var2] if Y is None else Y_cl.loc[var2]
-            mine.compute_score(x, y)
-            mic = mine.mic()
-            p = pval.loc[(var1, var2), cl]
-            R, _ = scipy.stats.pearsonr(x, y)
-            rho, _ = scipy.stats.spearmanr(x, y)
-
-            row = [cl,
-                   var1,
-                   var2,
-                   "{:e}".format(p),
-                   "{:.6f}".format(R),
-                   "{:.6f}".format(rho),
-                   "{:.6f}".format(mic)]
-
-            strength_writer.writerow(row)
+            pool.terminate()
 
     strength_handle.close()
 
 
 def strength_cmd(xvars_fn, pval_fn, output_fn, labels_fn=None, target=None,
-                 yvars_fn=None, t=0.05, alpha=None, clumps=5):
+                 yvars_fn=None, t=0.05, alpha=None, clumps=5, jobs=1,
+                 ordered=False):
 
     X, labels, Y = mictools.utils.read_data(xvars_fn, labels_fn, target,
                                             yvars_fn)
 
-    pval = pd.read_csv(pval_fn, sep='\t', dtype={"Var1": str, "Var2": str})
-    pval.set_index(["Var1", "Var2"], inplace=True)
-   
-    compute_strength(X=X,
-                     pval=pval,
-                     output_fn=output_fn,
-                     labels=labels, 
-                     Y=Y,
-                     t=t,
-                     alpha=alpha,
-                     c=clumps)
+    if mictools.results.is_results(pval_fn):
+        # only the pairs with at least one p-value < t are loaded
+        results = mictools.results.read_results(pval_fn)
+        rows = mictools.results.results_below(results, t)
+        pval = mictools.results.results_to_frame(results, rows).\
+            astype(np.float64)
+    else:
+        pval = pd.read_csv(pval_fn, sep='\t', dtype={"Var1": str,
+                                                     "Var2": str})
+        pval.set_index(["Var1", "Var2"], inplace=True)
+
+    try:
+        compute_strength(X=X,
+                         pval=pval,
+                         output_fn=output_fn,
+                         labels=labels,
+                         Y=Y,
+                         t=t,
+                         alpha=alpha,
+                         c=clumps,
+                         jobs=jobs,
+                         ordered=ordered)
+    except ValueError as e:
+        raise click.ClickException(str(e))
@@ -16,28 +16,244 @@
 ##    along with MICtools. If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import os.path
+import sys
+import json
+import hashlib
+import multiprocessing
+
 import numpy as np
 import pandas as pd
 
 import minepy
+import mictools.metrics
+
+
+_sstats_data = {}
+
+
+def balanced_chunk_size(n, size, jobs):
+    """Return the chunk size to split n items among jobs worker processes,
+    at most size.
+    """
+
+    if jobs > 1:
+        # at least 4 chunks per job to balance the load
+        size = max(1, min(size, -(-n // (4*jobs))))
+
+    return size
+
+
+def _sstats_init(Xa, Ya, alpha, c, est):
+    _sstats_data.update(Xa=Xa, Ya=Ya, alpha=alpha, c=c, est=est)
+
+
+def _sstats_chunk(chunk):
+    a, b = chunk
+    d = _sstats_data
+    mic = np.empty(b-a, dtype=np.float64)
+    tic = np.empty(b-a, dtype=np.float64)
+    mine = minepy.MINE(alpha=d["alpha"], c=d["c"], est=d["est"])
+    for i in range(a, b):
+        mine.compute_score(d["Xa"][i], d["Ya"][i])
+        mic[i-a] = mine.mic()
+        tic[i-a] = mine.tic(norm=True)
+
+    return a, mic, tic
+
+
+def sstats(X, Y, alpha=0.6, c=15, est="mic_approx", jobs=1,
+           chunk_size=1000):
+    """Compute MIC and normalized TIC between the rows X[i] and Y[i], for
+    i < min(X.shape[0], Y.shape[0]). With jobs > 1, chunks of (at most)
+    chunk_size rows are processed by jobs worker processes.
+    """
 
+    if jobs < 1:
+        raise ValueError("the number of jobs must be >=1")
 
-def sstats(X, Y, alpha=0.6, c=15, est="mic_approx"):
-    mic, tic = [], []
-    mine = minepy.MINE(alpha=alpha, c=c, est=est)
-    for i in range(min(X.shape[0], Y.shape[0])):
-        mine.compute_score(X[i], Y[i])
-        mic.append(mine.mic())
-        tic.append(mine.tic(norm=True))
-    mic, tic = np.asarray(mic), np.asarray(tic)
+    if chunk_size < 1:
+        raise ValueError("the chunk size must be >=1")
+
+    Xa = np.ascontiguousarray(X, dtype=np.float64)
+    Ya = np.ascontiguousarray(Y, dtype=np.float64)
+    n = min(Xa.shape[0], Ya.shape[0])
+    mic = np.empty(n, dtype=np.float64)
+    tic = np.empty(n, dtype=np.float64)
+
+    chunk_size = balanced_chunk_size(n, chunk_size, jobs)
+    chunks = [(a, min(a+chunk_size, n)) for a in range(0, n, chunk_size)]
+    initargs = (Xa, Ya, alpha, c, est)
+
+    serial = (jobs == 1) or (len(chunks) <= 1)
+    if serial:
+        _sstats_init(*initargs)
+        results = map(_sstats_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(jobs, _sstats_init, initargs)
+        results = pool.imap_unordered(_sstats_chunk, chunks)
+
+    # the chunks are written into the preallocated arrays as they complete
+    try:
+        for a, mic_chunk, tic_chunk in results:
+            mic[a:a+mic_chunk.shape[0]] = mic_chunk
+            tic[a:a+tic_chunk.shape[0]] = tic_chunk
+    finally:
+        if serial:
+            _sstats_data.clear()
+        else:
+            pool.terminate()
 
     return mic, tic
 
 
-def read_table(input_fn):
-    """Read table.
+def class_columns(labels):
+    """Return the sorted classes and, for each class, the positions of its
+    samples (columns), computed once and shared by all the stages.
     """
-    
+
+    labels_arr = np.asarray(labels)
+    clss = sorted(pd.unique(labels_arr))
+
+    return clss, [np.flatnonzero(labels_arr == cl) for cl in clss]
+
+
+def class_views(A, columns):
+    """Copy the columns of A into a single buffer, class by class (see
+    class_columns()), and return the C-contiguous per-class views
+    A[:, columns[l]] of the buffer. Row slices of the views are zero-copy
+    inputs for minepy.
+    """
+
+    A = np.asarray(A, dtype=np.float64)
+    sizes = [A.shape[0] * cols.shape[0] for cols in columns]
+    buf = np.empty(sum(sizes), dtype=np.float64)
+
+    views, start = [], 0
+    for cols, size in zip(columns, sizes):
+        view = buf[start:start+size].reshape(A.shape[0], cols.shape[0])
+        np.take(A, cols, axis=1, out=view)
+        views.append(view)
+        start += size
+
+    return views
+
+
+def class_data(X, labels=None, Y=None):
+    """Return the sorted classes, the positions of their samples (see
+    class_columns()) and the per-class views of X and Y (see class_views(),
+    a list of None if Y is None). The result can be computed once and
+    passed to the stages as class_data (see e.g.
+    mictools.null.compute_null()).
+    """
+
+    if labels is None:
+        labels = pd.Series('None', index=X.columns)
+
+    clss, columns = class_columns(labels)
+    Xa_cls = class_views(X.values, columns)
+    Ya_cls = [None] * len(clss) if Y is None else \
+        class_views(Y.values, columns)
+
+    return clss, columns, Xa_cls, Ya_cls
+
+
+def class_order(columns):
+    """Return the class positions sorted by decreasing number of samples, to
+    schedule the most expensive classes first.
+    """
+
+    return sorted(range(len(columns)), key=lambda l: -columns[l].shape[0])
+
+
+def dense_ranks(A):
+    """Return the dense ranks (1, 2, ..., ties share the same rank) of each
+    row of A.
+    """
+
+    A = np.asarray(A)
+    order = np.argsort(A, axis=1, kind='mergesort')
+    A_sorted = np.take_along_axis(A, order, axis=1)
+    new = np.ones(A.shape, dtype=bool)
+    new[:, 1:] = A_sorted[:, 1:] != A_sorted[:, :-1]
+    ranks = np.empty(A.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.cumsum(new, axis=1), axis=1)
+
+    return ranks
+
+
+def row_groups(A):
+    """Group the rank-equivalent rows of A, i.e. rows which are monotone
+    (increasing) transformations of each other and therefore have the same
+    MIC_e and TIC_e with any other variable. Return the representative (the
+    first row of its group) of each row and the mask of the constant rows.
+    """
+
+    A = np.asarray(A)
+    if A.shape[0] == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+
+    ranks = dense_ranks(A)
+    _, first, inverse = np.unique(ranks, axis=0, return_index=True,
+                                  return_inverse=True)
+    rep = first[inverse.reshape(-1)]
+    constant = ranks.max(axis=1) <= 1 if A.shape[1] else \
+        np.ones(A.shape[0], dtype=bool)
+
+    return rep, constant
+
+
+def pair_groups(Xa, Ya=None):
+    """Return the row groups (see row_groups()) of X and Y (or X) as a tuple
+    (rep_x, constant_x, rep_y, constant_y), or None if all the rows are
+    distinct and not constant.
+    """
+
+    groups_x = row_groups(Xa)
+    groups_y = groups_x if Ya is None else row_groups(Ya)
+    redundant = [(rep != np.arange(rep.shape[0])).any() or constant.any()
+                 for rep, constant in [groups_x, groups_y]]
+
+    return groups_x + groups_y if any(redundant) else None
+
+
+def condensed_index(i, j, m):
+    """Return the position k of the pair (i, j), i < j < m, in the condensed
+    (upper triangle, by row) ordering of the m*(m-1)/2 pairs, the same used
+    by minepy.pstats() and scipy.spatial.distance.pdist().
+    """
+
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+
+    return m*i - i*(i+1)//2 + j - i - 1
+
+
+def condensed_pairs(k, m):
+    """Return the pairs (i, j) at the positions k of the condensed ordering
+    of the m*(m-1)/2 pairs (inverse of condensed_index()).
+    """
+
+    k = np.asarray(k, dtype=np.int64)
+
+    # row i is the largest i such that condensed_index(i, i+1, m) <= k
+    i = m - 2 - np.floor(np.sqrt(-8*k + 4*m*(m-1) - 7) / 2 - 0.5).\
+        astype(np.int64)
+    # fix rounding errors for large m
+    i -= condensed_index(i, i+1, m) > k
+    i += condensed_index(i+1, i+2, m) <= k
+    j = k - condensed_index(i, i+1, m) + i + 1
+
+    return i, j
+
+
+DATA_CACHE_FORMAT = "mictools-data"
+DATA_CACHE_VERSION = 1
+DATA_CACHE_SUFFIX = ".npc"
+
+
+def _read_tsv(input_fn):
     table = pd.read_csv(input_fn, sep='\t', index_col=0)
     # cast index into string
     table.index = [str(elem) for elem in table.index]
@@ -45,6 +261,180 @@ def read_table(input_fn):
     return table
 
 
+def is_data_cache(path):
+    """Return True if path is a binary data cache directory (see
+    write_data_cache()).
+    """
+
+    meta_fn = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_fn):
+        return False
+
+    with open(meta_fn) as meta_handle:
+        return json.load(meta_handle).get("format") == DATA_CACHE_FORMAT
+
+
+def file_sha1(fn, chunk_size=2**20):
+    """Return the SHA-1 hex digest of the content of the file fn.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def row_sha1(A):
+    """Return the SHA-1 hex digests of the rows of A (as float64 values).
+    """
+
+    A = np.asarray(A, dtype=np.float64)
+
+    return [hashlib.sha1(np.ascontiguousarray(a).tobytes()).hexdigest()
+            for a in A]
+
+
+def write_data_cache(input_fn, cache_dir=None):
+    """Convert the tab-delimited data file input_fn to a binary data cache
+    directory (by default input_fn + DATA_CACHE_SUFFIX), containing:
+
+    * values.npy: the float64 data matrix (variables x samples), which can
+      be memory-mapped;
+    * rows.txt, columns.txt: the variable and the sample IDs. The samples
+      are sorted, i.e. aligned as in read_data();
+    * meta.json: the size, the modification time and the SHA-1 hash of
+      input_fn, used to validate the cache.
+
+    Return the cache directory.
+    """
+
+    if cache_dir is None:
+        cache_dir = input_fn + DATA_CACHE_SUFFIX
+
+    table = _read_tsv(input_fn)
+    table = table[sorted(table.columns)]
+    try:
+        values = table.values.astype(np.float64)
+    except ValueError:
+        raise ValueError("{} contains non-numeric values".format(input_fn))
+
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+
+    np.save(os.path.join(cache_dir, "values.npy"), values)
+    for key, names in [("rows", table.index), ("columns", table.columns)]:
+        with open(os.path.join(cache_dir, key + ".txt"), 'w') as handle:
+            for name in names:
+                handle.write("{}\n".format(name))
+
+    stat = os.stat(input_fn)
+    meta = {"format": DATA_CACHE_FORMAT, "version": DATA_CACHE_VERSION,
+            "source": os.path.basename(input_fn), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns, "sha1": file_sha1(input_fn),
+            "shape": list(values.shape)}
+    # meta.json is written last, the cache is valid only if complete
+    meta_fn = os.path.join(cache_dir, "meta.json")
+    with open(meta_fn + ".tmp", 'w') as meta_handle:
+        json.dump(meta, meta_handle, indent=1)
+    os.replace(meta_fn + ".tmp", meta_fn)
+
+    return cache_dir
+
+
+def read_data_cache(cache_dir, mmap=True):
+    """Read a binary data cache directory as a DataFrame. The data are
+    memory-mapped (read-only) if mmap is True.
+    """
+
+    with open(os.path.join(cache_dir, "meta.json")) as meta_handle:
+        meta = json.load(meta_handle)
+
+    if meta["version"] > DATA_CACHE_VERSION:
+        raise ValueError("unsupported data cache version {}".\
+                         format(meta["version"]))
+
+    values = np.load(os.path.join(cache_dir, "values.npy"),
+                     mmap_mode='r' if mmap else None)
+    names = []
+    for key in ["rows", "columns"]:
+        with open(os.path.join(cache_dir, key + ".txt")) as handle:
+            names.append([line.rstrip('\n') for line in handle])
+
+    return pd.DataFrame(values, index=names[0], columns=names[1], copy=False)
+
+
+def data_cache(input_fn):
+    """Return the data cache directory of input_fn if it exists and it is
+    up to date, None otherwise. The cache is up to date if input_fn has the
+    same size and modification time or, when only the modification time
+    differs (e.g. the file was touched or copied), the same SHA-1 hash. In
+    the latter case the modification time stored in the cache is updated.
+    """
+
+    cache_dir = input_fn + DATA_CACHE_SUFFIX
+    if not is_data_cache(cache_dir):
+        return None
+
+    meta_fn = os.path.join(cache_dir, "meta.json")
+    with open(meta_fn) as meta_handle:
+        meta = json.load(meta_handle)
+
+    stat = os.stat(input_fn)
+    if meta["size"] != stat.st_size or \
+       (meta["mtime_ns"] != stat.st_mtime_ns and \
+        meta["sha1"] != file_sha1(input_fn)):
+        sys.stderr.write("warning: the data cache {} is out of date and it "
+                         "will be ignored\n".format(cache_dir))
+        return None
+
+    if meta["mtime_ns"] != stat.st_mtime_ns:
+        meta["mtime_ns"] = stat.st_mtime_ns
+        try:
+            with open(meta_fn + ".tmp", 'w') as meta_handle:
+                json.dump(meta, meta_handle, indent=1)
+            os.replace(meta_fn + ".tmp", meta_fn)
+        except OSError:
+            pass
+
+    return cache_dir
+
+
+def datacache_cmd(input_fns):
+
+    for input_fn in input_fns:
+        try:
+            cache_dir = write_data_cache(input_fn)
+        except ValueError as e:
+            sys.stderr.write("{}\n".format(e))
+            exit(1)
+        sys.stdout.write("{} -> {}\n".format(input_fn, cache_dir))
+
+
+def read_table(input_fn):
+    """Read table. input_fn can be a tab-delimited file or a binary data
+    cache directory. If an up to date data cache of the file exists (see
+    write_data_cache()), it is used instead of parsing the file.
+    """
+
+    with mictools.metrics.io("read", input_fn):
+        if os.path.isdir(input_fn):
+            if not is_data_cache(input_fn):
+                raise ValueError("{} is not a data cache directory".\
+                                 format(input_fn))
+            return read_data_cache(input_fn)
+
+        cache_dir = data_cache(input_fn)
+        if cache_dir is not None:
+            return read_data_cache(cache_dir)
+
+        return _read_tsv(input_fn)
+
+
 def check_data(X, Y=None, labels=None):
     if not (Y is None):
         if X.shape[1] != Y.shape[1]:
@@ -61,6 +451,14 @@ def check_data(X, Y=None, labels=None):
             raise ValueError("sample names mismatch between X and labels")
 
 
+def _select_samples(table, sample_ids):
+    # no copy if the samples are already aligned (e.g. memory-mapped caches)
+    if list(table.columns) == sample_ids:
+        return table
+
+    return table[sample_ids]
+
+
 def read_data(xvars_fn, labels_fn=None, target=None, yvars_fn=None):
 
     X = read_table(xvars_fn)
@@ -86,9 +484,9 @@ def read_data(xvars_fn, labels_fn=None, target=None, yvars_fn=None):
     if not yvars_fn is None:
         Y = read_table(yvars_fn)
         sample_ids = sorted(set(sample_ids) & set(Y.columns))
-        Y = Y[sample_ids]
+        Y = _select_samples(Y, sample_ids)
     
-    X = X[sample_ids]
+    X = _select_samples(X, sample_ids)
 
     if not labels_fn is None:
         labels = labels[sample_ids]
@@ -26,6 +26,10 @@ import click
 import mictools.null
 import mictools.pval
 import mictools.strength
+import mictools.results
+import mictools.utils
+import mictools.run
+import mictools.metrics
 from mictools import __version__
 
 
@@ -45,12 +49,49 @@ yvars_help = 'tab-delimited data file (K x N). If this file is provided, the ' \
 rowwise_help = 'when the dataset Y is provided, compute the TICe values between ' \
                'XVARS_i and YVARS_i for each i, instead of XVARS_i and YVARS_j ' \
                'for each i, j.'
+
+jobs_help = 'number of worker processes.'
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        k, nshards = [int(elem) for elem in value.split('/')]
+    except ValueError:
+        raise click.BadParameter("shard must be in the form k/N")
+
+    if not (1 <= k <= nshards):
+        raise click.BadParameter("shard must be k/N with 1 <= k <= N")
+
+    return k, nshards
     
 
 @click.group()
-def cli():
+@click.option('--metrics', type=click.Path(writable=True), help='write a '
+              'JSON report of the run to this file: wall and CPU time, '
+              'throughput (permutations/s, pairs/s) and I/O time per stage, '
+              'the work done also per class, the peak RSS of the process '
+              'and the largest peak RSS of its worker processes.')
+@click.option('--progress', is_flag=True, help='report the progress, the '
+              'throughput and the ETA of the computations on stderr.')
+@click.option('--profile', type=click.Path(writable=True), help='profile '
+              'the main process with cProfile and write the statistics to '
+              'this file (see the Python pstats module).')
+@click.pass_context
+def cli(ctx, metrics, progress, profile):
     """MICtools v. {}.""".format(__version__)
-    pass
+
+    if (metrics is None) and (not progress) and (profile is None):
+        return
+
+    mictools.metrics.enable(progress=progress, profile=profile is not None)
+    if profile is not None:
+        ctx.call_on_close(lambda: mictools.metrics.write_profile(profile))
+    if metrics is not None:
+        ctx.call_on_close(lambda: mictools.metrics.write_metrics(metrics))
+    ctx.with_resource(mictools.metrics.stage(ctx.invoked_subcommand))
 
 @cli.command()
 @click.argument('xvars', type=click.Path(exists=True))
@@ -69,8 +110,33 @@ def cli():
               'for more complex alternative hypotheses.')
 @click.option('-c', '--clumps', type=click.INT, default=5,
               show_default=True, help="TICe c parameter.")
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True, help=jobs_help)
+@click.option('--batch', type=click.IntRange(min=1), default=1,
+              show_default=True, help='number of variables scored against '
+              'each permuted variable in a single minepy call. Values such as '
+              '100 are much faster for small sample sizes.')
+@click.option('--tail', is_flag=True, help='fit a generalized Pareto '
+              'distribution to the upper tail of the null distribution and '
+              'write its parameters to OUTPUT_tail.txt (see pval --tail).')
+@click.option('--tail-quantile', type=click.FLOAT, default=0.99,
+              show_default=True, help='null quantile above which the tail is '
+              'fitted.')
+@click.option('--shard', callback=parse_shard, metavar='k/N',
+              help='compute only the k-th of N independent portions of the '
+              'permutations (see mergenull).')
+@click.option('--checkpoint', type=click.Path(writable=True),
+              help='periodically save the partial null distribution to this '
+              'file and resume from it if it exists.')
+@click.option('--checkpoint-every', type=click.IntRange(min=1), default=10000,
+              show_default=True, help='number of permutations between two '
+              'checkpoints.')
+@click.option('--cache', type=click.Path(file_okay=False, writable=True),
+              help='null cache directory. The null distributions are looked '
+              'up in (and added to) the cache.')
 def null(xvars, output, labels, target, yvars, rowwise, nperm, seed, grid,
-         clumps):
+         clumps, jobs, batch, tail, tail_quantile, shard, checkpoint,
+         checkpoint_every, cache):
     """Compute the TICe null distribution.
 
     XVARS is a tab-delimited data file. The file must contain the variables by
@@ -95,16 +161,51 @@ def null(xvars, output, labels, target, yvars, rowwise, nperm, seed, grid,
 
     will compute the empirical null distribution considering all the variable
     pairs between the dataset data1.txt and the dataset data2.txt.
+
+    With -j/--jobs N the permutations are split across N worker processes,
+    each with an independent random stream derived from the seed. For a
+    given seed and number of jobs the result is reproducible.
+
+    With --batch K, each permuted variable is tested against a block of K
+    variables (respecting the -y/--yvars and -r/--rowwise pairing rules)
+    instead of a single one, which reduces the per-permutation overhead.
+
+    The computation can be spread over independent jobs with --shard k/N
+    (e.g. 1/4, 2/4, 3/4 and 4/4, with the same seed): each shard computes
+    an independent portion of the NPERM permutations and the resulting null
+    distributions are merged with the mergenull subcommand. With
+    --checkpoint FILE the partial state is saved every --checkpoint-every
+    permutations, and an interrupted run restarted with the same options
+    resumes from the last checkpoint.
+
+    Under permutation, the TICe null distribution depends only on the number
+    of samples, the TICe parameters, the pairing mode and the tie/zero
+    profiles of the variables. With --cache DIR, the null distributions are
+    stored in DIR keyed by these quantities and NPERM, looked up before
+    being computed and shared between classes with the same key. DIR can
+    be used as NULL in the pval subcommand.
+
+    If OUTPUT ends with .npz, the null distribution is written in a compact
+    binary format which stores only the non-zero bins, and uses 100 times
+    finer bins above the 0.99 quantile for more precise p-values in the
+    upper tail. The pval and mergenull subcommands read both formats.
     """
 
     mictools.null.null_cmd(xvars, output, labels, target, yvars, rowwise, nperm,
-                           seed, grid, clumps)
+                           seed, grid, clumps, jobs, batch, tail,
+                           tail_quantile, shard, checkpoint, checkpoint_every,
+                           cache)
 
 
 @cli.command()
 @click.argument('null', nargs=-1, type=click.Path(exists=True))
 @click.argument('output', nargs=1, type=click.Path(exists=False, writable=True))
-def mergenull(null, output):
+@click.option('--tail', is_flag=True, help='fit the generalized Pareto tail '
+              'of the merged null distribution (see null --tail).')
+@click.option('--tail-quantile', type=click.FLOAT, default=0.99,
+              show_default=True, help='null quantile above which the tail is '
+              'fitted.')
+def mergenull(null, output, tail, tail_quantile):
     """Merge multiple TICe null distributions.
 
     NULL is the input null distribution(s) and output is the output null
@@ -116,9 +217,17 @@ def mergenull(null, output):
 
     will merge the independent null distributions null_dist_1.txt and 
     null_dist_2.txt into the output file null_dist.txt.
+
+    The null distributions must have been computed with the same TICe
+    parameters (-b/--grid and -c/--clumps) and classes, and with different
+    random streams (e.g. different shards, see null --shard). Text and
+    binary (.npz, see null) null distributions can be mixed: the sparse
+    bins are added, and the finer upper-tail bins are kept where no input
+    has a coarser non-zero bin. If OUTPUT ends with .npz, the merged null
+    distribution is written in the binary format.
     """
 
-    mictools.mergenull.mergenull_cmd(null, output)
+    mictools.null.mergenull_cmd(null, output, tail, tail_quantile)
 
 
 @cli.command()
@@ -136,8 +245,47 @@ def mergenull(null, output):
               'for more complex alternative hypotheses.')
 @click.option('-c', '--clumps', type=click.INT, default=5,
               show_default=True, help="TICe c parameter.")
-
-def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps):
+@click.option('--tail', is_flag=True, help='extrapolate the p-values in the '
+              'upper tail using the generalized Pareto fit stored next to the '
+              'NULL file (see null --tail).')
+@click.option('--tile-size', type=click.IntRange(min=1), default=1000000,
+              show_default=True, help='number of variable pairs processed '
+              'at once. The memory usage depends on the tile size only.')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True, help=jobs_help)
+@click.option('-f', '--format', 'output_format', default='tsv',
+              type=click.Choice(['tsv', 'binary']), show_default=True,
+              help='format of the per-pair output files (see below).')
+@click.option('--max-pval', type=click.FLOAT, help='write only the pairs '
+              'with p-value <= MAX_PVAL in at least one class (see below).')
+@click.option('--min-tic', type=click.FLOAT, help='write only the pairs '
+              'with TICe >= MIN_TIC in at least one class (see below).')
+@click.option('--top-k', type=click.IntRange(min=1), help='write only the '
+              'TOP_K pairs with the highest TICe of each variable in at least '
+              'one class (see below).')
+@click.option('--previous', type=click.Path(exists=True, file_okay=False),
+              help='results directory of a previous run to be updated with '
+              'the new variables (see below).')
+@click.option('--screen', type=click.FloatRange(0, 1, min_open=True,
+                                                max_open=True),
+              help='fraction of the samples of each class used to screen '
+              'the pairs (see below).')
+@click.option('--screen-pval', type=click.FloatRange(0, 1), default=0.1,
+              show_default=True, help='p-value threshold of the screening.')
+@click.option('--screen-nperm', type=click.IntRange(min=1), default=10000,
+              show_default=True, help='number of permutations of the '
+              'screening null distribution.')
+@click.option('--screen-audit', type=click.FloatRange(0, 1), default=0.01,
+              show_default=True, help='fraction of the discarded pairs '
+              'rescored to estimate the false negative rate of the '
+              'screening.')
+@click.option('--screen-target', type=click.FloatRange(0, 1), default=0.01,
+              show_default=True, help='p-value on all the samples at which '
+              'the false negative rate of the screening is estimated.')
+def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps,
+         tail, tile_size, jobs, output_format, max_pval, min_tic, top_k,
+         previous, screen, screen_pval, screen_nperm, screen_audit,
+         screen_target):
     """Compute TICe p-values.
 
     XVARS is a tab-delimited data file. The file must contain the variables by
@@ -145,7 +293,10 @@ def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps):
     must contain the variable IDs and the first row the sample IDs. By default,
     all the possible variable pairs ((M*(M-1))/2) are tested.
 
-    NULL is the empirical TICe null distribution (see the null subcommand).
+    NULL is the empirical TICe null distribution (see the null subcommand)
+    or a null cache directory (see null --cache). In the latter case, the
+    cached null distribution with the largest number of permutations is used
+    for each class.
     
     If YVARS (K x N) is provided, the analysis will be performed between all 
     variables of the dataset XVARS and of those of the dataset YVARS, for a
@@ -164,7 +315,11 @@ def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps):
                each class;
     - pval.txt: empirical p values for each variable pair tested in 
                 each class;
-    - pval_CLASS.png: the p values distribution for each class.
+    - pval_CLASS.png: the p values distribution for each class;
+    - pval_dist.txt: only in the sparse mode (see below), the p values
+                     distribution of the pairs not written for each class.
+    - variables.txt: the names and the hashes of the variables tested
+                     (see --previous below).
 
     Example:
 
@@ -172,10 +327,71 @@ def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps):
 
     will compute the TICe p values for each variable pair between the dataset
     data1.txt and the dataset data2.txt.
+
+    The smallest empirical p-value is 1/(nperm+1). With --tail, the p-values
+    of the TICe values above the tail threshold are extrapolated using the
+    generalized Pareto distribution fitted by null --tail, allowing much
+    smaller p-values with the same number of permutations.
+
+    The variable pairs are processed in tiles of about --tile-size pairs:
+    the p-values of each tile are computed and written to the output files
+    straight away, so the memory usage does not depend on the number of
+    variables. With -j/--jobs N, the tiles are computed by N worker
+    processes; the tiles contain about the same number of pairs and the
+    output is identical to the serial one.
+
+    With -f/--format binary, obs.bin and pval.bin are written instead of
+    obs.txt and pval.txt. These are directories containing the variable
+    names, the integer pair indices and the float32 values of each class,
+    which can be memory-mapped. They can be used as input of the adjust and
+    strength subcommands, and converted to text with the convert subcommand.
+
+    With --max-pval and/or --min-tic, only the pairs passing one of the
+    thresholds in at least one class are written to the per-pair output
+    files, while obs_dist.txt still contains all the pairs. The p-values of
+    the pairs not written are stored as a histogram in pval_dist.txt, which
+    is read by the adjust subcommand so that the correction still accounts
+    for all the tests.
+
+    With --top-k N, only the N strongest partners (highest TICe) of each
+    variable are written, in the same sparse format. A pair is written if
+    it is among the top N of one of its variables in at least one class
+    (of the pairs passing the thresholds, if given), so that at most M*N
+    ((M+K)*N with YVARS) pairs per class are written and kept in memory.
+    --top-k cannot be used with -r/--rowwise.
+
+    With --previous DIR, the results of a previous run in DIR are updated
+    when variables are added to XVARS (or YVARS): only the pairs involving
+    a new variable are computed and merged with the pairs of DIR, which
+    are written first. The variables are matched by name and by a hash of
+    their values (stored in variables.txt), so that the pairs of a changed
+    variable are recomputed and those of a removed variable are dropped.
+    The samples, the labels, the TICe parameters and the null
+    distribution must be the same of the previous run. OUTPUT can be DIR.
+    Only the tsv results of the all pairs and the XVARS x YVARS modes,
+    without --max-pval, --min-tic or --top-k, can be updated.
+
+    With --screen FRACTION, the pairs are screened in two tiers, which is
+    much faster with many samples. TICe is first computed on a random
+    FRACTION of the samples of each class, with a null distribution of
+    --screen-nperm permutations of the same samples computed on the fly.
+    Only the pairs with p-value <= --screen-pval in at least one class are
+    rescored on all the samples with NULL and written, in the sparse
+    format. The p-values of the discarded pairs are stored in
+    pval_dist.txt, and obs_dist.txt contains only the pairs written; the
+    distribution of the first tier TICe values of all the pairs (on the
+    sample subsets) is written to obs_dist_screen.txt. A
+    random --screen-audit fraction of the discarded pairs is also rescored,
+    to report the estimated false negative rate of the screening, i.e. the
+    fraction of the pairs with p-value <= --screen-target on all the
+    samples which were discarded.
     """
     
     mictools.pval.pval_cmd(xvars, null, output, labels, target, yvars, rowwise, 
-                           grid, clumps)
+                           grid, clumps, tail, tile_size, jobs, output_format,
+                           max_pval, min_tic, top_k, previous, screen,
+                           screen_pval, screen_nperm, screen_audit,
+                           screen_target)
 
 
 @cli.command()
@@ -183,7 +399,13 @@ def pval(xvars, null, output, labels, target, yvars, rowwise, grid, clumps):
 @click.argument('output', type=click.Path(writable=True, dir_okay=True,
                 resolve_path=True))
 @click.option('-m', '--method', default='qvalue', help='correction method.')
-def adjust(pval, output, method):
+@click.option('--chunk-size', type=click.IntRange(min=1), default=1000000,
+              show_default=True, help='number of variable pairs read at '
+              'once.')
+@click.option('--binned', is_flag=True, help='bin the p-values on a fixed '
+              'grid: the memory usage is bounded, but the adjusted p-values '
+              'are conservative approximations.')
+def adjust(pval, output, method, chunk_size, binned):
     """Multiple testing correction.
 
     PVAL is the input file containing the uncorrected p values (see the 
@@ -192,11 +414,30 @@ def adjust(pval, output, method):
 
     \b
     - pval_adj.txt: adjusted p values for each variable pair tested in 
-                    each class.
+                    each class (pval_adj.bin if PVAL is in the binary
+                    format).
     - pi0_CLASS.png: if the method (-m/--method) is the qvalue, command will
                      return the estimated pi_0 versus the tuning parameter
                      lambda for each class. 
 
+    If the pval output was written in the sparse mode (see pval --max-pval
+    and --min-tic), the p-values of the pairs not written are read from the
+    pval_dist.txt file in the same directory of PVAL. Each of them is set to
+    the upper edge of its histogram bin, so the adjusted p-values are
+    slightly conservative.
+
+    PVAL is read twice, in chunks of --chunk-size pairs: the first pass
+    counts the distinct p-values of each class, the second one writes the
+    adjusted p-values. The memory usage depends on the number of distinct
+    p-values, not on the number of pairs, and the results are the same for
+    any chunk size. With --binned (and, with a warning, for a class with
+    more than 10^7 distinct p-values) the p-values are counted on a fixed
+    grid of bins instead, and each one is adjusted as the upper edge of its
+    bin. The memory usage is then bounded, and the adjusted p-values are
+    conservative: at most 0.23% larger (about 1% for the q-values, as pi0
+    is also estimated on the bins). The hommel method always needs all the
+    p-values in memory.
+
     The available methods are:
 
     \b
@@ -217,7 +458,7 @@ def adjust(pval, output, method):
         mictools adjust pval.txt .
     """
 
-    mictools.pval.adjust_cmd(pval, output, method)
+    mictools.pval.adjust_cmd(pval, output, method, chunk_size, binned)
 
 
 @cli.command()
@@ -234,7 +475,12 @@ def adjust(pval, output, method):
               "chosen by default.")
 @click.option('-c', '--clumps', type=click.INT, default=5,
               show_default=True, help="MICe c parameter.")
-def strength(xvars, pval, output, labels, target, yvars, thr, alpha, clumps):
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True, help=jobs_help)
+@click.option('--ordered', is_flag=True, help='with -j/--jobs, write the '
+              'rows in the same order of the serial computation.')
+def strength(xvars, pval, output, labels, target, yvars, thr, alpha, clumps,
+             jobs, ordered):
     """Compute the strength (MICe).
     
     Compute the strength (MICe) on the variable pairs called significant at
@@ -253,14 +499,138 @@ def strength(xvars, pval, output, labels, target, yvars, thr, alpha, clumps):
     analysis will be performed within each class independently. In this case,
     the relationships called significant in at least one class are evaluated.
 
+    PVAL is the (adjusted) p-values file, in text or binary format (see the
+    pval and adjust subcommands).
+
     The OUTPUT file contains MICe, the Pearson and the Spearman's rank 
     correlation coefficients and the TICe p values in each class.
 
+    With -j/--jobs N, the (class, variable pairs) chunks are processed by N
+    worker processes and the rows are written as soon as they are ready, in
+    a nondeterministic order. Use --ordered to keep the order of the serial
+    computation.
+
     Example:
 
         mictools strength data1.txt pval_adj.txt strength.txt -y data2.txt
     """
 
     mictools.strength.strength_cmd(xvars, pval, output, labels, target, yvars,
-                                   thr, alpha, clumps)
-                                   
\ No newline at end of file
+                                   thr, alpha, clumps, jobs, ordered)
+
+
+@cli.command()
+@click.argument('input', type=click.Path(exists=True, file_okay=False))
+@click.argument('output', type=click.Path(exists=False, writable=True))
+def convert(input, output):
+    """Convert binary results to text.
+
+    INPUT is a binary results directory (e.g. pval.bin, see pval
+    -f/--format) and OUTPUT is the TAB-delimited output file, in the same
+    format of the text outputs (e.g. pval.txt).
+
+    Example:
+
+        mictools convert pval.bin pval.txt
+    """
+
+    mictools.results.results_to_tsv(input, output)
+
+
+@cli.command()
+@click.argument('xvars', type=click.Path(exists=True))
+@click.argument('output', type=click.Path(writable=True, dir_okay=True,
+                resolve_path=True))
+@click.option('-l', '--labels', type=click.Path(exists=True), help=labels_help)
+@click.option('-t', '--target', type=click.STRING, help=target_help)
+@click.option('-y', '--yvars', type=click.Path(exists=True), help=yvars_help)
+@click.option('-r', '--rowwise', is_flag=True, help=rowwise_help)
+@click.option('-p', '--nperm', type=click.INT, default=200000,
+              show_default=True, help='number of permutations.')
+@click.option('-s', '--seed', type=click.INT, default=0,
+              show_default=True, help="random seed.")
+@click.option('-b', '--grid', type=click.INT, default=9,
+              show_default=True, help='TICe maximum grid size B(n).')
+@click.option('-c', '--clumps', type=click.INT, default=5,
+              show_default=True, help="TICe and MICe c parameter.")
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True, help=jobs_help)
+@click.option('--batch', type=click.IntRange(min=1), default=1,
+              show_default=True, help='see null --batch.')
+@click.option('--tail', is_flag=True, help='extrapolate the p-values in the '
+              'upper tail using a generalized Pareto fit of the null '
+              'distribution (see null --tail).')
+@click.option('--tail-quantile', type=click.FLOAT, default=0.99,
+              show_default=True, help='null quantile above which the tail is '
+              'fitted.')
+@click.option('--cache', type=click.Path(file_okay=False, writable=True),
+              help='null cache directory (see null --cache).')
+@click.option('--tile-size', type=click.IntRange(min=1), default=1000000,
+              show_default=True, help='see pval --tile-size.')
+@click.option('-m', '--method', default='qvalue', show_default=True,
+              help='correction method (see adjust).')
+@click.option('--thr', type=click.FLOAT, default=0.05,
+              show_default=True, help="significance threshold.")
+@click.option('-a', '--alpha', type=click.FLOAT, default=None,
+              show_default=True, help="MICe alpha parameter. Automatically "
+              "chosen by default.")
+@click.option('--intermediates', is_flag=True, help='write also the '
+              'intermediate results (see below).')
+def run(xvars, output, labels, target, yvars, rowwise, nperm, seed, grid,
+        clumps, jobs, batch, tail, tail_quantile, cache, tile_size, method,
+        thr, alpha, intermediates):
+    """Run the whole pipeline (null, pval, adjust and strength).
+
+    The data files are read once and the null distribution, the p-values
+    (in single precision) and the adjusted p-values are kept in memory and
+    passed to the next step, without writing and parsing intermediate text
+    files; the TICe values are only kept as a histogram. The options
+    have the same meaning of the corresponding ones of the single
+    subcommands.
+
+    The command returns in the OUTPUT directory the following files:
+
+    \b
+    - strength.txt: the strength of the pairs with an adjusted p value
+                    < THR in at least one class (see strength);
+    - pi0_CLASS.png: if the method is the qvalue (see adjust).
+
+    With --intermediates, also null_dist.txt (null_dist_tail.txt with
+    --tail), obs_dist.txt, obs.txt, pval.txt, pval_adj.txt and the
+    pval_CLASS.png plots are written.
+
+    Example:
+
+        mictools run data.txt results -l labels.txt -t class -j 4
+    """
+
+    mictools.run.run_cmd(xvars, output, labels, target, yvars, rowwise, nperm,
+                         seed, grid, clumps, jobs, batch, tail, tail_quantile,
+                         cache, tile_size, method, thr, alpha, intermediates)
+
+
+@cli.command()
+@click.argument('input', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+def datacache(input):
+    """Convert data files to binary data caches.
+
+    For each tab-delimited data file INPUT (e.g. XVARS or YVARS), write the
+    INPUT.npc directory containing the data matrix in the numpy format, the
+    variable and sample IDs and the size, modification time and SHA-1 hash
+    of INPUT.
+
+    The null, pval and strength subcommands use an up to date INPUT.npc
+    automatically when INPUT is provided, memory-mapping the data instead
+    of parsing the text file. A cache is ignored (with a warning) when
+    INPUT is modified afterwards. If only the modification time of INPUT
+    changed, the cache is still used when the SHA-1 hash matches. The
+    cache directory can also be passed
+    directly in place of INPUT.
+
+    Example:
+
+        mictools datacache data1.txt data2.txt
+    """
+
+    mictools.utils.datacache_cmd(input)
@@ -25,9 +25,9 @@ setup(
     maintainer_email='davide.albanese@gmail.com',
     install_requires=[
         'Click>=5.1',
-        'numpy>=1.7.0',
+        'numpy>=1.17.0',
         'scipy>=0.13',
-        'pandas>=0.17.0',
+        'pandas>=0.24.0',
         'matplotlib>=1.2.0',
         'statsmodels>=0.6.1',
         'minepy>=1.2'],